@@ -1,22 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 from django.utils.translation import ugettext_lazy as _
 
 from email_backup.core.models import (
+    Attachment,
     EmailAccount,
     Email,
-    EmailPath
+    EmailPath,
+    SyncRun
 )
+from email_backup.core.pagination import KEYSET_ORDERING, KeysetPaginator
 
 
 def sync_directories(modeladmin, request, queryset):
     for account in queryset.all():
-        email_server = account.connector()
-        email_server.open()
-        for directory in email_server.directories():
-            EmailPath.objects.get_or_create(account=account, path=directory)
+        with account.connection_pool().connection() as email_server:
+            for directory in email_server.directories():
+                EmailPath.objects.get_or_create(account=account, path=directory)
 
 
 sync_directories.short_description = _("Sync directories")
@@ -37,7 +46,7 @@ remove_sync_accounts.short_description = _("Remove sync mark")
 
 
 class EmailAccountAdmin(admin.ModelAdmin):
-    list_display = ('user', 'host', 'ssl', 'port', 'sync', 'path')
+    list_display = ('user', 'host', 'ssl', 'port', 'sync', 'next_sync', 'path')
     search_fields = ('user', 'path', 'host')
     list_filter = ('ssl', 'port', 'sync', 'remove', 'just_read')
     actions = [sync_directories, sync_accounts, remove_sync_accounts]
@@ -48,11 +57,11 @@ class EmailAccountAdmin(admin.ModelAdmin):
         }),
         (_('Advanced options'), {
             'classes': ('collapse',),
-            'fields': ('path', 'ssl', 'port'),
+            'fields': ('path', 'ssl', 'port', 'compression'),
         }),
         (_('Sync options'), {
             'classes': ('collapse',),
-            'fields': ('sync', 'weeks_before', 'remove', 'just_read'),
+            'fields': ('sync', 'next_sync', 'weeks_before', 'remove', 'just_read', 'connections'),
         }),
     )
 
@@ -74,12 +83,20 @@ def remove_ignore_paths(modeladmin, request, queryset):
 remove_ignore_paths.short_description = _("Remove ignore mark")
 
 
+def reset_paths(modeladmin, request, queryset):
+    queryset.update(uid_validity=None, last_uid=0)
+    SyncRun.objects.filter(path__in=queryset).cancel()
+
+
+reset_paths.short_description = _("Force full sync")
+
+
 class EmailPathAdmin(admin.ModelAdmin):
-    list_display = ('account', 'path', 'ignore')
+    list_display = ('account', 'path', 'ignore', 'last_uid')
     search_fields = ('path',)
-    readonly_fields = ('account', 'path')
+    readonly_fields = ('account', 'path', 'uid_validity', 'last_uid')
     list_filter = ('ignore',)
-    actions = [ignore_paths, remove_ignore_paths]
+    actions = [ignore_paths, remove_ignore_paths, reset_paths]
 
     def has_add_permission(self, request):
         return False
@@ -88,15 +105,95 @@ class EmailPathAdmin(admin.ModelAdmin):
 admin.site.register(EmailPath, EmailPathAdmin)
 
 
+def cancel_runs(modeladmin, request, queryset):
+    queryset.cancel()
+
+
+cancel_runs.short_description = _("Cancel")
+
+
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('path', 'account', 'state', 'checkpoint', 'emails', 'fetched', 'linked', 'started', 'finished')
+    list_filter = ('state',)
+    readonly_fields = ('account', 'path', 'state', 'uid_validity', 'since_uid', 'checkpoint',
+                       'emails', 'fetched', 'linked', 'error', 'started', 'updated', 'finished')
+    actions = [cancel_runs]
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(SyncRun, SyncRunAdmin)
+
+
+class EmailChangeList(ChangeList):
+    def get_queryset(self, request):
+        queryset = super(EmailChangeList, self).get_queryset(request).defer('content', 'raw')
+        return queryset.prefetch_related('attachments')
+
+
 class EmailAdmin(admin.ModelAdmin):
-    list_display = ('send_by', 'subject', 'attaches', 'date')
+    list_display = ('send_by', 'subject', 'attachment_links', 'date', 'raw_link')
+    list_display_links = None
     search_fields = ('^send_by', 'subject', 'content')
+    ordering = KEYSET_ORDERING
+    paginator = KeysetPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return EmailChangeList
+
+    def get_urls(self):
+        urls = [
+            url(r'^(?P<pk>\d+)/raw/$', self.admin_site.admin_view(self.raw_view), name='core_email_raw'),
+            url(r'^attachment/(?P<pk>\d+)/$', self.admin_site.admin_view(self.attachment_view),
+                name='core_email_attachment'),
+        ]
+        return urls + super(EmailAdmin, self).get_urls()
+
+    def raw_view(self, request, pk):
+        # The same users that can see the list of emails
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        email = get_object_or_404(Email, pk=pk)
+        response = FileResponse(email.open_raw(), content_type='message/rfc822')
+        response['Content-Disposition'] = 'attachment; filename="{}.eml"'.format(email.pk)
+        return response
+
+    def raw_link(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse('admin:core_email_raw', args=[obj.pk]), _('Download'))
+
+    raw_link.short_description = _("Raw")
+
+    def attachment_view(self, request, pk):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        attachment = get_object_or_404(Attachment, pk=pk)
+        response = FileResponse(attachment.open(), content_type=attachment.content_type)
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            attachment.filename.replace('"', '') or attachment.digest
+        )
+        return response
+
+    def attachment_links(self, obj):
+        return format_html_join(', ', '<a href="{}">{}</a>', (
+            (reverse('admin:core_email_attachment', args=[attachment.pk]), attachment)
+            for attachment in obj.attachments.all()
+        )) or obj.attaches
+
+    attachment_links.short_description = _("Attachments")
+
+    def get_search_results(self, request, queryset, search_term):
+        return queryset.search(search_term), False
 
     def has_add_permission(self, request):
         return False
 
     def has_change_permission(self, request, obj=None):
-        return False
+        # Only the list of emails, they can not be edited
+        if obj is not None:
+            return False
+        return super(EmailAdmin, self).has_change_permission(request)
 
 
 admin.site.register(Email, EmailAdmin)
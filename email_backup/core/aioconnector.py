@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+# Python 3.5+ only, asyncio versions of the connector
+import asyncio
+import imaplib
+import logging
+import re
+import ssl as ssl_lib
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from email_backup.core.connector import (
+    FETCH_CHUNK_SIZE,
+    RE_IMAP4_DIR_FLAGS,
+    RE_IMAP4_DIR_NAME,
+    RE_IMAP4_FETCH_UID,
+    RE_IMAP4_STATUS,
+    RE_IMAP4_STATUS_ITEM,
+    RE_IMAP4_VANISHED,
+    SESSION_ERRORS,
+    Email,
+    EmailConnectorInterface,
+    EmailHeader,
+    chunks,
+    message_set,
+    parse_fetch,
+    parse_message_id,
+    quote
+)
+
+logger = logging.getLogger(__name__)
+
+RE_TAGGED = re.compile(r'(?P<tag>A\d+) (?P<type>[A-Z]+) ?(?P<data>.*)$')
+RE_UNTAGGED = re.compile(r'\* (?:(?P<number>\d+) )?(?P<type>[A-Z-]+)(?: (?P<data>.*))?$')
+RE_LITERAL = re.compile(r'.*\{(?P<size>\d+)\}$')
+
+IMAP4_PORT = 143
+IMAP4_SSL_PORT = 993
+FETCH_WINDOW = 4
+
+
+def get_fetch_window():
+    return getattr(settings, 'EMAIL_BACKUP_FETCH_WINDOW', FETCH_WINDOW)
+
+
+class AsyncIMAP4(object):
+    def __init__(self, reader, writer, loop=None):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop or asyncio.get_event_loop()
+        self.tag = 0
+        self.pending = OrderedDict()
+        self.untagged = {}
+        self.welcome = None
+        self.error = None
+        self.continuation = None
+        self.changed = None
+        self._task = None
+
+    @classmethod
+    async def connect(cls, host, port=None, ssl=False, loop=None):
+        context = ssl_lib.create_default_context() if ssl else None
+        port = port or (IMAP4_SSL_PORT if ssl else IMAP4_PORT)
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        connection = cls(reader, writer, loop=loop)
+        await connection.start()
+        return connection
+
+    async def start(self):
+        self.welcome = await self._readline()
+        if not self.welcome.startswith('* OK') and not self.welcome.startswith('* PREAUTH'):
+            raise imaplib.IMAP4.error(self.welcome)
+        self._task = self.loop.create_task(self._read_responses())
+
+    def command(self, name, *args, response=None):
+        # The command is sent right away, several commands can be pipelined
+        # before waiting any of them
+        if self.error:
+            raise self.error
+        self.tag += 1
+        tag = 'A{:04d}'.format(self.tag)
+        future = self.loop.create_future()
+        self.pending[tag] = (future, response or name.split()[-1])
+        line = ' '.join([tag, name] + [str(arg) for arg in args if arg is not None])
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        return future
+
+    async def _readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        return line.rstrip(b'\r\n').decode('latin-1')
+
+    async def _read_responses(self):
+        try:
+            while True:
+                line = await self._readline()
+                if line.startswith('+'):
+                    if self.continuation and not self.continuation.done():
+                        self.continuation.set_result(line)
+                    continue
+                match = RE_TAGGED.match(line)
+                if match:
+                    self._complete(match.group('tag'), match.group('type'), match.group('data'))
+                    continue
+                match = RE_UNTAGGED.match(line)
+                if not match:
+                    continue
+                data = match.group('data') or ''
+                if match.group('number'):
+                    data = '{} {}'.format(match.group('number'), data).rstrip()
+                literal = RE_LITERAL.match(data)
+                while literal:
+                    message = await self.reader.readexactly(int(literal.group('size')))
+                    self._append(match.group('type'), (data, message))
+                    data = await self._readline()
+                    literal = RE_LITERAL.match(data)
+                self._append(match.group('type'), data)
+                if match.group('type') == 'BYE':
+                    raise imaplib.IMAP4.abort(data)
+        except (imaplib.IMAP4.abort, asyncio.IncompleteReadError, ConnectionError) as error:
+            self._abort(error)
+
+    def _append(self, response, data):
+        self.untagged.setdefault(response, []).append(data)
+        if response == 'EXISTS' and self.changed and not self.changed.done():
+            self.changed.set_result(data)
+
+    async def idle(self, timeout=None):
+        # Waits until the server reports new messages on the selected mailbox, RFC 2177
+        self.continuation = self.loop.create_future()
+        self.changed = self.loop.create_future()
+        if self.untagged.get('EXISTS'):
+            # Reported between the previous command and this one
+            self.changed.set_result(self.untagged['EXISTS'][-1])
+        future = self.command('IDLE', response='EXISTS')
+        try:
+            await asyncio.wait([self.continuation, future], return_when=asyncio.FIRST_COMPLETED)
+            if not future.done():
+                await asyncio.wait([self.changed, future], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Also when cancelled, the session must leave IDLE before any other command
+            if not future.done() and self.continuation.done() and not self.error:
+                self.writer.write(b'DONE\r\n')
+            self.continuation = self.changed = None
+        return await future
+
+    def _complete(self, tag, status, text):
+        if tag not in self.pending:
+            logger.warning('Unexpected response {} {} {}'.format(tag, status, text))
+            return
+        future, response = self.pending.pop(tag)
+        untagged, self.untagged = self.untagged, {}
+        if future.done():
+            return
+        if status == 'BAD':
+            future.set_exception(imaplib.IMAP4.error('{} command error: {}'.format(response, text)))
+        elif status == 'OK':
+            future.set_result((status, untagged.get(response, [None])))
+        else:
+            future.set_result((status, [text]))
+
+    def _abort(self, error):
+        if not isinstance(error, imaplib.IMAP4.abort):
+            error = imaplib.IMAP4.abort(str(error))
+        self.error = error
+        pending, self.pending = self.pending, OrderedDict()
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        self.writer.close()
+
+
+class FetchIterator(object):
+    # Keeps a window of FETCH commands in flight, only their messages are held in memory
+    def __init__(self, connector, directory, email_ids, query, chunk_size, window=None, transform=None):
+        self.connector = connector
+        self.directory = directory
+        self.query = query
+        self.window = max(int(window or get_fetch_window()), 1)
+        self.transform = transform
+        self.chunks = (message_set(chunk) for chunk in chunks(email_ids, chunk_size))
+        self.pending = deque()
+        self.messages = deque()
+        self.started = False
+
+    def __aiter__(self):
+        return self
+
+    def _send(self):
+        for chunk in self.chunks:
+            self.pending.append((chunk, self.connector._command('FETCH', chunk, self.query, response='FETCH')))
+            if len(self.pending) >= self.window:
+                break
+
+    async def __anext__(self):
+        if not self.started:
+            self.started = True
+            if self.connector.connection:
+                await self.connector.chdir(self.directory)
+                self._send()
+        while not self.messages:
+            if not self.pending:
+                raise StopAsyncIteration
+            chunk, future = self.pending.popleft()
+            ok, data = await future
+            self._send()
+            if ok != 'OK':
+                logger.error('Cannot fetch {} from {}'.format(chunk, self.directory))
+                continue
+            for email_id, uid, size, msg in parse_fetch(data):
+                if self.connector.use_uid:
+                    email_id = uid
+                self.messages.append((email_id, uid, size, msg))
+        message = self.messages.popleft()
+        return self.transform(*message) if self.transform else message
+
+
+class AsyncEmailConnector(EmailConnectorInterface):
+    def __init__(self, host, port, ssl, user, password, use_uid=False, readonly=False, loop=None):
+        super(AsyncEmailConnector, self).__init__(host, port, ssl, user, password, use_uid=use_uid,
+                                                  readonly=readonly)
+        self.loop = loop
+
+    def _command(self, command, *args, response=None):
+        if self.use_uid:
+            command = 'UID {}'.format(command)
+        return self.connection.command(command, *args, response=response)
+
+    async def open(self):
+        self.connection = await AsyncIMAP4.connect(self.host, self.port, ssl=self.ssl, loop=self.loop)
+        ok, data = await self.connection.command('LOGIN', quote(self.user), quote(self.password))
+        if ok != 'OK':
+            raise imaplib.IMAP4.error(data[-1])
+        if self.use_uid and await self.has_capability('QRESYNC'):
+            ok, _ = await self.connection.command('ENABLE', 'QRESYNC')
+            self._qresync = ok == 'OK'
+
+    async def close(self):
+        if self.connection:
+            try:
+                # CLOSE expunges a read-write mailbox, also the emails flagged by other clients
+                if not self._selected or self._selected[1]:
+                    await self.connection.command('CLOSE')
+                await self.connection.command('LOGOUT')
+            except imaplib.IMAP4.error:
+                pass  # Error because not login?
+            finally:
+                await self.connection.close()
+        self.connection = None
+        self._capabilities = None
+        self._qresync = False
+        self._trash = None
+        self._selected = None
+
+    async def has_capability(self, capability):
+        if not self.connection:
+            return False
+        if self._capabilities is None:
+            ok, data = await self.connection.command('CAPABILITY')
+            self._capabilities = set((data[-1] or '').upper().split()) if ok == 'OK' else set()
+        return capability.upper() in self._capabilities
+
+    async def idle(self, directory, timeout=None):
+        # The EXISTS counts reported until the timeout, empty when nothing arrived
+        if not self.connection:
+            return []
+        await self.chdir(directory, readonly=True)
+        ok, data = await self.connection.idle(timeout)
+        if ok != 'OK':
+            raise imaplib.IMAP4.error('IDLE failed on {}: {}'.format(directory, data[-1]))
+        return [int(count) for count in data if count]
+
+    async def trash(self):
+        if self._trash is None and self.connection:
+            self._trash = ''
+            _, lines = await self.connection.command('LIST', '""', '*')
+            for line in lines:
+                flags = RE_IMAP4_DIR_FLAGS.findall(line or '')
+                find = RE_IMAP4_DIR_NAME.findall(line or '')
+                if flags and find and '\\trash' in flags[0].lower().split():
+                    self._trash = find[0]
+                    break
+        return self._trash or None
+
+    async def trash_target(self):
+        if self.use_uid and await self.has_capability('MOVE'):
+            return await self.trash()
+        return None
+
+    async def directories(self):
+        directories = []
+        if self.connection:
+            _, lines = await self.connection.command('LIST', '""', '*')
+            for line in lines:
+                find = RE_IMAP4_DIR_NAME.findall(line or '')
+                if find:
+                    directories.append(find[0])
+        return directories
+
+    async def get_emails(self, directory, before=None, just_read=False):
+        email_ids = await self.search(directory, before=before, just_read=just_read)
+        return self.fetch(directory, email_ids)
+
+    async def status(self, directory):
+        status = {}
+        if self.connection and directory:
+            items = 'UIDVALIDITY UIDNEXT'
+            if await self.has_capability('CONDSTORE') or await self.has_capability('QRESYNC'):
+                items += ' HIGHESTMODSEQ'
+            ok, lines = await self.connection.command('STATUS', quote(directory), '({})'.format(items))
+            if ok == 'OK':
+                for line in lines:
+                    find = RE_IMAP4_STATUS.findall(line or '')
+                    if find:
+                        for key, value in RE_IMAP4_STATUS_ITEM.findall(find[0]):
+                            status[key.upper()] = int(value)
+        return status
+
+    async def search(self, directory, before=None, just_read=False, since_uid=None, invert=False):
+        ids = []
+        if self.connection:
+            num_emails = await self.chdir(directory, refresh=True)
+            ids, queries = self._search_criteria(num_emails, before, just_read, since_uid, invert)
+            if queries:
+                _, lines = await self._command('SEARCH', *queries)
+                ids = self._search_result(' '.join(line for line in lines if line), since_uid)
+        return list(ids)
+
+    def _fetch_chunks(self, directory, email_ids, query, chunk_size, transform=None):
+        return FetchIterator(self, directory, email_ids, query, chunk_size, transform=transform)
+
+    def fetch(self, directory, email_ids, only_header=False, chunk_size=FETCH_CHUNK_SIZE):
+        # An async iterator, the emails are read as they are used
+        query = '(UID RFC822.SIZE BODY.PEEK[HEADER])' if only_header else '(UID RFC822)'
+
+        def feed(email_id, uid, size, msg):
+            email = Email(self, email_id, directory, uid=uid)
+            email.feed(msg, only_header=only_header, size=size)
+            return email
+        return self._fetch_chunks(directory, email_ids, query, chunk_size, transform=feed)
+
+    async def message_ids(self, directory, email_ids, chunk_size=FETCH_CHUNK_SIZE):
+        query = '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+        message_ids, missing = [], []
+        async for email_id, _, _, msg in self._fetch_chunks(directory, email_ids, query, chunk_size):
+            message_id = parse_message_id(msg)
+            if message_id:
+                message_ids.append((email_id, message_id))
+            else:
+                missing.append(email_id)
+        # Only the emails without Message-Id need the whole header
+        query = '(UID BODY.PEEK[HEADER])'
+        async for email_id, _, _, msg in self._fetch_chunks(directory, missing, query, chunk_size):
+            message_ids.append((email_id, EmailHeader.parse(msg).message_id))
+        return message_ids
+
+    async def _fetch_one(self, email_id, query):
+        msg = None
+        if self.connection and int(email_id) > 0:
+            _, data = await self._command('FETCH', email_id, query, response='FETCH')
+            for _, _, _, msg in parse_fetch(data):
+                break
+        return msg
+
+    async def read(self, email_id):
+        return await self._fetch_one(email_id, '(RFC822)')
+
+    async def header(self, email_id):
+        return await self._fetch_one(email_id, '(BODY.PEEK[HEADER])')
+
+    async def get_uid(self, email_id):
+        if self.use_uid:
+            return int(email_id)
+        uid = None
+        if self.connection and int(email_id) > 0:
+            ok, lines = await self.connection.command('FETCH', email_id, '(UID)')
+            if ok == 'OK':
+                for line in lines:
+                    find = RE_IMAP4_FETCH_UID.findall(line or '')
+                    if find:
+                        uid = int(find[0])
+                        break
+        return uid
+
+    async def chdir(self, directory, readonly=None, refresh=False):
+        num_emails = 0
+        if self.connection and directory:
+            readonly = self.readonly if readonly is None else readonly
+            if not refresh and self._selected == (directory, readonly):
+                return self._selected_emails
+            self._selected = None
+            command = 'EXAMINE' if readonly else 'SELECT'
+            ok, lines = await self.connection.command(command, quote(directory), response='EXISTS')
+            if ok == 'OK':
+                num_emails = int(lines[-1] or 0)
+                self._selected, self._selected_emails = (directory, readonly), num_emails
+        return num_emails
+
+    async def vanished(self, directory, modseq, last_uid):
+        uids = []
+        if not self.connection or not self._qresync or not modseq or not last_uid:
+            return uids
+        await self.chdir(directory)
+        # The untagged responses of each command are kept apart, no other mailbox is reported here
+        ok, lines = await self.connection.command('UID FETCH', '1:{}'.format(int(last_uid)), '(UID)',
+                                                  '(CHANGEDSINCE {} VANISHED)'.format(int(modseq)),
+                                                  response='VANISHED')
+        if ok != 'OK':
+            logger.error('Cannot fetch the changes of {}'.format(directory))
+            return uids
+        for line in lines:
+            for start, end in RE_IMAP4_VANISHED.findall(line or ''):
+                start, end = sorted((int(start), int(end or start)))
+                uids.extend(range(start, end + 1))
+        return uids
+
+    async def noop(self):
+        if not self.connection:
+            return False
+        try:
+            ok, _ = await self.connection.command('NOOP')
+        except SESSION_ERRORS:
+            return False
+        return ok == 'OK'
+
+    async def mark_delete(self, email_id):
+        if self.connection and int(email_id) > 0:
+            await self._command('STORE', email_id, '+FLAGS', '\\Deleted')
+
+    async def delete(self, directory, email_ids, chunk_size=FETCH_CHUNK_SIZE):
+        # Like the imaplib connector, True when the folder still needs an EXPUNGE
+        if not self.connection or not email_ids:
+            return False
+        trash = await self.trash_target()
+        if trash == directory:
+            trash = None
+        expunge = not trash and self.use_uid and await self.has_capability('UIDPLUS')
+        await self.chdir(directory, readonly=False)
+        commands = []
+        for chunk in chunks(email_ids, chunk_size):
+            email_set = message_set(chunk)
+            if trash:
+                commands.append(self._command('MOVE', email_set, quote(trash)))
+                continue
+            commands.append(self._command('STORE', email_set, '+FLAGS.SILENT', '(\\Deleted)'))
+            if expunge:
+                commands.append(self._command('EXPUNGE', email_set))
+        await asyncio.gather(*commands)
+        return not trash and not expunge
+
+    async def do_delete(self):
+        if self.connection:
+            await self.connection.command('EXPUNGE')
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, unicode_literals
+
+import resource
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from email_backup.core.fakeimap import FakeIMAPServer
+from email_backup.core.models import Email, EmailAccount, EmailPath
+from email_backup.core.pipeline import close_parse_pool
+from email_backup.core.tasks import sync_account
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+class _QueryLog(deque):
+    # Only the number of queries is needed, the SQL is not kept
+    def __init__(self):
+        super(_QueryLog, self).__init__(maxlen=1)
+        self.count = 0
+
+    def append(self, query):
+        self.count += 1
+        super(_QueryLog, self).append(query)
+
+
+class QueryCounter(object):
+    # Counts the queries of every database connection, the sync workers open their own ones
+    def __init__(self):
+        self._connections = {}
+        self._logs = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        connection_created.connect(self._track)
+        for connection in connections.all():
+            self._track(None, connection)
+        return self
+
+    def __exit__(self, *args):
+        connection_created.disconnect(self._track)
+        for connection, force_debug_cursor, queries_log in self._connections.values():
+            connection.force_debug_cursor = force_debug_cursor
+            connection.queries_log = queries_log
+
+    def _track(self, sender, connection, **kwargs):
+        with self._lock:
+            if id(connection) not in self._connections:
+                self._connections[id(connection)] = (connection, connection.force_debug_cursor,
+                                                     connection.queries_log)
+                connection.force_debug_cursor = True
+                connection.queries_log = _QueryLog()
+                self._logs.append(connection.queries_log)
+
+    @property
+    def count(self):
+        return sum(log.count for log in self._logs)
+
+
+def _max_rss():
+    # Linux reports kilobytes, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class PeakMemory(object):
+    # tracemalloc gives the peak of the run but slows it down, the process peak RSS is used otherwise
+    def __init__(self, trace=False):
+        self.trace = trace and tracemalloc is not None
+        self.peak = None
+
+    def __enter__(self):
+        if self.trace:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.trace:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            self.peak = _max_rss()
+
+
+class BenchmarkResult(namedtuple('BenchmarkResult', 'messages emails seconds queries peak_memory commands')):
+    @property
+    def throughput(self):
+        return self.emails / self.seconds if self.seconds else 0
+
+    @property
+    def latency(self):
+        return self.seconds / self.emails if self.emails else 0
+
+
+def run_benchmark(mailboxes, latency=0, connections=1, compression='', just_read=False,
+                  trace_memory=False):
+    with FakeIMAPServer(mailboxes, latency=latency) as server:
+        account = EmailAccount.objects.create(
+            user='benchmark', password='benchmark', host=server.host, port=server.port, ssl=False,
+            sync=True, just_read=just_read, connections=connections, compression=compression
+        )
+        # New paths are skipped by the first sync
+        EmailPath.objects.bulk_create([EmailPath(account=account, path=mailbox.name) for mailbox in mailboxes])
+        server.commands.clear()
+
+        with QueryCounter() as queries, PeakMemory(trace_memory) as memory:
+            start = time.time()
+            sync_account(account.pk)
+            seconds = time.time() - start
+        # The sessions kept for the next syncs would outlive the server
+        account.connection_pool().close()
+        close_parse_pool()
+
+        return BenchmarkResult(
+            messages=sum(len(mailbox) for mailbox in mailboxes),
+            emails=Email.objects.filter(account=account).count(),
+            seconds=seconds,
+            queries=queries.count,
+            peak_memory=memory.peak,
+            commands=dict(server.commands)
+        )
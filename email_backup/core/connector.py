@@ -5,11 +5,21 @@ import base64
 import binascii
 import codecs
 import datetime
+import hashlib
 import imaplib
 import locale
 import logging
+import os
+import quopri
 import re
-from email.parser import Parser
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.feedparser import FeedParser
+from email.parser import HeaderParser, Parser
 from email.quoprimime import header_decode
 from email.utils import (
     parsedate_tz,
@@ -19,66 +29,588 @@ from email.utils import (
 )
 
 import six
+from django.conf import settings
+from six.moves import html_parser
+from six.moves.html_entities import name2codepoint
+
+from email_backup.core import metrics
 
 logger = logging.getLogger(__name__)
 
 RE_IMAP4_DIR_NAME = re.compile('"([\w/\[\] .-]+)"$', re.UNICODE)
+RE_IMAP4_DIR_FLAGS = re.compile('^\(([^)]*)\)')
+RE_IMAP4_FETCH_ID = re.compile('^(\d+) \(')
+RE_IMAP4_FETCH_UID = re.compile('UID (\d+)')
+RE_IMAP4_FETCH_SIZE = re.compile('RFC822\.SIZE (\d+)')
+RE_IMAP4_STATUS = re.compile('\(([\w ]*)\)$')
+RE_IMAP4_STATUS_ITEM = re.compile('(\w+) (\d+)')
+RE_IMAP4_VANISHED = re.compile('(\d+)(?::(\d+))?')
+RE_WHITESPACE = re.compile('\s+', re.UNICODE)
+RE_BLANK_LINES = re.compile('\n{3,}')
+
+FETCH_CHUNK_SIZE = 500
+LITERAL_SPOOL_SIZE = 256 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+SESSION_CACHE_SIZE = 8
+SESSION_KEEPALIVE = 240
+SESSION_MAX_IDLE = 2 * 3600
+
+SESSION_ERRORS = (imaplib.IMAP4.error, socket.error)
+# Characters of the text stored and indexed for each email, 0 keeps all of them
+CONTENT_MAX_LENGTH = 64 * 1024
+HTML_CHUNK_SIZE = 8 * 1024
+HTML_SKIP_TAGS = frozenset(('head', 'script', 'style', 'template', 'title'))
+HTML_BLOCK_TAGS = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer', 'form', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'
+))
+# Python 2 raises on some invalid documents
+HTML_PARSE_ERRORS = tuple(getattr(html_parser, name) for name in ('HTMLParseError',) if hasattr(html_parser, name))
 
 if not six.PY2:  # pragma: no cover
     unicode = str
 
+# imaplib only knows ENABLE (RFC 5161) since Python 3.5
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+
+
+def get_session_cache_size():
+    return getattr(settings, 'EMAIL_BACKUP_SESSION_CACHE_SIZE', SESSION_CACHE_SIZE)
+
+
+def get_session_keepalive():
+    return getattr(settings, 'EMAIL_BACKUP_SESSION_KEEPALIVE', SESSION_KEEPALIVE)
+
+
+def get_session_max_idle():
+    return getattr(settings, 'EMAIL_BACKUP_SESSION_MAX_IDLE', SESSION_MAX_IDLE)
+
+
+def get_content_max_length():
+    return getattr(settings, 'EMAIL_BACKUP_CONTENT_MAX_LENGTH', CONTENT_MAX_LENGTH)
+
+
+class HTMLText(html_parser.HTMLParser):
+    # Text of a HTML document, the blocks on their own lines
+    def __init__(self):
+        html_parser.HTMLParser.__init__(self)
+        self.parts = []
+        self.length = 0
+        self.skip = 0
+
+    def _append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIP_TAGS:
+            self.skip += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in HTML_SKIP_TAGS:
+            self.skip -= 1
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in HTML_BLOCK_TAGS and tag != 'br':
+            self._append('\n')
+
+    def handle_data(self, data):
+        if not self.skip:
+            self._append(RE_WHITESPACE.sub(' ', data))
+
+    # Python 2 does not convert the references before handle_data
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(six.unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        try:
+            self.handle_data(six.unichr(int(name[1:], 16) if name[:1] in 'xX' else int(name)))
+        except (ValueError, OverflowError):
+            pass
+
+    def text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.parts).split('\n'))
+        return RE_BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
 
-def get_email_content(email):
-    content = None
-    if email.is_multipart():
-        for e in email.get_payload():
-            content = get_email_content(e)
-            if content:
+def html_to_text(html, max_length=None):
+    parser = HTMLText()
+    try:
+        # Fed by chunks, the rest of the document is not parsed once the text is long enough
+        for position in range(0, len(html), HTML_CHUNK_SIZE):
+            parser.feed(html[position:position + HTML_CHUNK_SIZE])
+            if max_length and parser.length >= max_length:
                 break
-    elif email.get_content_maintype() == 'text':
-        enc = email.get('Content-Transfer-Encoding', '')
-        if 'base64' in enc:
-            content = base64.decodestring(six.b(email.get_payload()))
         else:
-            content = six.b(email.get_payload())
-    enc = email.get('Content-Type', '')
-    if enc:
-        find = re.findall('charset="([\w-]+)"', enc)
-        if find:
-            content = codecs.decode(content, find[0], 'strict')
-    return content
+            parser.close()
+    except HTML_PARSE_ERRORS:
+        logger.warning('Invalid HTML, only the text before the error is kept')
+    text = parser.text()
+    return text[:max_length] if max_length else text
+
+
+def decode_part(part):
+    # The transfer encoding and the charset of a leaf part
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ''
+    if isinstance(payload, six.text_type):  # pragma: no cover
+        return payload
+    charset = part.get_content_charset()
+    if charset:
+        try:
+            text = payload.decode(charset, 'replace')
+            if isinstance(text, six.text_type):
+                return text
+        except (LookupError, ValueError, TypeError):
+            pass
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return payload.decode('latin-1')
+
+
+def get_email_content(email, max_length=None):
+    # The first text/plain part, otherwise the first HTML part as text or any other text part
+    if max_length is None:
+        max_length = get_content_max_length()
+    if email is None:
+        return ''
+    html = other = None
+    for part in email.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text' or is_attachment(part):
+            continue
+        subtype = part.get_content_subtype()
+        if subtype == 'plain':
+            text = decode_part(part)
+            if text.strip():
+                return text[:max_length] if max_length else text
+        elif subtype == 'html':
+            html = html or part
+        else:
+            other = other or part
+    if html is not None:
+        return html_to_text(decode_part(html), max_length=max_length)
+    if other is not None:
+        text = decode_part(other)
+        return text[:max_length] if max_length else text
+    return ''
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def message_set(email_ids):
+    ranges = []
+    for email_id in sorted(set(int(i) for i in email_ids)):
+        if ranges and ranges[-1][1] + 1 == email_id:
+            ranges[-1][1] = email_id
+        else:
+            ranges.append([email_id, email_id])
+    return ','.join(
+        '{}'.format(first) if first == last else '{}:{}'.format(first, last)
+        for first, last in ranges
+    )
+
+
+def quote(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _fetch_item(regex, line):
+    find = regex.findall(_native(line))
+    return int(find[0]) if find else None
+
+
+def parse_fetch(data):
+    message = None
+    for item in data or []:
+        if isinstance(item, tuple) and len(item) == 2:
+            if message:
+                yield tuple(message)
+            message = None
+            line = _native(item[0])
+            match = RE_IMAP4_FETCH_ID.match(line)
+            if match:
+                message = [
+                    int(match.group(1)),
+                    _fetch_item(RE_IMAP4_FETCH_UID, line),
+                    _fetch_item(RE_IMAP4_FETCH_SIZE, line),
+                    item[1]
+                ]
+        elif message and isinstance(item, six.string_types + (six.binary_type,)):
+            # Servers may send the UID or the size after the message literal
+            if message[1] is None:
+                message[1] = _fetch_item(RE_IMAP4_FETCH_UID, item)
+            if message[2] is None:
+                message[2] = _fetch_item(RE_IMAP4_FETCH_SIZE, item)
+            yield tuple(message)
+            message = None
+    if message:
+        yield tuple(message)
+
+
+class RawMessage(object):
+    def __init__(self, max_size=SPOOL_SIZE):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.hash = hashlib.sha512()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.file.seek(0)
+        return iter(self.file)
+
+    @property
+    def digest(self):
+        return self.hash.hexdigest()
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+
+def _native(line):
+    if not six.PY2 and isinstance(line, bytes):  # pragma: no cover
+        return line.decode('latin-1')
+    return line
+
+
+def _find_boundary(boundaries, line):
+    delimiter = line.rstrip('\r\n')
+    if delimiter.startswith('--'):
+        for position in range(len(boundaries) - 1, -1, -1):
+            boundary = '--{}'.format(boundaries[position])
+            if delimiter == boundary:
+                return position, False
+            elif delimiter == '{}--'.format(boundary):
+                return position, True
+    return None, False
+
+
+def parse_text_parts(lines):
+    # Parse the message skipping the body of the non text parts
+    parser = FeedParser()
+    boundaries = []
+    headers = []
+    in_headers = True
+    skip = False
+    for line in lines:
+        line = _native(line)
+        if in_headers:
+            headers.append(line)
+            if line.strip():
+                continue
+            in_headers = False
+            part = HeaderParser().parsestr(''.join(headers))
+            parser.feed(''.join(headers))
+            headers = []
+            skip = False
+            if part.get_content_maintype() == 'multipart' and part.get_boundary():
+                boundaries.append(part.get_boundary())
+            elif part.get_content_maintype() == 'message':
+                in_headers = True
+            elif part.get_content_maintype() != 'text':
+                skip = True
+            continue
+
+        position, closing = _find_boundary(boundaries, line)
+        if position is not None:
+            del boundaries[position if closing else position + 1:]
+            in_headers = not closing
+            skip = False
+            parser.feed(line)
+        elif not skip:
+            parser.feed(line)
+    if headers:
+        parser.feed(''.join(headers))
+    return parser.close()
+
+
+def is_attachment(part):
+    if part.get_content_maintype() in ('multipart', 'message'):
+        return False
+    disposition = (part.get('Content-Disposition') or '').split(';')[0].strip().lower()
+    return disposition == 'attachment' or part.get_content_maintype() != 'text'
+
+
+def _raw_line(line):
+    if not six.PY2 and isinstance(line, str):  # pragma: no cover
+        return line.encode('latin-1')
+    return line
+
+
+class AttachmentDecoder(object):
+    def __init__(self, part):
+        self.filename = decode_subject(part.get_filename()) or ''
+        self.content_type = part.get_content_type()
+        self.encoding = (part.get('Content-Transfer-Encoding') or '').strip().lower()
+        self.content = RawMessage()
+        self._buffer = ''
+        self._line = None
+
+    def write(self, line):
+        if self.encoding == 'base64':
+            self._buffer += ''.join(line.split())
+            size = len(self._buffer) // 4 * 4
+            self._write_base64(self._buffer[:size])
+            self._buffer = self._buffer[size:]
+            return
+        # The line break before the boundary belongs to the boundary
+        if self._line is not None:
+            self._write_line(self._line)
+        self._line = line
+
+    def close(self):
+        if self._buffer:
+            self._write_base64(self._buffer + '=' * (-len(self._buffer) % 4))
+        if self._line is not None:
+            line = self._line
+            self._write_line(line[:-2] if line.endswith('\r\n') else line.rstrip('\n'))
+        self.content.seek(0)
+        return self.filename, self.content_type, self.content
+
+    def _write_base64(self, data):
+        try:
+            self.content.write(base64.b64decode(data))
+        except (binascii.Error, TypeError):
+            logger.warning('Invalid base64 on attachment {}'.format(self.filename))
+
+    def _write_line(self, line):
+        line = _raw_line(line)
+        if self.encoding == 'quoted-printable':
+            line = quopri.decodestring(line)
+        self.content.write(line)
+
+
+def iter_attachments(lines):
+    # Decode the attachments walking the message once, their content is spooled
+    boundaries = []
+    headers = []
+    in_headers = True
+    attachment = None
+    for line in lines:
+        line = _native(line)
+        if in_headers:
+            headers.append(line)
+            if line.strip():
+                continue
+            in_headers = False
+            part = HeaderParser().parsestr(''.join(headers))
+            headers = []
+            if part.get_content_maintype() == 'multipart' and part.get_boundary():
+                boundaries.append(part.get_boundary())
+            elif part.get_content_maintype() == 'message':
+                in_headers = True
+            elif is_attachment(part):
+                attachment = AttachmentDecoder(part)
+            continue
+
+        position, closing = _find_boundary(boundaries, line)
+        if position is not None:
+            if attachment:
+                yield attachment.close()
+                attachment = None
+            del boundaries[position if closing else position + 1:]
+            in_headers = not closing
+        elif attachment:
+            attachment.write(line)
+    if attachment:
+        yield attachment.close()
+
+
+def spool_literal(read, connection, size):
+    if size <= LITERAL_SPOOL_SIZE:
+        return read(connection, size)
+    message = RawMessage()
+    while size > 0:
+        data = read(connection, min(size, READ_CHUNK_SIZE))
+        if not data:
+            break
+        message.write(data)
+        size -= len(data)
+    message.seek(0)
+    return message
+
+
+class SpooledIMAP4(imaplib.IMAP4):
+    def read(self, size):
+        return spool_literal(imaplib.IMAP4.read, self, size)
+
+
+class SpooledIMAP4_SSL(imaplib.IMAP4_SSL):
+    def read(self, size):
+        return spool_literal(imaplib.IMAP4_SSL.read, self, size)
+
+
+def decode_subject(subject):
+    match = ecre.match(subject or '')
+    if match:
+        try:
+            subject_data = match.groupdict()
+            enc_subject = b''
+            if subject_data['encoding'] in ['q', 'Q']:
+                enc_subject = six.b(header_decode(subject_data['atom']))
+            elif subject_data['encoding'] in ['b', 'B']:
+                enc_subject = base64.decodestring(six.b(subject_data['atom']))
+            subject = codecs.decode(enc_subject, subject_data['charset'], 'strict')
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            logger.exception('Cannot decode {}'.format(subject))
+        except binascii.Error:
+            logger.exception('Cannot decode {}'.format(subject))
+    return subject
+
+
+def parse_date(date_str):
+    if date_str:
+        date_tuple = parsedate_tz(date_str)
+        if date_tuple:
+            return datetime.datetime.fromtimestamp(mktime_tz(date_tuple))
+    return None
+
+
+def _latin1(text):
+    if isinstance(text, six.text_type):
+        return text.encode('latin-1', 'replace')
+    return text
+
+
+def synthetic_message_id(msg):
+    # Stable id of the emails without Message-Id, the digest of the whole header is
+    # the same for the stored email and the header fetched to deduplicate it
+    lines = [_latin1(name).lower() + b': ' + b' '.join(_latin1(value).split()) for name, value in msg.items()]
+    if not lines:
+        return None
+    return '<{}@email_backup>'.format(hashlib.sha512(b'\n'.join(lines)).hexdigest())
+
+
+def parse_message_id(msg):
+    # The Message-Id of the header fields fetched, they are not enough for a synthetic one
+    return HeaderParser().parsestr(_native(msg or '')).get('Message-Id') or None
+
+
+class EmailHeader(object):
+    __slots__ = ('message_id', 'subject', 'send_by', 'date', 'size')
+
+    def __init__(self, message_id=None, subject=None, send_by=None, date=None, size=None):
+        self.message_id = message_id
+        self.subject = subject
+        self.send_by = send_by
+        self.date = date
+        self.size = size
+
+    @classmethod
+    def parse(cls, msg, size=None):
+        if msg is None or isinstance(msg, six.string_types + (six.binary_type,)):
+            msg = HeaderParser().parsestr(_native(msg or ''))
+        return cls(
+            message_id=msg.get('Message-Id') or synthetic_message_id(msg),
+            subject=decode_subject(msg.get('Subject')),
+            send_by=parseaddr(msg.get('from'))[1] or None,
+            date=parse_date(msg.get('date')),
+            size=size
+        )
+
+    def __repr__(self):
+        return '<EmailHeader {}>'.format(self.message_id)
 
 
 class Email(object):
-    def __init__(self, connector, server_id, directory):
-        assert isinstance(connector, EmailConnectorInterface)
+    def __init__(self, connector, server_id, directory, uid=None):
+        # Without connector the email must be fed, e.g. on the parse processes of the pipeline
+        assert connector is None or isinstance(connector, EmailConnectorInterface)
         self.id = server_id
+        self.uid = uid
         self.connector = connector
         self.directory = directory
-        self.email = None
+        self._email = None
+        self._unparsed = None
         self._header = False
         self._full = False
+        self._headers = None
         self.raw = None
+        self.size = None
 
     @property
     def server_id(self):
         return self.id
 
+    @property
+    def headers(self):
+        if self._headers is None:
+            self.load(True)
+            if self.email is None:
+                return EmailHeader(size=self.size)
+            self._headers = EmailHeader.parse(self.email, size=self.size)
+        return self._headers
+
     def load(self, only_header=False):
-        self.connector.chdir(self.directory)
-        msg = None
         if only_header:
             if not self._header:
-                msg = self.connector.header(self.id)
-            self._header = True
-        else:
-            if not self._full:
-                msg = self.connector.read(self.id)
-                self.raw = msg
-            self._header = True
+                self.connector.chdir(self.directory)
+                self.feed(self.connector.header(self.id), only_header=True)
+        elif not self._full:
+            self.connector.chdir(self.directory)
+            self.feed(self.connector.read(self.id))
+
+    def feed(self, msg, only_header=False, size=None):
+        if not only_header:
+            self.raw = msg
             self._full = True
-        if msg:
-            self.email = Parser().parsestr(msg)
+            if msg:
+                size = len(msg)
+        if size is not None:
+            self.size = size
+        self._header = True
+        self._headers = None
+        if isinstance(msg, RawMessage) or msg:
+            # Parsed on the first use, not by the thread fetching the emails
+            self._unparsed = (msg, only_header)
+
+    @property
+    def email(self):
+        if self._unparsed is not None:
+            msg, only_header = self._unparsed
+            self._unparsed = None
+            with metrics.timer('parse'):
+                if isinstance(msg, RawMessage):
+                    self._email = parse_text_parts(msg) if msg else None
+                else:
+                    parser = HeaderParser() if only_header else Parser()
+                    self._email = parser.parsestr(_native(msg))
+        return self._email
+
+    @email.setter
+    def email(self, email):
+        self._unparsed = None
+        self._email = email
 
     def __unicode__(self):
         return "[{}] {}".format(self.id, self.directory)
@@ -87,81 +619,102 @@ class Email(object):
         return "[{}] {}".format(self.id, self.directory)
 
     def date(self, default=None):
-        self.load(True)
-        if not self.email:
-            return default
-        read_date = default
-        date_str = self.email.get('date', None)
-        if date_str:
-            date_tuple = parsedate_tz(date_str)
-            if date_tuple:
-                read_date = datetime.datetime.fromtimestamp(mktime_tz(date_tuple))
-        return read_date
+        date = self.headers.date
+        return default if date is None else date
 
     def send_by(self, default=None):
-        self.load(True)
-        return parseaddr(self.email.get('from'))[1] or default
+        return self.headers.send_by or default
 
     def attaches(self):
         self.load()
-        if self.email.is_multipart():
-            return len(self.email.get_payload())
-        return 0
+        if self.email is None:
+            return 0
+        return sum(1 for part in self.email.walk() if is_attachment(part))
+
+    def attachments(self):
+        self.load()
+        if not self.raw:
+            return
+        raw = self.raw.encode('utf-8') if isinstance(self.raw, six.text_type) else self.raw
+        lines = raw if isinstance(raw, RawMessage) else six.BytesIO(raw)
+        for attachment in iter_attachments(lines):
+            yield attachment
+        if isinstance(self.raw, RawMessage):
+            self.raw.seek(0)
 
     def subject(self, default=None):
-        self.load(True)
-        subject = self.email.get('Subject', default)
-        match = ecre.match(subject)
-        if match:
-            try:
-                subject_data = match.groupdict()
-                enc_subject = b''
-                if subject_data['encoding'] in ['q', 'Q']:
-                    enc_subject = six.b(header_decode(subject_data['atom']))
-                elif subject_data['encoding'] in ['b', 'B']:
-                    enc_subject = base64.decodestring(six.b(subject_data['atom']))
-                subject = codecs.decode(enc_subject, subject_data['charset'], 'strict')
-            except (UnicodeDecodeError, UnicodeEncodeError):
-                logger.exception('Cannot decode {}'.format(subject))
-            except binascii.Error:
-                logger.exception('Cannot decode {}'.format(subject))
-        return subject
+        subject = self.headers.subject
+        return default if subject is None else subject
 
     def content(self):
         self.load()
         return get_email_content(self.email)
 
+    def fields(self):
+        # The searchable fields stored with the email
+        self.load()
+        headers = self.headers
+        return {
+            'message_id': headers.message_id,
+            'send_by': headers.send_by,
+            'date': headers.date,
+            'subject': headers.subject or '',
+            'content': self.content(),
+            'attaches': self.attaches(),
+        }
+
     def get(self, key, default=None):
-        self.load(True)
         if key.lower() == 'date':
             return self.date(default)
         elif key.lower() in ['from', 'send_by']:
             return self.send_by(default)
         elif key.lower() == 'subject':
             return self.subject(default)
+        elif key.lower() == 'message-id':
+            return self.headers.message_id or default
+        self.load(True)
         return self.email.get(key, default)
 
 
 class EmailConnectorInterface(object):
-    def __init__(self, host, port, ssl, user, password):
+    def __init__(self, host, port, ssl, user, password, use_uid=False, readonly=False):
         self.host = host
         self.port = port
         self.ssl = ssl
         self.user = user
         self.password = password
+        self.use_uid = use_uid
+        self.readonly = readonly
         self.connection = None
+        self._capabilities = None
+        self._qresync = False
+        self._trash = None
+        self._selected = None
+        self._selected_emails = 0
+
+    def _command(self, command, *args):
+        if self.use_uid:
+            return self.connection.uid(command, *args)
+        return getattr(self.connection, command.lower())(*args)
 
     def open(self):
         if self.ssl:
-            self.connection = imaplib.IMAP4_SSL(self.host, self.port)
+            self.connection = SpooledIMAP4_SSL(self.host, self.port)
         else:
-            self.connection = imaplib.IMAP4(self.host, self.port)
-        self.connection.login(self.user, self.password)
+            self.connection = SpooledIMAP4(self.host, self.port)
+        with metrics.timer('imap_login'):
+            self.connection.login(self.user, self.password)
+        # ENABLE is only valid before selecting a mailbox
+        if self.use_uid and self.has_capability('QRESYNC'):
+            ok, _ = self.connection._simple_command('ENABLE', 'QRESYNC')
+            self._qresync = ok == 'OK'
 
     def close(self):
         if self.connection:
             try:
-                self.connection.close()
+                # CLOSE expunges a read-write mailbox, also the emails flagged by other clients
+                if not self._selected or self._selected[1]:
+                    self.connection.close()
                 self.connection.logout()
             except imaplib.IMAP4.error:
                 pass  # Error because not login?
@@ -169,86 +722,464 @@ class EmailConnectorInterface(object):
                 sock = self.connection.socket()
                 sock.close()
         self.connection = None
+        self._capabilities = None
+        self._qresync = False
+        self._trash = None
+        self._selected = None
+
+    def has_capability(self, capability):
+        # The capabilities can change after the login, they are read once per session
+        if not self.connection:
+            return False
+        if self._capabilities is None:
+            ok, data = self.connection.capability()
+            self._capabilities = set(_native(data[-1] or '').upper().split()) if ok == 'OK' else set()
+        return capability.upper() in self._capabilities
+
+    def trash(self):
+        if self._trash is None and self.connection:
+            self._trash = ''
+            _, lines = self.connection.list()
+            for line in lines:
+                line = _native(line or '')
+                flags = RE_IMAP4_DIR_FLAGS.findall(line)
+                find = RE_IMAP4_DIR_NAME.findall(line)
+                if flags and find and '\\trash' in flags[0].lower().split():
+                    self._trash = find[0]
+                    break
+        return self._trash or None
+
+    def trash_target(self):
+        # The folder delete() moves the emails to, None when they are expunged
+        if self.use_uid and self.has_capability('MOVE'):
+            return self.trash()
+        return None
 
     def directories(self):
         directories = []
         if self.connection:
             _, lines = self.connection.list()
             for line in lines:
-                find = RE_IMAP4_DIR_NAME.findall(line)
+                find = RE_IMAP4_DIR_NAME.findall(_native(line or ''))
                 if find:
                     directories.append(find[0])
         return directories
 
     def get_emails(self, directory, before=None, just_read=False):
-        ids = []
-        if self.connection:
-            num_emails = self.chdir(directory)
-            ids = range(1, int(num_emails) + 1)
-            queries = []
-            if before:
-                before_date = None
-                if isinstance(before, (datetime.date, datetime.datetime)):
-                    before_date = before
-                elif isinstance(before, six.string_types):
-                    try:
-                        before_date = datetime.datetime.strptime(before, '%d-%b-%Y')
-                    except ValueError:
-                        pass
-                else:
-                    raise ValueError('Invalid before')
+        for i in self.search(directory, before=before, just_read=just_read):
+            yield Email(self, i, directory, uid=i if self.use_uid else None)
+
+    def status(self, directory):
+        status = {}
+        if self.connection and directory:
+            items = 'UIDVALIDITY UIDNEXT'
+            if self.has_capability('CONDSTORE') or self.has_capability('QRESYNC'):
+                items += ' HIGHESTMODSEQ'
+            ok, lines = self.connection.status(quote(directory), '({})'.format(items))
+            if ok == 'OK':
+                for line in lines:
+                    find = RE_IMAP4_STATUS.findall(_native(line or ''))
+                    if find:
+                        for key, value in RE_IMAP4_STATUS_ITEM.findall(find[0]):
+                            status[key.upper()] = int(value)
+        return status
+
+    def _search_criteria(self, num_emails, before=None, just_read=False, since_uid=None, invert=False):
+        ids = range(1, int(num_emails) + 1)
+        queries = []
+        if before:
+            before_date = None
+            if isinstance(before, (datetime.date, datetime.datetime)):
+                before_date = before
+            elif isinstance(before, six.string_types):
                 try:
-                    code, enc = locale.getlocale(locale.LC_TIME)
-                    if code == enc:  # Only code == enc is both are None
-                        code, enc = locale.getdefaultlocale()
-                    loc_code = '{}.{}'.format(code, enc)
-                    locale.setlocale(locale.LC_TIME, 'en_GB.UTF-8')
-                    if not before_date and isinstance(before, six.string_types):
-                        before_date = datetime.datetime.strptime(before, '%d-%b-%Y')
-                    queries.append('(before "{}")'.format(before_date.strftime('%d-%b-%Y')))
-                    locale.setlocale(locale.LC_TIME, loc_code)
-                except locale.Error:
+                    before_date = datetime.datetime.strptime(before, '%d-%b-%Y')
+                except ValueError:
                     pass
-            if just_read:
-                queries.append('(SEEN)')
+            else:
+                raise ValueError('Invalid before')
+            try:
+                code, enc = locale.getlocale(locale.LC_TIME)
+                if code == enc:  # Only code == enc is both are None
+                    code, enc = locale.getdefaultlocale()
+                loc_code = '{}.{}'.format(code, enc)
+                locale.setlocale(locale.LC_TIME, 'en_GB.UTF-8')
+                if not before_date and isinstance(before, six.string_types):
+                    before_date = datetime.datetime.strptime(before, '%d-%b-%Y')
+                queries.append('(before "{}")'.format(before_date.strftime('%d-%b-%Y')))
+                locale.setlocale(locale.LC_TIME, loc_code)
+            except locale.Error:
+                pass
+        if just_read:
+            queries.append('(SEEN)')
+        if invert:
+            ids = []
             if queries:
-                _, (ids_inline,) = self.connection.search(None, *queries)
-                ids = ids_inline.split()
-        for i in ids:
-            yield Email(self, i, directory)
+                queries = ['NOT ({})'.format(' '.join(queries))]
+        if since_uid and (queries or not invert):
+            queries.insert(0, '(UID {}:*)'.format(int(since_uid) + 1))
+        if self.use_uid:
+            # Sequence numbers are useless in UID mode, the server must be asked always
+            ids = []
+            if not queries and not invert and num_emails:
+                queries.append('ALL')
+        return ids, queries
+
+    def _search_result(self, ids_inline, since_uid=None):
+        ids = _native(ids_inline or '').split()
+        if self.use_uid and since_uid:
+            # "UID n:*" matches the last message even when its UID is lower than n
+            ids = [i for i in ids if int(i) > int(since_uid)]
+        return ids
+
+    def search(self, directory, before=None, just_read=False, since_uid=None, invert=False):
+        ids = []
+        if self.connection:
+            num_emails = self.chdir(directory, refresh=True)
+            ids, queries = self._search_criteria(num_emails, before, just_read, since_uid, invert)
+            if queries:
+                _, (ids_inline,) = self._command('SEARCH', None, *queries)
+                ids = self._search_result(ids_inline, since_uid)
+        return ids
+
+    def _fetch_chunks(self, directory, email_ids, query, chunk_size):
+        if not self.connection:
+            return
+        self.chdir(directory)
+        for chunk in chunks(email_ids, chunk_size):
+            with metrics.timer('imap_fetch'):
+                ok, data = self._command('FETCH', message_set(chunk), query)
+            if ok != 'OK':
+                logger.error('Cannot fetch {} from {}'.format(message_set(chunk), directory))
+                continue
+            for email_id, uid, size, msg in parse_fetch(data):
+                if self.use_uid:
+                    email_id = uid
+                metrics.inc('imap_fetched_messages')
+                metrics.inc('imap_fetched_bytes', len(msg or ''))
+                yield email_id, uid, size, msg
+
+    def fetch(self, directory, email_ids, only_header=False, chunk_size=FETCH_CHUNK_SIZE):
+        query = '(UID RFC822.SIZE BODY.PEEK[HEADER])' if only_header else '(UID RFC822)'
+        for email_id, uid, size, msg in self._fetch_chunks(directory, email_ids, query, chunk_size):
+            email = Email(self, email_id, directory, uid=uid)
+            email.feed(msg, only_header=only_header, size=size)
+            yield email
+
+    def message_ids(self, directory, email_ids, chunk_size=FETCH_CHUNK_SIZE):
+        query = '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+        missing = []
+        for email_id, _, _, msg in self._fetch_chunks(directory, email_ids, query, chunk_size):
+            message_id = parse_message_id(msg)
+            if message_id:
+                yield email_id, message_id
+            else:
+                missing.append(email_id)
+        # Only the emails without Message-Id need the whole header
+        query = '(UID BODY.PEEK[HEADER])'
+        for email_id, _, _, msg in self._fetch_chunks(directory, missing, query, chunk_size):
+            yield email_id, EmailHeader.parse(msg).message_id
 
     def read(self, email_id):
         msg = None
-        if self.connection and email_id > 0:
+        if self.connection and int(email_id) > 0:
             try:
-                _, ((_, msg), _) = self.connection.fetch(email_id, '(RFC822)')
+                _, ((_, msg), _) = self._command('FETCH', email_id, '(RFC822)')
             except ValueError:
                 pass
         return msg
 
     def header(self, email_id):
         msg = None
-        if self.connection and email_id > 0:
+        if self.connection and int(email_id) > 0:
             try:
-                _, ((_, msg), _) = self.connection.fetch(email_id, '(BODY.PEEK[HEADER])')
+                _, ((_, msg), _) = self._command('FETCH', email_id, '(BODY.PEEK[HEADER])')
             except ValueError:
                 pass
         return msg
 
-    def chdir(self, directory):
+    def get_uid(self, email_id):
+        if self.use_uid:
+            return int(email_id)
+        uid = None
+        if self.connection and int(email_id) > 0:
+            ok, lines = self.connection.fetch(email_id, '(UID)')
+            if ok == 'OK':
+                for line in lines:
+                    find = RE_IMAP4_FETCH_UID.findall(_native(line or ''))
+                    if find:
+                        uid = int(find[0])
+                        break
+        return uid
+
+    def chdir(self, directory, readonly=None, refresh=False):
+        # The selected mailbox is kept, EXAMINE is used unless the emails are modified
         num_emails = 0
         if self.connection and directory:
-            ok, (num_emails,) = self.connection.select(directory)
+            readonly = self.readonly if readonly is None else readonly
+            if not refresh and self._selected == (directory, readonly):
+                return self._selected_emails
+            self._selected = None
+            with metrics.timer('imap_select'):
+                ok, (num_emails,) = self.connection.select(quote(directory), readonly)
             if ok == 'OK':
                 num_emails = int(num_emails)
+                self._selected, self._selected_emails = (directory, readonly), num_emails
             else:
                 num_emails = 0
         return num_emails
 
+    def vanished(self, directory, modseq, last_uid):
+        # UIDs up to last_uid expunged since modseq, a single response with QRESYNC (RFC 7162)
+        uids = []
+        if not self.connection or not self._qresync or not modseq or not last_uid:
+            return uids
+        self.chdir(directory)
+        # Unsolicited VANISHED responses could be from other mailboxes
+        self.connection.response('VANISHED')
+        ok, _ = self.connection.uid('FETCH', '1:{}'.format(int(last_uid)), '(UID)',
+                                    '(CHANGEDSINCE {} VANISHED)'.format(int(modseq)))
+        _, lines = self.connection.response('VANISHED')
+        if ok != 'OK':
+            logger.error('Cannot fetch the changes of {}'.format(directory))
+            return uids
+        for line in lines:
+            for start, end in RE_IMAP4_VANISHED.findall(_native(line or '')):
+                start, end = sorted((int(start), int(end or start)))
+                uids.extend(range(start, end + 1))
+        return uids
+
+    def noop(self):
+        # Keeps the session alive, False when the server dropped it
+        if not self.connection:
+            return False
+        try:
+            ok, _ = self.connection.noop()
+        except SESSION_ERRORS:
+            return False
+        return ok == 'OK'
+
     def mark_delete(self, email_id):
-        if self.connection and email_id > 0:
-            self.connection.store(email_id, '+FLAGS', '\\Deleted')
+        if self.connection and int(email_id) > 0:
+            self._command('STORE', email_id, '+FLAGS', '\\Deleted')
+
+    def delete(self, directory, email_ids, chunk_size=FETCH_CHUNK_SIZE):
+        # One command per chunk, the emails are moved to the trash when the server allows it.
+        # True when the emails are only flagged and the folder still needs an EXPUNGE
+        if not self.connection or not email_ids:
+            return False
+        trash = self.trash_target()
+        if trash == directory:
+            trash = None
+        expunge = not trash and self.use_uid and self.has_capability('UIDPLUS')
+        self.chdir(directory, readonly=False)
+        for chunk in chunks(email_ids, chunk_size):
+            email_set = message_set(chunk)
+            if trash:
+                self.connection.uid('MOVE', email_set, quote(trash))
+                continue
+            self._command('STORE', email_set, '+FLAGS.SILENT', '(\\Deleted)')
+            if expunge:
+                self.connection.uid('EXPUNGE', email_set)
+        return not trash and not expunge
 
     def do_delete(self):
         if self.connection:
             self.connection.expunge()
+
+
+class ConnectionPool(object):
+    def __init__(self, factory, max_connections=1, on_release=None):
+        self.factory = factory
+        self.max_connections = max(int(max_connections), 1)
+        self.on_release = on_release
+        self._semaphore = threading.BoundedSemaphore(self.max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+        # When each idle session was released and when the server last answered it
+        self._seen = {}
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _checkout(self):
+        keepalive, max_idle = get_session_keepalive(), get_session_max_idle()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connector = self._idle.pop()
+                idle_since, alive_at = self._seen.pop(id(connector), (0, 0))
+            now = time.time()
+            if max_idle and now - idle_since > max_idle:
+                connector.close()
+            elif keepalive and now - alive_at >= keepalive and not connector.noop():
+                connector.close()
+            else:
+                return connector
+
+    def _release(self, connectors):
+        # connectors are (connector, idle since, alive at), the oldest first
+        extra = []
+        with self._lock:
+            self._idle[:0] = [connector for connector, _, _ in connectors]
+            for connector, idle_since, alive_at in connectors:
+                self._seen[id(connector)] = (idle_since, alive_at)
+            while len(self._idle) > self.max_connections:
+                connector = self._idle.pop(0)
+                self._seen.pop(id(connector), None)
+                extra.append(connector)
+        for connector in extra:
+            connector.close()
+
+    @contextmanager
+    def connection(self):
+        self._semaphore.acquire()
+        try:
+            connector = self._checkout()
+            if connector is None:
+                connector = self.factory()
+                try:
+                    connector.open()
+                except Exception:
+                    connector.close()
+                    raise
+            try:
+                yield connector
+            except SESSION_ERRORS:
+                connector.close()
+                connector = None
+                raise
+            except Exception:
+                # The error could leave a response halfway, the session must still answer
+                if not connector.noop():
+                    connector.close()
+                    connector = None
+                raise
+            finally:
+                if connector is not None:
+                    now = time.time()
+                    with self._lock:
+                        self._idle.append(connector)
+                        self._seen[id(connector)] = (now, now)
+        finally:
+            self._semaphore.release()
+        if self.on_release:
+            self.on_release()
+
+    def keepalive(self, interval, max_idle=None):
+        # Only the idle sessions, the ones in use already talk to the server
+        with self._lock:
+            idle, self._idle = self._idle, []
+            seen = [self._seen.pop(id(connector), (0, 0)) for connector in idle]
+        alive = []
+        for connector, (idle_since, alive_at) in zip(idle, seen):
+            now = time.time()
+            if max_idle and now - idle_since > max_idle:
+                connector.close()
+                continue
+            if now - alive_at >= interval:
+                if not connector.noop():
+                    connector.close()
+                    continue
+                alive_at = time.time()
+            alive.append((connector, idle_since, alive_at))
+        self._release(alive)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._seen.clear()
+        for connector in idle:
+            connector.close()
+
+
+class SessionCache(object):
+    # Authenticated sessions of the worker process, reused by the next tasks of the same account
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = OrderedDict()
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _check_process(self):
+        # A forked worker cannot share the sockets of its parent, they are forgotten without LOGOUT
+        if self._pid != os.getpid():
+            self._pools = OrderedDict()
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = None
+
+    def _start_keepalive(self):
+        if self._thread is None and get_session_keepalive():
+            self._thread = threading.Thread(target=self._keepalive_loop, args=(self._stop,),
+                                            name='email_backup-keepalive')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _keepalive_loop(self, stop):
+        while not stop.wait(get_session_keepalive() or SESSION_KEEPALIVE):
+            try:
+                self.keepalive()
+            except Exception:
+                logger.exception('Cannot keep the IMAP sessions alive')
+
+    def pool(self, key, factory, max_connections=1):
+        max_connections = max(int(max_connections), 1)
+        stale = None
+        with self._lock:
+            self._check_process()
+            pool = self._pools.pop(key, None)
+            if pool is not None and pool.max_connections != max_connections:
+                stale, pool = pool, None
+            if pool is None:
+                pool = ConnectionPool(factory, max_connections, on_release=self.evict)
+            pool.factory = factory
+            # The most recently used pools are at the end
+            self._pools[key] = pool
+            self._start_keepalive()
+        if stale is not None:
+            stale.close()
+        return pool
+
+    def evict(self, size=None):
+        # The idle sessions of the least recently used pools are closed first
+        size = get_session_cache_size() if size is None else size
+        with self._lock:
+            pools = list(self._pools.values())
+        idle = sum(pool.idle for pool in pools)
+        for pool in pools:
+            if idle <= size:
+                break
+            idle -= pool.idle
+            pool.close()
+
+    def keepalive(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.keepalive(get_session_keepalive(), get_session_max_idle())
+        self.evict()
+
+    def close(self):
+        with self._lock:
+            self._check_process()
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+            self._stop.set()
+            self._stop = threading.Event()
+            self._thread = None
+        for pool in pools:
+            pool.close()
+
+
+sessions = SessionCache()
+
+
+def get_connection_pool(key, factory, max_connections=1):
+    return sessions.pool(key, factory, max_connections)
+
+
+def close_sessions():
+    sessions.close()
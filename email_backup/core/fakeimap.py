@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+# In-process IMAP4rev1 stand-in with synthetic mailboxes, it only knows the
+# commands used by the connectors
+from __future__ import unicode_literals
+
+import base64
+import datetime
+import hashlib
+import math
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from email.utils import formatdate
+
+from six.moves import socketserver
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+CAPABILITIES = ('IMAP4rev1', 'UIDPLUS', 'MOVE', 'SPECIAL-USE')
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip'
+).split()
+
+RE_COMMAND = re.compile(r'^(?P<tag>[^ ]+) (?P<command>[A-Za-z]+)(?: (?P<args>.*))?$')
+
+
+class FakeMessage(object):
+    def __init__(self, uid, raw, date, flags=()):
+        self.uid = uid
+        self.raw = raw
+        self.date = date
+        self.flags = set(flags)
+
+    @property
+    def header(self):
+        return self.raw.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+
+    def header_fields(self, names):
+        names = set(name.lower() for name in names)
+        lines, keep = [], False
+        for line in self.header.split(b'\r\n'):
+            if line[:1] not in (b' ', b'\t'):
+                keep = line.split(b':', 1)[0].decode('latin-1').lower() in names
+            if keep and line:
+                lines.append(line + b'\r\n')
+        return b''.join(lines) + b'\r\n'
+
+
+class FakeMailbox(object):
+    def __init__(self, name, uid_validity=1, special_use=None):
+        self.name = name
+        self.uid_validity = uid_validity
+        self.special_use = special_use
+        self.messages = []
+        self.uid_next = 1
+
+    def append(self, raw, date, flags=()):
+        message = FakeMessage(self.uid_next, raw, date, flags)
+        self.messages.append(message)
+        self.uid_next += 1
+        return message
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def tokens(text):
+    # Atoms, quoted strings and parenthesized lists, brackets belong to the atoms
+    stack, atom, quoted, brackets = [[]], None, False, 0
+    chars = iter(text)
+    for char in chars:
+        if quoted:
+            if char == '"':
+                stack[-1].append(atom)
+                atom, quoted = None, False
+            else:
+                atom += next(chars) if char == '\\' else char
+        elif brackets or char not in ' ()"':
+            brackets += {'[': 1, ']': -1}.get(char, 0)
+            atom = (atom or '') + char
+        elif char == '"':
+            atom, quoted = '', True
+        else:
+            if atom is not None:
+                stack[-1].append(atom)
+                atom = None
+            if char == '(':
+                stack.append([])
+            elif char == ')' and len(stack) > 1:
+                group = stack.pop()
+                stack[-1].append(group)
+    if atom is not None:
+        stack[-1].append(atom)
+    return stack[0]
+
+
+def parse_date(text):
+    day, month, year = text.split('-')
+    return datetime.date(int(year), MONTHS.index(month.capitalize()) + 1, int(day))
+
+
+def select_messages(messages, text, uid=False):
+    last = (messages[-1].uid if uid else len(messages)) if messages else 0
+    ranges = []
+    for item in text.split(','):
+        first, _, second = item.partition(':')
+        first = last if first == '*' else int(first)
+        second = first if not second else (last if second == '*' else int(second))
+        ranges.append((min(first, second), max(first, second)))
+    selected = [(seq, message) for seq, message in enumerate(messages, 1)
+                if any(first <= (message.uid if uid else seq) <= second for first, second in ranges)]
+    if uid and not selected and messages and any(second >= last for _, second in ranges):
+        # "n:*" always matches the last message
+        selected.append((len(messages), messages[-1]))
+    return selected
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.selected = None
+        self.readonly = False
+        self.uid = False
+
+    def send(self, data):
+        if isinstance(data, bytes):
+            self.wfile.write(data)
+        else:
+            self.wfile.write(data.encode('utf-8') + b'\r\n')
+
+    def handle(self):
+        self.send('* OK Fake IMAP4rev1 ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            match = RE_COMMAND.match(line.rstrip(b'\r\n').decode('utf-8'))
+            if not match:
+                self.send('* BAD Invalid command')
+                continue
+            tag, command, args = match.group('tag'), match.group('command').upper(), match.group('args') or ''
+            self.uid = command == 'UID'
+            if self.uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+            self.server.record(command)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            method = getattr(self, 'do_{}'.format(command), None)
+            if method is None:
+                self.send('{} BAD Unknown command {}'.format(tag, command))
+                continue
+            try:
+                status = method(tokens(args))
+            except (IndexError, KeyError, ValueError) as error:
+                status = 'BAD {}'.format(error)
+            self.send('{} {}'.format(tag, status or 'OK {} completed'.format(command)))
+            self.wfile.flush()
+            if command == 'LOGOUT':
+                return
+
+    def mailbox(self, name):
+        return self.server.mailboxes.get(name)
+
+    def do_CAPABILITY(self, args):
+        self.send('* CAPABILITY {}'.format(' '.join(self.server.capabilities)))
+
+    def do_LOGIN(self, args):
+        pass
+
+    def do_NOOP(self, args):
+        pass
+
+    def do_LOGOUT(self, args):
+        self.send('* BYE Logging out')
+
+    def do_LIST(self, args):
+        for mailbox in self.server.mailboxes.values():
+            flags = ' '.join(flag for flag in ('\\HasNoChildren', mailbox.special_use) if flag)
+            self.send('* LIST ({}) "/" "{}"'.format(flags, mailbox.name))
+
+    def do_STATUS(self, args):
+        mailbox = self.mailbox(args[0])
+        if mailbox is None:
+            return 'NO Mailbox does not exist'
+        self.send('* STATUS "{}" (UIDVALIDITY {} UIDNEXT {})'.format(
+            mailbox.name, mailbox.uid_validity, mailbox.uid_next))
+
+    def do_SELECT(self, args, readonly=False):
+        mailbox = self.mailbox(args[0])
+        self.selected = mailbox
+        if mailbox is None:
+            return 'NO Mailbox does not exist'
+        self.readonly = readonly
+        self.send('* {} EXISTS'.format(len(mailbox)))
+        self.send('* 0 RECENT')
+        self.send('* OK [UIDVALIDITY {}] UIDs valid'.format(mailbox.uid_validity))
+        self.send('* OK [UIDNEXT {}] Predicted next UID'.format(mailbox.uid_next))
+        return 'OK [{}] Done'.format('READ-ONLY' if readonly else 'READ-WRITE')
+
+    def do_EXAMINE(self, args):
+        return self.do_SELECT(args, readonly=True)
+
+    def do_CLOSE(self, args):
+        if self.selected is not None and not self.readonly:
+            self._expunge()
+        self.selected = None
+
+    def _search_key(self, args):
+        key = args.pop(0)
+        if isinstance(key, list):
+            keys = []
+            while key:
+                keys.append(self._search_key(key))
+            return lambda seq, message: all(match(seq, message) for match in keys)
+        key = key.upper()
+        if key == 'ALL':
+            return lambda seq, message: True
+        if key in ('SEEN', 'DELETED'):
+            flag = '\\' + key.capitalize()
+            return lambda seq, message: flag in message.flags
+        if key in ('UNSEEN', 'UNDELETED'):
+            flag = '\\' + key[2:].capitalize()
+            return lambda seq, message: flag not in message.flags
+        if key in ('BEFORE', 'SINCE'):
+            date = parse_date(args.pop(0))
+            if key == 'BEFORE':
+                return lambda seq, message: message.date.date() < date
+            return lambda seq, message: message.date.date() >= date
+        if key == 'NOT':
+            match = self._search_key(args)
+            return lambda seq, message: not match(seq, message)
+        if key == 'OR':
+            first, second = self._search_key(args), self._search_key(args)
+            return lambda seq, message: first(seq, message) or second(seq, message)
+        uid = key == 'UID'
+        selected = set(message.uid for _, message in
+                       select_messages(self.selected.messages, args.pop(0) if uid else key, uid=uid))
+        return lambda seq, message: message.uid in selected
+
+    def do_SEARCH(self, args):
+        if args and not isinstance(args[0], list) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        match = self._search_key([args])
+        found = [message.uid if self.uid else seq for seq, message in enumerate(self.selected.messages, 1)
+                 if match(seq, message)]
+        self.send('* SEARCH {}'.format(' '.join(str(i) for i in found)).rstrip())
+
+    def _fetch_item(self, item, message):
+        name = item.upper()
+        if name == 'UID':
+            return 'UID {}'.format(message.uid).encode('ascii')
+        if name == 'FLAGS':
+            return 'FLAGS ({})'.format(' '.join(sorted(message.flags))).encode('ascii')
+        if name == 'RFC822.SIZE':
+            return 'RFC822.SIZE {}'.format(len(message.raw)).encode('ascii')
+        if name in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+            response, data = 'RFC822' if name == 'RFC822' else 'BODY[]', message.raw
+        elif name in ('RFC822.HEADER', 'BODY[HEADER]', 'BODY.PEEK[HEADER]'):
+            response, data = name.replace('.PEEK', ''), message.header
+        elif name.startswith('BODY.PEEK[HEADER.FIELDS') or name.startswith('BODY[HEADER.FIELDS'):
+            response = item.replace('.PEEK', '').replace('.peek', '')
+            data = message.header_fields(name[name.index('(') + 1:name.index(')')].split())
+        else:
+            raise ValueError('Unknown fetch item {}'.format(item))
+        if not name.startswith('BODY.PEEK') and not self.readonly:
+            message.flags.add('\\Seen')
+        return '{} {{{}}}\r\n'.format(response, len(data)).encode('ascii') + data
+
+    def do_FETCH(self, args):
+        items = args[1] if isinstance(args[1], list) else args[1:]
+        if self.uid and 'UID' not in [item.upper() for item in items]:
+            items = ['UID'] + items
+        fetched = 0
+        for seq, message in select_messages(self.selected.messages, args[0], uid=self.uid):
+            data = b' '.join(self._fetch_item(item, message) for item in items)
+            self.send('* {} FETCH ('.format(seq).encode('ascii') + data + b')\r\n')
+            fetched += 1
+        self.server.record('FETCH messages', fetched)
+
+    def do_STORE(self, args):
+        if self.readonly:
+            return 'NO Mailbox is read-only'
+        action = args[1].upper()
+        flags = set(args[2] if isinstance(args[2], list) else args[2:])
+        for seq, message in select_messages(self.selected.messages, args[0], uid=self.uid):
+            if action.startswith('+'):
+                message.flags |= flags
+            elif action.startswith('-'):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            if not action.endswith('.SILENT'):
+                self.send('* {} FETCH (FLAGS ({}) UID {})'.format(seq, ' '.join(sorted(message.flags)), message.uid))
+
+    def _expunge(self, uids=None):
+        with self.server.lock:
+            messages = self.selected.messages
+            for seq in range(len(messages), 0, -1):
+                message = messages[seq - 1]
+                if '\\Deleted' in message.flags and (uids is None or message.uid in uids):
+                    del messages[seq - 1]
+                    self.send('* {} EXPUNGE'.format(seq))
+
+    def do_EXPUNGE(self, args):
+        if self.readonly:
+            return 'NO Mailbox is read-only'
+        uids = None
+        if self.uid:
+            uids = set(message.uid for _, message in select_messages(self.selected.messages, args[0], uid=True))
+        self._expunge(uids)
+
+    def do_MOVE(self, args):
+        target = self.mailbox(args[1])
+        if target is None:
+            return 'NO [TRYCREATE] Mailbox does not exist'
+        with self.server.lock:
+            moved = select_messages(self.selected.messages, args[0], uid=self.uid)
+            for seq, message in reversed(moved):
+                target.append(message.raw, message.date, message.flags)
+                del self.selected.messages[seq - 1]
+                self.send('* {} EXPUNGE'.format(seq))
+
+
+class FakeIMAPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailboxes, latency=0, capabilities=CAPABILITIES, address=('127.0.0.1', 0)):
+        socketserver.TCPServer.__init__(self, address, FakeIMAPHandler)
+        self.mailboxes = OrderedDict((mailbox.name, mailbox) for mailbox in mailboxes)
+        self.latency = latency
+        self.capabilities = capabilities
+        self.lock = threading.Lock()
+        self.commands = defaultdict(int)
+        self._thread = None
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, command, count=1):
+        with self.lock:
+            self.commands[command] += count
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def random_bytes(rng, size):
+    # Deterministic and incompressible like real attachments
+    seed = repr(rng.random()).encode('ascii')
+    blocks = [hashlib.sha512(seed + str(i).encode('ascii')).digest() for i in range(size // 64 + 1)]
+    return b''.join(blocks)[:size]
+
+
+def synthetic_email(rng, number, date, size, attachment_size=0):
+    words = []
+    length = 0
+    while length < size:
+        # Not rng.choice(), it picks different items on python 2 and 3
+        word = WORDS[int(rng.random() * len(WORDS))]
+        words.append(word)
+        length += len(word) + 1
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    headers = [
+        'Message-ID: <{}.benchmark@email.test>'.format(number),
+        'Date: {}'.format(formatdate(time.mktime(date.timetuple()))),
+        'From: Sender {0} <sender{0}@email.test>'.format(number % 97),
+        'To: user@email.test',
+        'Subject: Benchmark email {} {}'.format(number, ' '.join(words[:5])),
+        'MIME-Version: 1.0',
+    ]
+    if not attachment_size:
+        headers.append('Content-Type: text/plain; charset="utf-8"')
+        return '\r\n'.join(headers + [''] + lines).encode('utf-8') + b'\r\n'
+    boundary = '==benchmark{}=='.format(number)
+    encoded = base64.b64encode(random_bytes(rng, attachment_size)).decode('ascii')
+    headers.append('Content-Type: multipart/mixed; boundary="{}"'.format(boundary))
+    body = [
+        '--{}'.format(boundary), 'Content-Type: text/plain; charset="utf-8"', ''] + lines + [
+        '--{}'.format(boundary), 'Content-Type: application/octet-stream',
+        'Content-Disposition: attachment; filename="file{}.bin"'.format(number),
+        'Content-Transfer-Encoding: base64', ''] + [
+        encoded[i:i + 76] for i in range(0, len(encoded), 76)] + [
+        '--{}--'.format(boundary)]
+    return '\r\n'.join(headers + [''] + body).encode('utf-8') + b'\r\n'
+
+
+def lognormal_size(rng, mean):
+    # Email sizes have a long tail, sigma 1 keeps the given mean
+    return max(int(rng.lognormvariate(math.log(mean) - 0.5, 1.0)), 1)
+
+
+def generate_mailboxes(emails=1000, folders=3, size=4096, attachments=0.1, attachment_size=64 * 1024,
+                       seen=1.0, days=365, seed=0, trash=True, now=None):
+    rng = random.Random(seed)
+    now = now or datetime.datetime.now()
+    mailboxes = [FakeMailbox('INBOX')] + [FakeMailbox('Folder {}'.format(i)) for i in range(1, folders)]
+    # The first folders get most of the emails like real accounts
+    weights = [1.0 / (i + 1) for i in range(len(mailboxes))]
+    dates = sorted(now - datetime.timedelta(days=1 + rng.random() * days) for _ in range(emails))
+    for number, date in enumerate(dates):
+        mailbox = mailboxes[_weighted_index(rng, weights)]
+        attachment = lognormal_size(rng, attachment_size) if rng.random() < attachments else 0
+        raw = synthetic_email(rng, number, date, lognormal_size(rng, size), attachment)
+        mailbox.append(raw, date, ['\\Seen'] if rng.random() < seen else [])
+    if trash:
+        mailboxes.append(FakeMailbox('Trash', special_use='\\Trash'))
+    return mailboxes
+
+
+def _weighted_index(rng, weights):
+    point = rng.random() * sum(weights)
+    for index, weight in enumerate(weights):
+        point -= weight
+        if point < 0:
+            return index
+    return len(weights) - 1
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Python 3.5+ only, IMAP IDLE sessions enqueueing the sync of the INBOX when emails arrive
+import asyncio
+import imaplib
+import logging
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from email_backup.core.aioconnector import AsyncEmailConnector
+from email_backup.core.models import EmailAccount
+from email_backup.core.tasks import sync_account
+
+logger = logging.getLogger(__name__)
+
+IDLE_DIRECTORY = 'INBOX'
+# RFC 2177, the servers can log out the clients idle for 30 minutes
+IDLE_TIMEOUT = 25 * 60
+IDLE_RETRY = 60
+IDLE_DEBOUNCE = 10
+IDLE_REFRESH = 300
+CLOSE_TIMEOUT = 10
+
+
+def get_idle_timeout():
+    return getattr(settings, 'EMAIL_BACKUP_IDLE_TIMEOUT', IDLE_TIMEOUT)
+
+
+def get_idle_retry():
+    return getattr(settings, 'EMAIL_BACKUP_IDLE_RETRY', IDLE_RETRY)
+
+
+def get_idle_debounce():
+    return getattr(settings, 'EMAIL_BACKUP_IDLE_DEBOUNCE', IDLE_DEBOUNCE)
+
+
+def get_idle_refresh():
+    return getattr(settings, 'EMAIL_BACKUP_IDLE_REFRESH', IDLE_REFRESH)
+
+
+def enqueue_sync(account_pk, directory):
+    # The task takes the account lease, it is retried while another sync of the account runs.
+    # Only one sync waits in the queue, it also stores the emails arriving until it starts
+    close_old_connections()
+    if EmailAccount.objects.filter(pk=account_pk).queue_sync():
+        sync_account.apply_async(args=[account_pk, directory])
+
+
+def account_key(account):
+    # A listener is restarted when the account connects in other way
+    return account.host, account.port, account.ssl, account.user, account.password
+
+
+class AccountListener(object):
+    def __init__(self, account, enqueue=enqueue_sync, directory=IDLE_DIRECTORY, loop=None):
+        self.account = account
+        self.enqueue = enqueue
+        self.directory = directory
+        self.loop = loop or asyncio.get_event_loop()
+        self.connector = None
+        self.exists = None
+
+    async def run(self):
+        # Reconnects after the errors until it is cancelled
+        while True:
+            try:
+                await self.listen()
+                return
+            except (imaplib.IMAP4.error, OSError, EOFError) as error:
+                logger.warning('IDLE on {} failed: {!r}'.format(self.account, error))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('IDLE on {} failed'.format(self.account))
+            finally:
+                await self.close()
+            await asyncio.sleep(get_idle_retry())
+
+    async def listen(self):
+        account = self.account
+        self.connector = AsyncEmailConnector(account.host, account.port, account.ssl, account.user,
+                                             account.password, use_uid=True, readonly=True, loop=self.loop)
+        await self.connector.open()
+        if not await self.connector.has_capability('IDLE'):
+            logger.warning('{} does not support IDLE, {} is only synced by the schedule'.format(
+                account.host, account))
+            return
+        exists = await self.connector.chdir(self.directory, readonly=True)
+        if self.exists is not None and exists != self.exists:
+            # Emails arrived while the session was down
+            await self.changed()
+        self.exists = exists
+        while True:
+            counts = await self.connector.idle(self.directory, timeout=get_idle_timeout())
+            if counts:
+                self.exists = counts[-1]
+                await self.changed()
+
+    async def changed(self):
+        await self.loop.run_in_executor(None, self.enqueue, self.account.pk, self.directory)
+        # The emails arriving together are synced by the same task
+        await asyncio.sleep(get_idle_debounce())
+
+    async def close(self):
+        connector, self.connector = self.connector, None
+        if connector is None or connector.connection is None:
+            return
+        try:
+            await asyncio.wait_for(connector.close(), CLOSE_TIMEOUT)
+        except (imaplib.IMAP4.error, OSError, EOFError, asyncio.TimeoutError):
+            pass
+
+
+class IdleListener(object):
+    # One IDLE session per synced account, all of them on the same event loop
+    def __init__(self, enqueue=enqueue_sync, loop=None):
+        self.enqueue = enqueue
+        self.loop = loop or asyncio.get_event_loop()
+        self.listeners = {}
+
+    def accounts(self):
+        close_old_connections()
+        return list(EmailAccount.objects.filter(sync=True))
+
+    async def refresh(self):
+        accounts = await self.loop.run_in_executor(None, self.accounts)
+        keys = dict((account.pk, account_key(account)) for account in accounts)
+        for pk, (key, task) in list(self.listeners.items()):
+            if keys.get(pk) != key:
+                task.cancel()
+                del self.listeners[pk]
+        for account in accounts:
+            if account.pk not in self.listeners:
+                listener = AccountListener(account, enqueue=self.enqueue, loop=self.loop)
+                self.listeners[account.pk] = (account_key(account), self.loop.create_task(listener.run()))
+
+    async def run(self):
+        try:
+            while True:
+                await self.refresh()
+                await asyncio.sleep(get_idle_refresh())
+        finally:
+            tasks = [task for _, task in self.listeners.values()]
+            self.listeners = {}
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
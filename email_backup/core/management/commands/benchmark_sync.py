@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from email_backup.core.benchmark import run_benchmark
+from email_backup.core.fakeimap import generate_mailboxes
+
+
+class Command(BaseCommand):
+    help = "Measures sync_account against a local fake IMAP server with synthetic mailboxes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--emails', type=int, default=1000, help="Number of emails")
+        parser.add_argument('--folders', type=int, default=3, help="Number of folders")
+        parser.add_argument('--size', type=int, default=4096, help="Mean size of the email text")
+        parser.add_argument('--attachments', type=float, default=0.1,
+                            help="Ratio of emails with an attachment")
+        parser.add_argument('--attachment-size', type=int, default=64 * 1024,
+                            help="Mean size of the attachments")
+        parser.add_argument('--latency', type=float, default=0,
+                            help="Milliseconds the server waits before each response")
+        parser.add_argument('--connections', type=int, default=1, help="Connections of the account")
+        parser.add_argument('--compression', default='', help="Compression of the raw emails")
+        parser.add_argument('--parse-processes', type=int, default=0,
+                            help="Processes parsing the emails, 0 parses them on the sync thread")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic mailboxes")
+        parser.add_argument('--trace-memory', action='store_true',
+                            help="Measure the peak with tracemalloc, slower but only counts the sync")
+
+    def handle(self, *args, **options):
+        mailboxes = generate_mailboxes(
+            emails=options['emails'], folders=options['folders'], size=options['size'],
+            attachments=options['attachments'], attachment_size=options['attachment_size'],
+            seed=options['seed']
+        )
+        # The emails are stored on a throwaway database and media folder, the
+        # time limit is disabled so the sync is never handed to celery
+        tmp = tempfile.mkdtemp(prefix='email_backup_benchmark')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(tmp, 'media'), EMAIL_BACKUP_SYNC_TIME_LIMIT=0,
+                                   EMAIL_BACKUP_PARSE_PROCESSES=options['parse_processes']):
+                result = run_benchmark(
+                    mailboxes, latency=options['latency'] / 1000, connections=options['connections'],
+                    compression=options['compression'], trace_memory=options['trace_memory']
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.stdout.write('Messages:     {}'.format(result.messages))
+        self.stdout.write('Stored:       {}'.format(result.emails))
+        self.stdout.write('Time:         {:.3f} s'.format(result.seconds))
+        self.stdout.write('Throughput:   {:.1f} messages/s'.format(result.throughput))
+        self.stdout.write('Latency:      {:.2f} ms/message'.format(result.latency * 1000))
+        self.stdout.write('SQL queries:  {}'.format(result.queries))
+        self.stdout.write('Peak memory:  {:.1f} MiB'.format(result.peak_memory / 1024 / 1024))
+        self.stdout.write('IMAP commands:')
+        for command, count in sorted(result.commands.items()):
+            self.stdout.write('  {:<16} {}'.format(command, count))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import signal
+
+import six
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Keeps IMAP IDLE sessions on the INBOX of the synced accounts and syncs it when emails arrive"
+
+    def handle(self, *args, **options):
+        if six.PY2:
+            raise CommandError("The IDLE listener requires Python 3.5+")
+        import asyncio
+        from email_backup.core.listener import IdleListener
+
+        loop = asyncio.get_event_loop()
+        task = loop.create_task(IdleListener(loop=loop).run())
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, task.cancel)
+        self.stdout.write('Listening the IMAP accounts, press Ctrl+C to stop')
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, unicode_literals
+
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'email_backup_'
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+METRICS_SINKS = ()
+METRICS_PATH = os.path.join(tempfile.gettempdir(), 'email_backup.{pid}.prom')
+
+
+def get_metrics_sinks():
+    return getattr(settings, 'EMAIL_BACKUP_METRICS_SINKS', METRICS_SINKS)
+
+
+def get_metrics_path():
+    return getattr(settings, 'EMAIL_BACKUP_METRICS_PATH', METRICS_PATH)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels))
+
+
+class Registry(object):
+    # The metrics are kept per name and labels, the sync workers share the registry
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = Histogram()
+            histogram.observe(value)
+
+    def merge(self, other):
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other_histogram in other.histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(other_histogram.buckets)
+                histogram.merge(other_histogram)
+
+    def snapshot(self):
+        groups = OrderedDict()
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                groups.setdefault(labels, {'counters': {}, 'timers': {}})['counters'][name] = value
+            for (name, labels), histogram in self.histograms.items():
+                groups.setdefault(labels, {'counters': {}, 'timers': {}})['timers'][name] = {
+                    'count': histogram.count, 'sum': histogram.sum
+                }
+        return [dict(group, labels=dict(labels)) for labels, group in groups.items()]
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            names = OrderedDict()
+            for name, labels in self.counters:
+                names.setdefault((name, 'counter'), []).append(labels)
+            for name, labels in self.histograms:
+                names.setdefault((name, 'histogram'), []).append(labels)
+            for (name, kind), labels_list in names.items():
+                if kind == 'counter':
+                    metric = '{}{}_total'.format(PREFIX, name)
+                    lines.append('# TYPE {} counter'.format(metric))
+                    for labels in labels_list:
+                        lines.append('{}{} {}'.format(metric, _labels(labels), self.counters[name, labels]))
+                    continue
+                metric = '{}{}'.format(PREFIX, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                for labels in labels_list:
+                    histogram = self.histograms[name, labels]
+                    cumulative = 0
+                    for bucket, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(metric, _labels(labels, le=bucket), cumulative))
+                    lines.append('{}_sum{} {}'.format(metric, _labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(metric, _labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+_local = threading.local()
+
+
+def _active():
+    return getattr(_local, 'active', None)
+
+
+@contextmanager
+def collect(registry=None, **labels):
+    # The metrics recorded by the thread go to the registry with the labels
+    previous = _active()
+    registry = registry or Registry()
+    _local.active = (registry, tuple(sorted((key, '{}'.format(value)) for key, value in labels.items())))
+    try:
+        yield registry
+    finally:
+        _local.active = previous
+
+
+def bind(func):
+    # Keeps the collection of the thread on the functions run by other threads
+    active = _active()
+
+    def wrapper(*args, **kwargs):
+        previous = _active()
+        _local.active = active
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.active = previous
+    return wrapper
+
+
+def inc(name, value=1):
+    active = _active()
+    if active:
+        active[0].inc(name, value, active[1])
+
+
+def observe(name, value):
+    active = _active()
+    if active:
+        active[0].observe(name, value, active[1])
+
+
+@contextmanager
+def timer(name):
+    if not _active():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe('{}_seconds'.format(name), time.time() - start)
+
+
+class LogSink(object):
+    # One JSON line per sync and labels
+    def write(self, registry):
+        for group in registry.snapshot():
+            sync = group['timers'].get('sync_seconds')
+            if sync and sync['sum']:
+                group['messages_per_second'] = group['counters'].get('messages', 0) / sync['sum']
+            logger.info(json.dumps(group, sort_keys=True))
+
+
+class PrometheusSink(object):
+    # Celery workers have no HTTP server, the totals of the process are
+    # written for the textfile collector of the node exporter
+    def __init__(self, path=None):
+        self.path = (path or get_metrics_path()).format(pid=os.getpid())
+        self.registry = Registry()
+
+    def write(self, registry):
+        self.registry.merge(registry)
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.email_backup', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(self.registry.prometheus().encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    # The sinks are created once per process, the Prometheus one keeps the totals
+    paths = tuple(get_metrics_sinks())
+    with _sinks_lock:
+        if paths not in _sinks:
+            _sinks.clear()
+            _sinks[paths] = [import_string(path)() for path in paths]
+        return _sinks[paths]
+
+
+def publish(registry):
+    for sink in get_sinks():
+        try:
+            sink.write(registry)
+        except Exception:
+            logger.exception('Cannot publish the metrics on {}'.format(sink.__class__.__name__))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailpath',
+            name='last_uid',
+            field=models.BigIntegerField(default=0, help_text='Highest UID already processed on this path'),
+        ),
+        migrations.AddField(
+            model_name='emailpath',
+            name='uid_validity',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_emailaccount_connections'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='raw',
+            field=models.FileField(db_index=True, upload_to=b''),
+        ),
+    ]
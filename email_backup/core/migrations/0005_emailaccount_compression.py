@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import email_backup.core.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_email_raw_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='compression',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('gzip', 'gzip'), ('zstd', 'zstd')], default='', help_text='Compression used to store the raw emails', max_length=8, validators=[email_backup.core.validators.compression_validator]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from email_backup.core import search
+
+
+def install_search(apps, schema_editor):
+    Email = apps.get_model('core', 'Email')
+    search.install(schema_editor.connection, Email._meta.db_table)
+
+
+def uninstall_search(apps, schema_editor):
+    Email = apps.get_model('core', 'Email')
+    search.uninstall(schema_editor.connection, Email._meta.db_table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_emailaccount_compression'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search, uninstall_search),
+    ]
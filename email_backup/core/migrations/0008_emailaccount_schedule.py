@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_email_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='backlog',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='New emails found on the last sync'),
+        ),
+        migrations.AddField(
+            model_name='emailaccount',
+            name='next_sync',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the account should be synced again', null=True),
+        ),
+        migrations.AddField(
+            model_name='emailaccount',
+            name='sync_started',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_emailaccount_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('running', 'Running'), ('paused', 'Paused'), ('failed', 'Failed'), ('canceled', 'Canceled'), ('done', 'Done')], default='running', max_length=8)),
+                ('uid_validity', models.BigIntegerField(blank=True, null=True)),
+                ('since_uid', models.BigIntegerField(default=0, help_text='Highest UID already processed on the path when the run started')),
+                ('checkpoint', models.BigIntegerField(default=0, help_text='Highest UID processed by this run')),
+                ('emails', models.PositiveIntegerField(default=0)),
+                ('fetched', models.PositiveIntegerField(default=0)),
+                ('linked', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_runs', to='core.EmailAccount')),
+                ('path', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_runs', to='core.EmailPath')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='syncrun',
+            index_together=set([('path', 'state')]),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_attachment'),
+    ]
+
+    operations = [
+        # The automatic through table of Email.paths becomes the EmailLink model
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='EmailLink',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Email')),
+                        ('emailpath', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.EmailPath')),
+                    ],
+                    options={
+                        'db_table': 'core_email_paths',
+                    },
+                ),
+                migrations.AlterUniqueTogether(
+                    name='emaillink',
+                    unique_together=set([('email', 'emailpath')]),
+                ),
+                migrations.AlterField(
+                    model_name='email',
+                    name='paths',
+                    field=models.ManyToManyField(related_name='emails', through='core.EmailLink', to='core.EmailPath'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='emaillink',
+            name='uid',
+            field=models.BigIntegerField(blank=True, help_text='UID of the email on the path', null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='emaillink',
+            index_together=set([('emailpath', 'uid')]),
+        ),
+        migrations.AddField(
+            model_name='emailpath',
+            name='highest_modseq',
+            field=models.BigIntegerField(blank=True, help_text='HIGHESTMODSEQ of the path on the last sync', null=True),
+        ),
+    ]
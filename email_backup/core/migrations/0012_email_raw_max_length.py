@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 17:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from email_backup.core import search
+
+
+def install_sqlite_search(apps, schema_editor):
+    # SQLite rebuilds the table to alter a column, its triggers are dropped with the old one
+    if schema_editor.connection.vendor == 'sqlite':
+        Email = apps.get_model('core', 'Email')
+        search.install(schema_editor.connection, Email._meta.db_table)
+
+
+def uninstall_sqlite_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        Email = apps.get_model('core', 'Email')
+        search.uninstall(schema_editor.connection, Email._meta.db_table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_emaillink_uid'),
+    ]
+
+    operations = [
+        migrations.RunPython(uninstall_sqlite_search, install_sqlite_search),
+        migrations.AlterField(
+            model_name='email',
+            name='raw',
+            field=models.FileField(db_index=True, max_length=255, upload_to=b''),
+        ),
+        migrations.RunPython(install_sqlite_search, uninstall_sqlite_search),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 17:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_email_raw_max_length'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='blob',
+            field=models.FileField(db_index=True, max_length=255, upload_to=b''),
+        ),
+    ]
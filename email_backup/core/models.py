@@ -1,28 +1,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import hashlib
-import os
-
 import six
-from django.core.files import File
-from django.core.files.storage import default_storage
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from six import StringIO
 
 from email_backup.core.connector import Email as TmpEmail
-from email_backup.core.connector import EmailConnectorInterface
+from email_backup.core.connector import EmailConnectorInterface, FETCH_CHUNK_SIZE, chunks, get_connection_pool
+from email_backup.core.pagination import KEYSET_ORDERING, seek
+from email_backup.core.scheduler import get_host_sessions, get_sync_timeout
+from email_backup.core.search import search
+from email_backup.core.storage import AttachmentStore, BlobStore, COMPRESSION_CHOICES, blob_reused
 from email_backup.core.validators import (
     host_validator,
     bind_port_validator,
-    path_validator
+    path_validator,
+    compression_validator
 )
 
 if not six.PY2:  # pragma: no cover
     unicode = str
 
 
+class EmailAccountQuerySet(models.QuerySet):
+    def due(self, until):
+        queryset = self.filter(sync=True).filter(Q(next_sync__isnull=True) | Q(next_sync__lt=until))
+        return queryset.order_by('-backlog', 'pk')
+
+    def queue_sync(self):
+        # Marks a folder sync waiting in the queue, False when the accounts have one already
+        now = timezone.now()
+        queryset = self.filter(Q(sync_queued__isnull=True) | Q(sync_queued__lte=now - get_sync_timeout()))
+        return queryset.update(sync_queued=now) > 0
+
+
 class EmailAccount(models.Model):
     user = models.CharField(max_length=128)
     password = models.CharField(max_length=128)
@@ -45,6 +60,27 @@ class EmailAccount(models.Model):
         default=True,
         help_text=_("Should de system ignore the unread emails?")
     )
+    connections = models.PositiveSmallIntegerField(
+        default=1,
+        help_text=_("Maximum number of simultaneous connections to the server")
+    )
+    compression = models.CharField(
+        max_length=8, default='', blank=True,
+        choices=COMPRESSION_CHOICES, validators=[compression_validator],
+        help_text=_("Compression used to store the raw emails")
+    )
+    next_sync = models.DateTimeField(
+        null=True, blank=True, db_index=True,
+        help_text=_("When the account should be synced again")
+    )
+    sync_started = models.DateTimeField(null=True, blank=True, editable=False)
+    sync_queued = models.DateTimeField(null=True, blank=True, editable=False)
+    backlog = models.PositiveIntegerField(
+        default=0, editable=False,
+        help_text=_("New emails found on the last sync")
+    )
+
+    objects = EmailAccountQuerySet.as_manager()
 
     class Meta:
         unique_together = ("user", "host")
@@ -56,13 +92,58 @@ class EmailAccount(models.Model):
         return "{} at [{}]".format(self.user, self.host)
 
     def connector(self):
-        return EmailConnectorInterface(self.host, self.port, self.ssl, self.user, self.password)
+        return EmailConnectorInterface(self.host, self.port, self.ssl, self.user, self.password,
+                                       use_uid=True, readonly=not self.remove)
+
+    def connection_pool(self):
+        return get_connection_pool((self.host, self.port, self.user, self.remove), self.connector, self.connections)
+
+    def acquire_sync(self):
+        # The accounts of the host are locked to count the running sessions
+        now = timezone.now()
+        with transaction.atomic():
+            accounts = EmailAccount.objects.select_for_update().filter(host__iexact=self.host)
+            running = 0
+            for pk, connections, started in accounts.values_list('pk', 'connections', 'sync_started'):
+                if not started or started <= now - get_sync_timeout():
+                    continue
+                if pk == self.pk:
+                    # Another task is syncing this account
+                    return False
+                running += connections
+            if running and running + self.connections > get_host_sessions():
+                return False
+            self.sync_started = now
+            self.save(update_fields=['sync_started'])
+        return True
+
+    def dequeue_sync(self):
+        # The queued folder sync starts, the emails arriving from now on need another one
+        self.sync_queued = None
+        self.save(update_fields=['sync_queued'])
+
+    def release_sync(self, backlog=None):
+        self.sync_started = None
+        update_fields = ['sync_started']
+        if backlog is not None:
+            self.backlog = backlog
+            update_fields.append('backlog')
+        self.save(update_fields=update_fields)
 
 
 class EmailPath(models.Model):
     account = models.ForeignKey(EmailAccount, related_name='ignore')
     path = models.CharField(max_length=2048, validators=[path_validator])
     ignore = models.BooleanField(default=False)
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(
+        default=0,
+        help_text=_("Highest UID already processed on this path")
+    )
+    highest_modseq = models.BigIntegerField(
+        null=True, blank=True,
+        help_text=_("HIGHESTMODSEQ of the path on the last sync")
+    )
 
     class Meta:
         unique_together = ("account", "path")
@@ -74,12 +155,111 @@ class EmailPath(models.Model):
         return self.path
 
 
-class EmailManager(models.Manager):
+class SyncRunQuerySet(models.QuerySet):
+    def resumable(self):
+        return self.filter(state__in=SyncRun.RESUMABLE_STATES)
+
+    def resume(self, account, path, uid_validity):
+        run = self.resumable().filter(path=path, uid_validity=uid_validity).order_by('-pk').first()
+        if run is None:
+            return self.create(account=account, path=path, uid_validity=uid_validity,
+                               since_uid=path.last_uid, checkpoint=path.last_uid)
+        run.state = SyncRun.RUNNING
+        run.save(update_fields=['state', 'updated'])
+        return run
+
+    def cancel(self):
+        return self.resumable().update(state=SyncRun.CANCELED, finished=timezone.now())
+
+
+class SyncRun(models.Model):
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    FAILED = 'failed'
+    CANCELED = 'canceled'
+    DONE = 'done'
+    STATE_CHOICES = (
+        (RUNNING, _("Running")),
+        (PAUSED, _("Paused")),
+        (FAILED, _("Failed")),
+        (CANCELED, _("Canceled")),
+        (DONE, _("Done")),
+    )
+    RESUMABLE_STATES = (RUNNING, PAUSED, FAILED)
+
+    account = models.ForeignKey(EmailAccount, related_name='sync_runs')
+    path = models.ForeignKey(EmailPath, related_name='sync_runs')
+    state = models.CharField(max_length=8, choices=STATE_CHOICES, default=RUNNING)
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    since_uid = models.BigIntegerField(
+        default=0,
+        help_text=_("Highest UID already processed on the path when the run started")
+    )
+    checkpoint = models.BigIntegerField(
+        default=0,
+        help_text=_("Highest UID processed by this run")
+    )
+    emails = models.PositiveIntegerField(default=0)
+    fetched = models.PositiveIntegerField(default=0)
+    linked = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = SyncRunQuerySet.as_manager()
+
+    class Meta:
+        index_together = ("path", "state")
+
+    def __unicode__(self):
+        return "{} [{}]".format(self.path, self.state)
+
+    def __str__(self):
+        return "{} [{}]".format(self.path, self.state)
+
+    def found(self, count):
+        self.emails = self.fetched + self.linked + count
+        self.save(update_fields=['emails', 'updated'])
+
+    def progress(self, email_ids, fetched=0, linked=0):
+        if email_ids:
+            self.checkpoint = max(self.checkpoint, max(int(email_id) for email_id in email_ids))
+        self.fetched += fetched
+        self.linked += linked
+        self.save(update_fields=['checkpoint', 'fetched', 'linked', 'updated'])
+
+    def finish(self, state=DONE, error=''):
+        self.state = state
+        self.error = error
+        self.finished = timezone.now() if state != SyncRun.PAUSED else None
+        self.save(update_fields=['state', 'error', 'finished', 'updated'])
+
+
+class EmailQuerySet(models.QuerySet):
+    def search(self, query):
+        return search(self, query)
+
+    def keyset(self, after=None):
+        queryset = self.order_by(*KEYSET_ORDERING)
+        if after:
+            queryset = seek(queryset, *after)
+        return queryset
+
+
+class EmailManager(models.Manager.from_queryset(EmailQuerySet)):
     def filter_from(self, email):
         assert isinstance(email, TmpEmail), 'Only support {} objects'.format(TmpEmail.__class__)
         email.load(True)
         return self.get_queryset().filter(message_id=email.get('Message-Id'))
 
+    def stored_message_ids(self, account, message_ids):
+        message_ids = set(message_id for message_id in message_ids if message_id)
+        if not message_ids:
+            return {}
+        queryset = self.get_queryset().filter(account=account, message_id__in=message_ids)
+        return dict(queryset.values_list('message_id', 'pk'))
+
     def get_or_create_from(self, email, **kwargs):
         assert isinstance(email, TmpEmail), 'Only support {} objects'.format(TmpEmail.__class__)
         account = kwargs.get('account', None)
@@ -91,35 +271,67 @@ class EmailManager(models.Manager):
         return self.create_from(email, **kwargs), True
 
     def create_from(self, email, **kwargs):
-        assert isinstance(email, TmpEmail), 'Only support {} objects'.format(TmpEmail.__class__)
-        account = kwargs.get('account', None)
-        assert account, 'Account is required'
-        email.load()
+        instance = self.create(**self.fields_from(email, **kwargs))
+        attachments = self.attachments_from(email, **kwargs)
+        for attachment in attachments:
+            attachment.email = instance
+        Attachment.objects.bulk_create(attachments)
+        return instance
+
+    def build_from(self, email, **kwargs):
+        return self.model(**self.fields_from(email, **kwargs))
 
-        kwargs['message_id'] = email.get('Message-Id')
-        kwargs['send_by'] = email.get('from')
-        kwargs['date'] = email.get('date')
-        kwargs['subject'] = email.get('Subject', '')
-        kwargs['content'] = email.content()
-        kwargs['attaches'] = email.attaches()
+    def create_parsed(self, parsed, **kwargs):
+        instance, attachments = self.build_parsed(parsed, **kwargs)
+        instance.save()
+        for attachment in attachments:
+            attachment.email = instance
+        Attachment.objects.bulk_create(attachments)
+        return instance
 
-        email_hash = hashlib.sha512(six.b(email.raw) or b'')
+    def build_parsed(self, parsed, **kwargs):
+        # Parsed by the processes of the pipeline, only the blobs are left to store
+        account = kwargs.get('account', None)
+        assert account, 'Account is required'
+        kwargs.update(parsed.fields)
+        kwargs['raw'] = BlobStore(compression=account.compression).save_encoded(*parsed.raw)
+        store = AttachmentStore(compression=account.compression)
+        attachments = [
+            Attachment(blob=store.save_encoded(digest, content), filename=filename, content_type=content_type,
+                       size=size, digest=digest)
+            for filename, content_type, size, digest, content in parsed.attachments
+        ]
+        return self.model(**kwargs), attachments
 
-        base_path = '.'
-        try:
-            base_path = default_storage.path('.')
-        except NotImplementedError:
-            pass
-        filename = '{}/{}/{}.eml'.format(base_path, account.path, email_hash.hexdigest())
-        filename = os.path.abspath(filename)
-        kwargs['raw'] = File(StringIO(unicode(email)), name=filename)
+    def fields_from(self, email, **kwargs):
+        assert isinstance(email, TmpEmail), 'Only support {} objects'.format(TmpEmail.__class__)
+        account = kwargs.get('account', None)
+        assert account, 'Account is required'
+        kwargs.update(email.fields())
+        kwargs['raw'] = BlobStore(compression=account.compression).save(email.raw)
+        return kwargs
 
-        return self.create(**kwargs)
+    def attachments_from(self, email, **kwargs):
+        # The content is stored right away, the rows are created with the email
+        account = kwargs.get('account', None)
+        assert account, 'Account is required'
+        store = AttachmentStore(compression=account.compression)
+        attachments = []
+        for filename, content_type, content in email.attachments():
+            try:
+                attachments.append(Attachment(
+                    blob=store.save(content), filename=filename[:255], content_type=content_type[:255],
+                    size=len(content), digest=content.digest
+                ))
+            finally:
+                content.close()
+        return attachments
 
 
 class Email(models.Model):
     account = models.ForeignKey(EmailAccount)
-    raw = models.FileField()
+    # messages/ab/cd/<sha512>.eml.zst does not fit the default 100 characters
+    raw = models.FileField(max_length=255, db_index=True)
     message_id = models.CharField(max_length=1024)
     # For search proposed
     send_by = models.EmailField()
@@ -127,9 +339,121 @@ class Email(models.Model):
     content = models.TextField(blank=True)
     attaches = models.IntegerField(default=0)
     date = models.DateTimeField()
-    paths = models.ManyToManyField(EmailPath, related_name='emails')
+    paths = models.ManyToManyField(EmailPath, related_name='emails', through='EmailLink')
 
     objects = EmailManager()
 
     class Meta:
         unique_together = ("account", "message_id")
+        indexes = [
+            models.Index(fields=['date', 'id'], name='core_email_date_id_idx'),
+            models.Index(fields=['account', 'date'], name='core_email_account_date_idx'),
+            models.Index(fields=['send_by'], name='core_email_send_by_idx'),
+        ]
+
+    def open_raw(self):
+        return BlobStore().open(self.raw.name)
+
+
+class EmailLinkQuerySet(models.QuerySet):
+    def reset_uids(self, path):
+        return self.filter(emailpath=path).update(uid=None)
+
+    def vanish(self, path, uids, chunk_size=FETCH_CHUNK_SIZE):
+        removed = 0
+        for chunk in chunks(uids, chunk_size):
+            removed += self.filter(emailpath=path, uid__in=chunk).delete()[0]
+        return removed
+
+
+class EmailLink(models.Model):
+    # Keeps the table of the former automatic through model of Email.paths
+    email = models.ForeignKey(Email)
+    emailpath = models.ForeignKey(EmailPath)
+    uid = models.BigIntegerField(
+        null=True, blank=True,
+        help_text=_("UID of the email on the path")
+    )
+
+    objects = EmailLinkQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'core_email_paths'
+        unique_together = ("email", "emailpath")
+        index_together = ("emailpath", "uid")
+
+    def __unicode__(self):
+        return "{} [{}]".format(self.emailpath, self.uid)
+
+    def __str__(self):
+        return "{} [{}]".format(self.emailpath, self.uid)
+
+
+@receiver(post_delete, sender=Email)
+def release_raw(sender, instance, **kwargs):
+    if instance.raw.name:
+        # Deleted later by collect_blobs, the row comes back with its blob if the transaction is rolled back
+        ReleasedBlob.objects.get_or_create(name=instance.raw.name, defaults={'attachment': False})
+
+
+class Attachment(models.Model):
+    email = models.ForeignKey(Email, related_name='attachments')
+    blob = models.FileField(max_length=255, db_index=True)
+    filename = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+    digest = models.CharField(max_length=128, db_index=True)
+
+    def __unicode__(self):
+        return self.filename or self.digest
+
+    def __str__(self):
+        return self.filename or self.digest
+
+    def open(self):
+        return AttachmentStore().open(self.blob.name)
+
+
+@receiver(post_delete, sender=Attachment)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob.name:
+        ReleasedBlob.objects.get_or_create(name=instance.blob.name, defaults={'attachment': True})
+
+
+class ReleasedBlobQuerySet(models.QuerySet):
+    def collect(self, before):
+        deleted = 0
+        for pk, name, attachment in self.filter(released__lte=before).values_list('pk', 'name', 'attachment'):
+            with transaction.atomic():
+                # Deleting the row first locks it, an ingest reusing the blob waits for the file to be gone
+                if not self.filter(pk=pk).delete()[0]:
+                    continue
+                if attachment:
+                    referenced = Attachment.objects.filter(blob=name).exists()
+                else:
+                    referenced = Email.objects.filter(raw=name).exists()
+                if not referenced:
+                    (AttachmentStore() if attachment else BlobStore()).delete(name)
+                    deleted += 1
+        return deleted
+
+
+class ReleasedBlob(models.Model):
+    # Blobs left without the row referencing them, deleted once no ingest can be reusing them
+    name = models.CharField(max_length=255, unique=True)
+    attachment = models.BooleanField(default=False)
+    released = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = ReleasedBlobQuerySet.as_manager()
+
+    def __unicode__(self):
+        return self.name
+
+    def __str__(self):
+        return self.name
+
+
+@receiver(blob_reused)
+def cancel_release(sender, name, **kwargs):
+    # Waits for a collection deleting the blob, the store checks the file again afterwards
+    ReleasedBlob.objects.filter(name=name).delete()
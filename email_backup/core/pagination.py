@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Q
+from django.utils.functional import cached_property
+
+APPROXIMATE_COUNT = 100000
+KEYSET_ORDERING = ('-date', '-id')
+
+
+def get_approximate_count():
+    return getattr(settings, 'EMAIL_BACKUP_APPROXIMATE_COUNT', APPROXIMATE_COUNT)
+
+
+def seek(queryset, date, pk, inclusive=False):
+    # Rows after the (date, id) key with descending KEYSET_ORDERING
+    if inclusive:
+        return queryset.filter(Q(date__lt=date) | Q(date=date, id__lte=pk))
+    return queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+
+
+def estimate_count(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row else None
+    elif connection.vendor == 'sqlite':
+        # Row ids are not reused, the highest one is an upper bound read from the primary key
+        return queryset.model._default_manager.db_manager(queryset.db).aggregate(count=Max('pk'))['count'] or 0
+    return None
+
+
+class KeysetPaginator(Paginator):
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'query') and not self.object_list.query.where:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= get_approximate_count():
+                return estimate
+        return super(KeysetPaginator, self).count
+
+    def is_keyset(self):
+        # The id is unique, any ordering after the key is irrelevant
+        if not hasattr(self.object_list, 'query'):
+            return False
+        return tuple(self.object_list.query.order_by[:len(KEYSET_ORDERING)]) == KEYSET_ORDERING
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        if bottom == 0 or not self.is_keyset():
+            return super(KeysetPaginator, self).page(number)
+        top = self.per_page
+        if bottom + top + self.orphans >= self.count:
+            top = self.count - bottom
+        # Only the key is read with OFFSET, the rows are read from that key
+        keys = list(self.object_list.values_list('date', 'id')[bottom:bottom + 1])
+        object_list = seek(self.object_list, *keys[0], inclusive=True)[:top] if keys else self.object_list.none()
+        return self._get_page(object_list, number, self)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+import billiard
+import six
+from django.conf import settings
+from six.moves import queue
+
+from email_backup.core import metrics
+from email_backup.core.connector import Email, RawMessage
+from email_backup.core.storage import AttachmentStore, BlobStore
+
+PARSE_PROCESSES = 0
+PIPELINE_SIZE = 100
+PIPELINE_FETCH_SIZE = 50
+
+# Picklable result of the parse processes, everything but the storage and the database rows
+ParsedEmail = namedtuple('ParsedEmail', ['fields', 'raw', 'attachments', 'seconds'])
+
+
+def get_parse_processes():
+    return getattr(settings, 'EMAIL_BACKUP_PARSE_PROCESSES', PARSE_PROCESSES)
+
+
+def get_pipeline_size():
+    return getattr(settings, 'EMAIL_BACKUP_PIPELINE_SIZE', PIPELINE_SIZE)
+
+
+def get_pipeline_fetch_size():
+    return getattr(settings, 'EMAIL_BACKUP_PIPELINE_FETCH_SIZE', PIPELINE_FETCH_SIZE)
+
+
+def parse(raw, size=None, compression=''):
+    start = time.time()
+    message = Email(None, None, None)
+    message.feed(raw, size=size)
+    fields = message.fields()
+    store = AttachmentStore(compression=compression)
+    attachments = []
+    for filename, content_type, content in message.attachments():
+        try:
+            digest, data = store.encode(content.read(), digest=content.digest)
+            attachments.append((filename[:255], content_type[:255], len(content), digest, data))
+        finally:
+            content.close()
+    raw = BlobStore(compression=compression).encode(message.raw)
+    return ParsedEmail(fields, raw, attachments, time.time() - start)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    # billiard, unlike multiprocessing, can fork from the daemonic celery workers
+    global _pool
+    processes = get_parse_processes()
+    if processes <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool[0] != os.getpid() or _pool[1] != processes:
+            if _pool is not None and _pool[0] == os.getpid():
+                _pool[2].terminate()
+            _pool = (os.getpid(), processes, billiard.Pool(processes))
+        return _pool[2]
+
+
+def close_parse_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool[0] == os.getpid():
+        pool[2].close()
+        pool[2].join()
+
+
+class FetchError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Pipeline(object):
+    # The fetching thread, the parse processes and the writer on the calling thread run at the same time
+    END = object()
+
+    def __init__(self, writer, compression='', pool=None, size=None, fetch_size=None):
+        self.writer = writer
+        self.compression = compression
+        self.pool = pool
+        self.size = size or get_pipeline_size()
+        self.fetch_size = fetch_size or get_pipeline_fetch_size()
+
+    def store(self, email_server, directory, email_ids, path):
+        # Yields the server ids of the emails given to the writer
+        if not email_ids:
+            return
+        fetched = queue.Queue(maxsize=self.size)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=metrics.bind(self._fetch),
+                                   args=(email_server, directory, email_ids, fetched, stop))
+        fetcher.daemon = True
+        fetcher.start()
+        pending = deque()
+        try:
+            while True:
+                message = fetched.get()
+                if message is self.END:
+                    break
+                if isinstance(message, FetchError):
+                    six.reraise(*message.exc_info)
+                pending.append((message, self._parse(message)))
+                while len(pending) > (self.size if self.pool else 0):
+                    yield self._write(path, *pending.popleft())
+            while pending:
+                yield self._write(path, *pending.popleft())
+        finally:
+            # The session is free again once the fetcher leaves it
+            stop.set()
+            while fetcher.is_alive():
+                try:
+                    fetched.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            fetcher.join()
+
+    def _fetch(self, email_server, directory, email_ids, fetched, stop):
+        try:
+            for message in email_server.fetch(directory, email_ids, chunk_size=self.fetch_size):
+                # Blocks while the parse and writer stages are behind
+                fetched.put(message)
+                if stop.is_set():
+                    break
+        except Exception:
+            fetched.put(FetchError(sys.exc_info()))
+        finally:
+            fetched.put(self.END)
+
+    def _parse(self, message):
+        # The spooled big emails are parsed by the writer, they are not sent to the processes
+        if self.pool is None or not message.raw or isinstance(message.raw, RawMessage):
+            return None
+        return self.pool.apply_async(parse, (message.raw, message.size, self.compression))
+
+    def _write(self, path, message, result):
+        if result is None:
+            self.writer.add(message, path)
+        else:
+            with metrics.timer('parse_wait'):
+                parsed = result.get()
+            metrics.observe('parse_seconds', parsed.seconds)
+            self.writer.add_parsed(parsed, message.uid, path)
+        return message.server_id
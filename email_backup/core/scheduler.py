@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+
+SYNC_INTERVAL = 3600
+SYNC_RETRY = 60
+SYNC_TIMEOUT = 4 * 3600
+SYNC_TIME_LIMIT = 600
+HOST_SESSIONS = 20
+
+
+def get_sync_interval():
+    return timedelta(seconds=getattr(settings, 'EMAIL_BACKUP_SYNC_INTERVAL', SYNC_INTERVAL))
+
+
+def get_sync_retry():
+    return getattr(settings, 'EMAIL_BACKUP_SYNC_RETRY', SYNC_RETRY)
+
+
+def get_sync_timeout():
+    return timedelta(seconds=getattr(settings, 'EMAIL_BACKUP_SYNC_TIMEOUT', SYNC_TIMEOUT))
+
+
+def get_sync_time_limit():
+    return getattr(settings, 'EMAIL_BACKUP_SYNC_TIME_LIMIT', SYNC_TIME_LIMIT)
+
+
+def get_host_sessions():
+    return getattr(settings, 'EMAIL_BACKUP_HOST_SESSIONS', HOST_SESSIONS)
+
+
+def schedule(accounts, now, interval):
+    # Accounts keep their due time, the new or late ones are spread along
+    # the interval per host in the given order
+    late = OrderedDict()
+    for account in accounts:
+        if account.next_sync and account.next_sync >= now:
+            yield account, account.next_sync
+        else:
+            late.setdefault(account.host.lower(), []).append(account)
+    for accounts in late.values():
+        step = interval // len(accounts)
+        for position, account in enumerate(accounts):
+            yield account, now + step * position
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import operator
+import re
+from functools import reduce
+
+from django.db import connections
+from django.db.models import Q
+
+RE_SEARCH_TERM = re.compile('\w+', re.UNICODE)
+
+SEARCH_CONFIG = 'simple'
+SEARCH_FIELDS = ('subject', 'send_by', 'content')
+
+POSTGRESQL_INSTALL = (
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector",
+    """CREATE FUNCTION {table}_search_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('{config}', coalesce(NEW.subject, '')), 'A') ||
+        setweight(to_tsvector('{config}', coalesce(NEW.send_by, '')), 'A') ||
+        setweight(to_tsvector('{config}', coalesce(NEW.content, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER {table}_search_update BEFORE INSERT OR UPDATE OF subject, send_by, content
+ON {table} FOR EACH ROW EXECUTE PROCEDURE {table}_search_update()""",
+    "UPDATE {table} SET subject = subject",
+    "CREATE INDEX {table}_search_vector ON {table} USING GIN (search_vector)",
+)
+POSTGRESQL_UNINSTALL = (
+    "DROP TRIGGER IF EXISTS {table}_search_update ON {table}",
+    "DROP FUNCTION IF EXISTS {table}_search_update()",
+    "ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector",
+)
+
+SQLITE_INSTALL = (
+    """CREATE VIRTUAL TABLE {table}_fts USING fts5(
+    subject, send_by, content, content='{table}', content_rowid='id'
+)""",
+    """CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+    INSERT INTO {table}_fts(rowid, subject, send_by, content)
+    VALUES (new.id, new.subject, new.send_by, new.content);
+END""",
+    """CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+    INSERT INTO {table}_fts({table}_fts, rowid, subject, send_by, content)
+    VALUES ('delete', old.id, old.subject, old.send_by, old.content);
+END""",
+    """CREATE TRIGGER {table}_fts_update AFTER UPDATE OF subject, send_by, content ON {table} BEGIN
+    INSERT INTO {table}_fts({table}_fts, rowid, subject, send_by, content)
+    VALUES ('delete', old.id, old.subject, old.send_by, old.content);
+    INSERT INTO {table}_fts(rowid, subject, send_by, content)
+    VALUES (new.id, new.subject, new.send_by, new.content);
+END""",
+    "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+)
+SQLITE_UNINSTALL = (
+    "DROP TRIGGER IF EXISTS {table}_fts_insert",
+    "DROP TRIGGER IF EXISTS {table}_fts_delete",
+    "DROP TRIGGER IF EXISTS {table}_fts_update",
+    "DROP TABLE IF EXISTS {table}_fts",
+)
+
+
+_installed = {}
+
+
+def search_terms(query):
+    return RE_SEARCH_TERM.findall(query or '')
+
+
+def has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def is_supported(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    elif connection.vendor == 'sqlite':
+        return has_fts5(connection)
+    return False
+
+
+def _is_installed(connection, table):
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, table)
+        return 'search_vector' in [column.name for column in columns]
+    elif connection.vendor == 'sqlite':
+        return '{}_fts'.format(table) in connection.introspection.table_names()
+    return False
+
+
+def is_installed(connection, table):
+    key = (connection.alias, table)
+    if key not in _installed:
+        _installed[key] = _is_installed(connection, table)
+    return _installed[key]
+
+
+def _execute(connection, statements, table):
+    _installed.pop((connection.alias, table), None)
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement.format(table=table, config=SEARCH_CONFIG))
+
+
+def install(connection, table):
+    if not is_supported(connection):
+        return False
+    if connection.vendor == 'postgresql':
+        _execute(connection, POSTGRESQL_INSTALL, table)
+    else:
+        _execute(connection, SQLITE_INSTALL, table)
+    return True
+
+
+def uninstall(connection, table):
+    if connection.vendor == 'postgresql':
+        _execute(connection, POSTGRESQL_UNINSTALL, table)
+    elif connection.vendor == 'sqlite':
+        _execute(connection, SQLITE_UNINSTALL, table)
+
+
+def search(queryset, query):
+    terms = search_terms(query)
+    if not terms:
+        return queryset
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if not is_installed(connection, table):
+        # Slow path for the backends without full text index
+        return queryset.filter(reduce(operator.and_, [
+            reduce(operator.or_, [Q(**{'{}__icontains'.format(field): term}) for field in SEARCH_FIELDS])
+            for term in terms
+        ]))
+    if connection.vendor == 'postgresql':
+        return queryset.extra(
+            where=['{}.search_vector @@ to_tsquery(%s, %s)'.format(table)],
+            params=[SEARCH_CONFIG, ' & '.join('{}:*'.format(term) for term in terms)]
+        )
+    return queryset.extra(
+        where=['{0}.id IN (SELECT rowid FROM {0}_fts WHERE {0}_fts MATCH %s)'.format(table)],
+        params=[' '.join('"{}"*'.format(term) for term in terms)]
+    )
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import tempfile
+
+import six
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.dispatch import Signal
+from django.utils.translation import ugettext_lazy as _
+from six import BytesIO
+
+from email_backup.core import metrics
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+BLOB_PATH = 'messages'
+ATTACHMENT_PATH = 'attachments'
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+COMPRESSION_CHOICES = (
+    ('', _('None')),
+    ('gzip', 'gzip'),
+    ('zstd', 'zstd'),
+)
+COMPRESSION_EXTENSIONS = {
+    '': '.eml',
+    'gzip': '.eml.gz',
+    'zstd': '.eml.zst',
+}
+ATTACHMENT_EXTENSIONS = {
+    '': '.bin',
+    'gzip': '.bin.gz',
+    'zstd': '.bin.zst',
+}
+
+blob_reused = Signal(providing_args=['name'])
+
+
+def get_blob_path():
+    return getattr(settings, 'EMAIL_BACKUP_BLOB_PATH', BLOB_PATH)
+
+
+def get_attachment_path():
+    return getattr(settings, 'EMAIL_BACKUP_ATTACHMENT_PATH', ATTACHMENT_PATH)
+
+
+def blob_name(digest, extension='.eml', path=None):
+    return '{}/{}/{}/{}{}'.format(path or get_blob_path(), digest[:2], digest[2:4], digest, extension)
+
+
+def to_bytes(content):
+    if isinstance(content, six.text_type):
+        return content.encode('utf-8')
+    return content or b''
+
+
+class BlobStore(object):
+    extensions = COMPRESSION_EXTENSIONS
+
+    def __init__(self, storage=None, compression=''):
+        self.storage = storage or default_storage
+        self.compression = compression or ''
+        if self.compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unknown compression {}'.format(self.compression))
+        if self.compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+
+    def get_path(self):
+        return get_blob_path()
+
+    def save(self, content):
+        with metrics.timer('blob_save'):
+            return self._hash_and_save(content)
+
+    def _hash_and_save(self, content):
+        if isinstance(content, six.string_types + (six.binary_type,)) or content is None:
+            content = to_bytes(content)
+            if not self.compression:
+                return self._save(hashlib.sha512(content).hexdigest(), ContentFile(content))
+            content = BytesIO(content)
+        elif getattr(content, 'digest', None) and not self.compression:
+            # Already hashed while it was downloaded
+            content.seek(0)
+            return self._save(content.digest, File(content))
+
+        digest = hashlib.sha512()
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            writer = self._writer(spool)
+            for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+                chunk = to_bytes(chunk)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                writer.write(chunk)
+            self._close_writer(writer)
+            spool.seek(0)
+            return self._save(digest.hexdigest(), File(spool))
+        finally:
+            spool.close()
+
+    def encode(self, content, digest=None):
+        # The digest and the stored bytes, computed apart from the storage by the parse processes
+        content = to_bytes(content)
+        digest = digest or hashlib.sha512(content).hexdigest()
+        if self.compression:
+            buffer = BytesIO()
+            writer = self._writer(buffer)
+            writer.write(content)
+            self._close_writer(writer)
+            content = buffer.getvalue()
+        return digest, content
+
+    def save_encoded(self, digest, content):
+        with metrics.timer('blob_save'):
+            return self._save(digest, ContentFile(content))
+
+    def _writer(self, fileobj):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=fileobj, mode='wb')
+        elif self.compression == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(fileobj)
+        return fileobj
+
+    def _close_writer(self, writer):
+        if self.compression == 'gzip':
+            writer.close()
+        elif self.compression == 'zstd':
+            writer.flush(zstandard.FLUSH_FRAME)
+
+    def _save(self, digest, content):
+        name = blob_name(digest, self.extensions[self.compression], self.get_path())
+        with metrics.timer('storage_write'):
+            if self.storage.exists(name):
+                # Cancels a pending release of the blob, a collection running meanwhile could have deleted it
+                blob_reused.send(sender=self.__class__, name=name)
+                if self.storage.exists(name):
+                    return name
+            name = self.storage.save(name, content)
+        return name
+
+    def open(self, name):
+        fileobj = self.storage.open(name, 'rb')
+        if name.endswith(self.extensions['gzip']):
+            return gzip.GzipFile(fileobj=fileobj, mode='rb')
+        elif name.endswith(self.extensions['zstd']):
+            if zstandard is None:
+                raise ValueError('zstd compression requires the zstandard package')
+            return zstandard.ZstdDecompressor().stream_reader(fileobj)
+        return fileobj
+
+    def delete(self, name):
+        if name and self.storage.exists(name):
+            self.storage.delete(name)
+
+
+class AttachmentStore(BlobStore):
+    # The same attachment is stored once for all the emails and accounts
+    extensions = ATTACHMENT_EXTENSIONS
+
+    def get_path(self):
+        return get_attachment_path()
@@ -2,35 +2,240 @@
 from __future__ import absolute_import, unicode_literals
 
 import datetime
+import threading
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_process_shutdown
+from django.db import connection as db_connection
+from django.utils import timezone
 
 from email_backup.celery import app
-from email_backup.core.models import EmailAccount, Email, EmailPath
+from email_backup.core import metrics
+from email_backup.core.connector import chunks, close_sessions, FETCH_CHUNK_SIZE
+from email_backup.core.models import EmailAccount, Email, EmailLink, EmailPath, ReleasedBlob, SyncRun
+from email_backup.core.pipeline import close_parse_pool, get_parse_pool, Pipeline
+from email_backup.core.scheduler import (
+    get_sync_interval, get_sync_retry, get_sync_time_limit, get_sync_timeout, schedule
+)
+from email_backup.core.writer import EmailWriter
+
+
+class SyncPaused(Exception):
+    pass
+
+
+def _check_deadline(deadline, stop=None):
+    # The stop event pauses the folder threads when the task is interrupted
+    if (deadline and time.time() > deadline) or (stop and stop.is_set()):
+        raise SyncPaused()
+
+
+def _last_uid(email_server, directory, since_uid, uid_next, before=None, just_read=False):
+    # Messages skipped by the account filters must be read again on the next sync
+    last_uid = uid_next - 1
+    pending = email_server.search(directory=directory, before=before, just_read=just_read,
+                                  since_uid=since_uid, invert=True)
+    if pending:
+        pending_uid = email_server.get_uid(min(int(i) for i in pending))
+        if pending_uid and pending_uid > since_uid:
+            last_uid = min(last_uid, pending_uid - 1)
+    return last_uid
+
+
+def _sync_emails(email_server, account, path, directory, email_ids, chunk_size=FETCH_CHUNK_SIZE,
+                 run=None, deadline=None, stop=None):
+    # Returns the lowest UID the server did not give back, the checkpoints stay below it
+    failed = None
+    expunge = False
+    writer = EmailWriter(account)
+    pipeline = Pipeline(writer, compression=account.compression, pool=get_parse_pool())
+    for chunk in chunks(email_ids, chunk_size):
+        _check_deadline(deadline, stop)
+        message_ids = list(email_server.message_ids(directory, chunk, chunk_size=chunk_size))
+        stored = Email.objects.stored_message_ids(account, [message_id for _, message_id in message_ids])
+        writer.link([(stored[message_id], int(email_id) if email_server.use_uid else None)
+                     for email_id, message_id in message_ids if message_id in stored], path)
+
+        new_ids, done_ids = [], []
+        known = set(stored)
+        for email_id, message_id in message_ids:
+            if message_id and message_id in known:
+                done_ids.append(email_id)
+            else:
+                new_ids.append(email_id)
+                known.add(message_id)
+
+        linked = len(done_ids)
+        done_ids.extend(pipeline.store(email_server, directory, new_ids, path))
+        writer.flush()
+        metrics.inc('messages', len(done_ids))
+        metrics.inc('messages_linked', linked)
+
+        # The chunk is already stored, it can be removed from the server
+        if account.remove and email_server.delete(directory, done_ids, chunk_size=chunk_size):
+            expunge = True
+        done = set(int(email_id) for email_id in done_ids)
+        missing = [int(email_id) for email_id in chunk if int(email_id) not in done]
+        if missing:
+            metrics.inc('messages_missing', len(missing))
+            failed = min(missing + [failed]) if failed else min(missing)
+        if run:
+            run.progress([email_id for email_id in chunk if not failed or int(email_id) < failed],
+                         fetched=len(done_ids) - linked, linked=linked)
+    if expunge:
+        # A plain EXPUNGE also removes the flagged emails this sync skipped, only without UIDPLUS or MOVE
+        email_server.do_delete()
+    return failed
 
 
 @app.task
 def sync_all_account():
-    for account in EmailAccount.objects.filter(sync=True):
-        sync_account.apply_async(account.pk)
+    now = timezone.now()
+    interval = get_sync_interval()
+    for account, eta in schedule(EmailAccount.objects.due(now + interval), now, interval):
+        account.next_sync = eta + interval
+        account.save(update_fields=['next_sync'])
+        sync_account.apply_async(args=[account.pk], eta=eta)
 
 
 @app.task
-def sync_account(account_pk):
+def collect_blobs():
+    # A sync lasts at most the sync timeout, the ones that found the blob before it was released are over
+    return ReleasedBlob.objects.collect(timezone.now() - get_sync_timeout())
+
+
+def _sync_path(email_server, account, path, deadline=None, stop=None):
+    _check_deadline(deadline, stop)
+    directory = path.path
+    status = email_server.status(directory)
+    uid_validity, uid_next = status.get('UIDVALIDITY'), status.get('UIDNEXT')
+    modseq = status.get('HIGHESTMODSEQ')
+    if uid_validity != path.uid_validity:
+        path.uid_validity = uid_validity
+        path.last_uid = 0
+        path.highest_modseq = None
+        EmailLink.objects.reset_uids(path)
+    else:
+        # The accounts removing the synced emails would unlink all of them
+        if modseq and path.highest_modseq and modseq != path.highest_modseq and not account.remove:
+            # Only the messages expunged since the last sync are reported
+            vanished = email_server.vanished(directory, path.highest_modseq,
+                                             uid_next - 1 if uid_next else path.last_uid)
+            metrics.inc('messages_vanished', EmailLink.objects.vanish(path, vanished))
+        if uid_next and path.last_uid >= uid_next - 1:
+            if modseq != path.highest_modseq:
+                path.highest_modseq = modseq
+                path.save(update_fields=['highest_modseq'])
+            return 0
+
+    # An interrupted run of the path continues from its checkpoint
+    run = SyncRun.objects.resume(account, path, uid_validity)
+    try:
+        before = datetime.date.today() - datetime.timedelta(weeks=account.weeks_before)
+        email_ids = email_server.search(directory=directory, before=before,
+                                        just_read=account.just_read, since_uid=run.checkpoint)
+        run.found(len(email_ids))
+        failed = _sync_emails(email_server, account, path, directory, email_ids, run=run, deadline=deadline,
+                              stop=stop)
+
+        if uid_next:
+            path.last_uid = _last_uid(email_server, directory, run.since_uid, uid_next,
+                                      before=before, just_read=account.just_read)
+        if failed:
+            # The failed FETCH commands are tried again on the next sync
+            path.last_uid = min(path.last_uid, failed - 1)
+        path.highest_modseq = modseq
+        path.save(update_fields=['uid_validity', 'last_uid', 'highest_modseq'])
+    except (SyncPaused, SoftTimeLimitExceeded):
+        run.finish(SyncRun.PAUSED)
+        raise
+    except Exception as error:
+        run.finish(SyncRun.FAILED, error=repr(error))
+        raise
+    run.finish()
+    return len(email_ids)
+
+
+def _sync_path_worker(pool, account, path, deadline=None, stop=None):
+    try:
+        with pool.connection() as email_server:
+            return _sync_path(email_server, account, path, deadline=deadline, stop=stop)
+    finally:
+        db_connection.close()
+
+
+@app.task
+def sync_account(account_pk, directory=None):
+    # With a directory only that path is synced, e.g. when the IDLE listener sees new emails
     account = EmailAccount.objects.get(pk=account_pk)
     if not account.sync:
         return
-    email_server = account.connector()
-    for directory in email_server.directories():
-        path, created = EmailPath.objects.get_or_create(account=account, path=directory)
-        if path.ignore or created:
-            continue
+    args = [account.pk] if directory is None else [account.pk, directory]
+    if not account.acquire_sync():
+        # The folder stays queued, the listener does not enqueue more syncs meanwhile
+        sync_account.apply_async(args=args, countdown=get_sync_retry())
+        return
+    if directory is not None:
+        account.dequeue_sync()
+    backlog = None
+    paused = False
+    time_limit = get_sync_time_limit()
+    registry = metrics.Registry()
+    try:
+        with metrics.collect(registry, account=account.pk, host=account.host.lower()):
+            with metrics.timer('sync'):
+                backlog = _sync_account(account, deadline=time.time() + time_limit if time_limit else None,
+                                        directory=directory)
+    except (SyncPaused, SoftTimeLimitExceeded):
+        paused = True
+    finally:
+        # The backlog orders the full syncs, a single path does not tell it
+        account.release_sync(backlog if directory is None else None)
+        metrics.publish(registry)
+    if paused:
+        # The remaining emails are synced by a new task from the checkpoints, once the lease is released
+        sync_account.apply_async(args=args)
 
-        before = datetime.date.today() - datetime.timedelta(weeks=account.weeks_before)
-        emails = email_server.get_emails(directory=directory, before=before,
-                                         just_read=account.just_read)
-        for email in emails:
-            email, created = Email.objects.get_or_create_from(email, account=account)
-            email.paths.add(path)
-            if account.remove:
-                email_server.mark_delete(email.server_id)  # email.delete()
-    if account.remove:
-        email_server.do_delete()
+
+def _sync_account(account, deadline=None, directory=None):
+    # The sessions stay open in the pool for the next tasks of the account
+    pool = account.connection_pool()
+    with pool.connection() as email_server:
+        # The removed emails are moved to the trash, syncing it would link and purge them again
+        trash = email_server.trash_target() if account.remove else None
+        paths = []
+        for name in [directory] if directory else email_server.directories():
+            if trash and name == trash:
+                continue
+            path, created = EmailPath.objects.get_or_create(account=account, path=name)
+            if path.ignore or created:
+                continue
+            paths.append(path)
+
+        # SQLite locks the whole database on write, the folder threads would fail with "database is locked"
+        if account.connections <= 1 or len(paths) <= 1 or db_connection.vendor == 'sqlite':
+            return sum(_sync_path(email_server, account, path, deadline=deadline) for path in paths)
+
+    stop = threading.Event()
+    workers = ThreadPool(min(account.connections, len(paths)))
+    try:
+        return sum(workers.map(metrics.bind(partial(_sync_path_worker, pool, account, deadline=deadline,
+                                                    stop=stop)), paths))
+    finally:
+        # SoftTimeLimitExceeded is raised on this thread, the others pause after their current chunk
+        stop.set()
+        workers.close()
+        workers.join()
+
+
+@worker_process_shutdown.connect
+def logout_sessions(**kwargs):
+    close_sessions()
+
+
+@worker_process_shutdown.connect
+def stop_parse_processes(**kwargs):
+    close_parse_pool()
@@ -4,6 +4,8 @@ from __future__ import unicode_literals
 from unittest import TestCase
 from mock import Mock, patch, call
 from email_backup.core.admin import *
+from email_backup.core.connector import ConnectionPool
+from six import BytesIO
 
 
 class AdminActionsTest(TestCase):
@@ -16,6 +18,7 @@ class AdminActionsTest(TestCase):
         open_mock = Mock()
         open_mock.directories.return_value = [directory]
         account.connector.return_value = open_mock
+        account.connection_pool.return_value = ConnectionPool(account.connector)
 
         sync_directories(modeladmin, request, queryset)
 
@@ -28,6 +31,8 @@ class AdminActionsTest(TestCase):
 
         self.assertEqual(objects_mock.get_or_create.call_count, 1)
         self.assertEqual(objects_mock.get_or_create.call_args, call(account=account, path=directory))
+        self.assertEqual(open_mock.close.call_count, 0)
+        self.assertEqual(account.connection_pool.return_value.idle, 1)
 
     def test_sync_accounts(self):
         modeladmin, request, queryset = Mock(), Mock(), Mock()
@@ -57,6 +62,22 @@ class AdminActionsTest(TestCase):
         self.assertEqual(queryset.update.call_count, 1)
         self.assertEqual(queryset.update.call_args, call(ignore=False))
 
+    @patch('email_backup.core.admin.SyncRun.objects')
+    def test_reset_paths(self, sync_runs_mock):
+        modeladmin, request, queryset = Mock(), Mock(), Mock()
+        reset_paths(modeladmin, request, queryset)
+
+        self.assertEqual(queryset.update.call_count, 1)
+        self.assertEqual(queryset.update.call_args, call(uid_validity=None, last_uid=0))
+        self.assertEqual(sync_runs_mock.filter.call_args, call(path__in=queryset))
+        self.assertEqual(sync_runs_mock.filter.return_value.cancel.call_count, 1)
+
+    def test_cancel_runs(self):
+        modeladmin, request, queryset = Mock(), Mock(), Mock()
+        cancel_runs(modeladmin, request, queryset)
+
+        self.assertEqual(queryset.cancel.call_count, 1)
+
 
 class EmailAdminTest(TestCase):
     def test_has_add_permission(self):
@@ -65,10 +86,116 @@ class EmailAdminTest(TestCase):
 
     def test_has_change_permission(self):
         page = EmailAdmin(Email, None)
-        self.assertFalse(page.has_change_permission(None))
+        self.assertFalse(page.has_change_permission(None, Mock()))
+
+    def test_has_change_permission_changelist(self):
+        page = EmailAdmin(Email, None)
+        request = Mock()
+        request.user.has_perm.return_value = True
+        self.assertTrue(page.has_change_permission(request))
+        self.assertEqual(request.user.has_perm.call_args, call('core.change_email'))
+        request.user.has_perm.return_value = False
+        self.assertFalse(page.has_change_permission(request))
+
+    def test_changelist(self):
+        page = EmailAdmin(Email, None)
+        self.assertEqual(page.get_changelist(None), EmailChangeList)
+        self.assertEqual(page.get_paginator(None, Email.objects.all(), 10).__class__, KeysetPaginator)
+
+    @patch('email_backup.core.admin.ChangeList.get_queryset')
+    def test_changelist_queryset(self, get_queryset_mock):
+        changelist = EmailChangeList.__new__(EmailChangeList)
+        queryset = changelist.get_queryset(None)
+        defer_mock = get_queryset_mock.return_value.defer
+        self.assertEqual(queryset, defer_mock.return_value.prefetch_related.return_value)
+        self.assertEqual(defer_mock.call_args, call('content', 'raw'))
+        self.assertEqual(defer_mock.return_value.prefetch_related.call_args, call('attachments'))
+
+    @patch('email_backup.core.admin.get_object_or_404')
+    def test_raw_view(self, get_object_mock):
+        page = EmailAdmin(Email, Mock())
+        page.has_change_permission = Mock(return_value=True)
+        email = get_object_mock.return_value
+        email.pk = 5
+        email.open_raw.return_value = BytesIO(b'Message')
+
+        response = page.raw_view(Mock(), '5')
+
+        self.assertEqual(get_object_mock.call_args, call(Email, pk='5'))
+        self.assertEqual(response['Content-Type'], 'message/rfc822')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="5.eml"')
+        self.assertEqual(b''.join(response.streaming_content), b'Message')
+
+    def test_raw_view_without_permission(self):
+        page = EmailAdmin(Email, Mock())
+        request = Mock()
+        request.user.has_perm.side_effect = lambda perm: perm != 'core.change_email'
+        request.user.has_module_perms.return_value = True
+        self.assertRaises(PermissionDenied, page.raw_view, request, '5')
+
+    @patch('email_backup.core.admin.reverse')
+    def test_raw_link(self, reverse_mock):
+        reverse_mock.return_value = '/admin/core/email/5/raw/'
+        page = EmailAdmin(Email, None)
+        obj = Mock(pk=5)
+        link = page.raw_link(obj)
+        self.assertEqual(reverse_mock.call_args, call('admin:core_email_raw', args=[5]))
+        self.assertIn('href="/admin/core/email/5/raw/"', link)
+
+    @patch('email_backup.core.admin.get_object_or_404')
+    def test_attachment_view(self, get_object_mock):
+        page = EmailAdmin(Email, Mock())
+        page.has_change_permission = Mock(return_value=True)
+        attachment = get_object_mock.return_value
+        attachment.filename = 'pdf "1".pdf'
+        attachment.content_type = 'application/pdf'
+        attachment.open.return_value = BytesIO(b'%PDF')
+
+        response = page.attachment_view(Mock(), '7')
+
+        self.assertEqual(get_object_mock.call_args, call(Attachment, pk='7'))
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="pdf 1.pdf"')
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF')
+
+    def test_attachment_view_without_permission(self):
+        page = EmailAdmin(Email, Mock())
+        request = Mock()
+        request.user.has_perm.side_effect = lambda perm: perm != 'core.change_email'
+        request.user.has_module_perms.return_value = True
+        self.assertRaises(PermissionDenied, page.attachment_view, request, '7')
+
+    @patch('email_backup.core.admin.reverse')
+    def test_attachment_links(self, reverse_mock):
+        reverse_mock.side_effect = lambda name, args: '/admin/core/email/attachment/{}/'.format(args[0])
+        page = EmailAdmin(Email, None)
+        obj = Mock(attaches=2)
+        obj.attachments.all.return_value = [Attachment(pk=1, filename='a.pdf'), Attachment(pk=2, filename='b<.pdf')]
+        links = page.attachment_links(obj)
+        self.assertEqual(links, '<a href="/admin/core/email/attachment/1/">a.pdf</a>, '
+                                '<a href="/admin/core/email/attachment/2/">b&lt;.pdf</a>')
+
+    def test_attachment_links_not_extracted(self):
+        page = EmailAdmin(Email, None)
+        obj = Mock(attaches=3)
+        obj.attachments.all.return_value = []
+        self.assertEqual(page.attachment_links(obj), 3)
+
 
+    def test_get_search_results(self):
+        page = EmailAdmin(Email, None)
+        queryset = Mock()
+        ret = page.get_search_results(None, queryset, 'hola mundo')
+        self.assertEqual(ret, (queryset.search.return_value, False))
+        self.assertEqual(queryset.search.call_args, call('hola mundo'))
 
 class EmailPathAdminTest(TestCase):
     def test_has_add_permission(self):
         page = EmailPathAdmin(EmailPath, None)
         self.assertFalse(page.has_add_permission(None))
+
+
+class SyncRunAdminTest(TestCase):
+    def test_has_add_permission(self):
+        page = SyncRunAdmin(SyncRun, None)
+        self.assertFalse(page.has_add_permission(None))
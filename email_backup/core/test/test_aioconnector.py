@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from mock import Mock, patch
+import imaplib
+import os
+import six
+
+if not six.PY2:  # pragma: no cover
+    import asyncio
+    from email_backup.core.aioconnector import *
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeServer(object):
+    def __init__(self, loop, *responses):
+        self.loop = loop
+        self.responses = list(responses)
+        self.commands = []
+        self.tag = None
+        self.pipelined = 0
+        self.connection = None
+        self.reader = asyncio.StreamReader(loop=loop)
+        self.reader.feed_data(b'* OK IMAP4rev1 ready\r\n')
+        self.writer = Mock()
+        self.writer.write.side_effect = self.write
+
+    def write(self, data):
+        line = data.decode('utf-8').rstrip('\r\n')
+        if line == 'DONE':
+            # Ends the IDLE command, the response completes its tag
+            tag, command = self.tag, line
+        else:
+            tag, command = line.split(' ', 1)
+        self.tag = tag
+        self.commands.append(command)
+        self.pipelined = max(self.pipelined, len(self.connection.pending))
+        response = self.responses.pop(0) if self.responses else b'$TAG OK\r\n'
+        self.loop.call_soon(self.reader.feed_data, response.replace(b'$TAG', tag.encode('ascii')))
+
+    def close(self):
+        self.loop.call_soon(self.reader.feed_eof)
+
+
+@skipIf(six.PY2, 'asyncio requires Python 3')
+class AsyncTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            self.run_async(server.connection.close())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def collect(self, iterator):
+        items = []
+        while True:
+            try:
+                items.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def server(self, *responses):
+        server = FakeServer(self.loop, *responses)
+        server.connection = AsyncIMAP4(server.reader, server.writer, loop=self.loop)
+        self.run_async(server.connection.start())
+        self.servers.append(server)
+        return server
+
+
+class AsyncIMAP4Test(AsyncTestCase):
+    def test_welcome(self):
+        server = self.server()
+        self.assertEqual(server.connection.welcome, '* OK IMAP4rev1 ready')
+
+    def test_wrong_welcome(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b'* BYE go away\r\n')
+        connection = AsyncIMAP4(reader, Mock(), loop=self.loop)
+        self.assertRaises(imaplib.IMAP4.error, self.run_async, connection.start())
+
+    def test_command(self):
+        server = self.server(b'* SEARCH 1 2 3\r\n$TAG OK SEARCH completed\r\n')
+        ok, data = self.run_async(server.connection.command('SEARCH', None, 'ALL'))
+        self.assertEqual((ok, data), ('OK', ['1 2 3']))
+        self.assertEqual(server.commands, ['SEARCH ALL'])
+
+    def test_command_literal(self):
+        server = self.server(
+            b'* 1 FETCH (UID 11 RFC822 {7}\r\nMessage)\r\n'
+            b'* 2 FETCH (RFC822 {2}\r\nMe UID 12)\r\n'
+            b'$TAG OK FETCH completed\r\n'
+        )
+        ok, data = self.run_async(server.connection.command('FETCH', '1:2', '(UID RFC822)'))
+        self.assertEqual(ok, 'OK')
+        self.assertEqual(data, [('1 (UID 11 RFC822 {7}', b'Message'), ')', ('2 (RFC822 {2}', b'Me'), ' UID 12)'])
+
+    def test_command_no_data(self):
+        server = self.server()
+        self.assertEqual(self.run_async(server.connection.command('NOOP')), ('OK', [None]))
+
+    def test_command_no(self):
+        server = self.server(b'$TAG NO [NONEXISTENT] Unknown Mailbox\r\n')
+        ok, data = self.run_async(server.connection.command('SELECT', '"Unknown"'))
+        self.assertEqual((ok, data), ('NO', ['[NONEXISTENT] Unknown Mailbox']))
+
+    def test_command_bad(self):
+        server = self.server(b'$TAG BAD Command unknown\r\n')
+        self.assertRaises(imaplib.IMAP4.error, self.run_async, server.connection.command('WRONG'))
+
+    def test_pipelined(self):
+        server = self.server(
+            b'* 1 EXISTS\r\n$TAG OK\r\n',
+            b'* 2 EXISTS\r\n$TAG OK\r\n',
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+        )
+        connection = server.connection
+        responses = self.run_async(asyncio.gather(
+            connection.command('NOOP', response='EXISTS'),
+            connection.command('NOOP', response='EXISTS'),
+            connection.command('NOOP', response='EXISTS'),
+        ))
+        self.assertEqual(server.pipelined, 3)
+        self.assertEqual(responses, [('OK', ['1']), ('OK', ['2']), ('OK', ['3'])])
+
+    def test_abort(self):
+        server = self.server(b'+ idling\r\n')
+        future = server.connection.command('IDLE')
+        server.close()
+        self.assertRaises(imaplib.IMAP4.abort, self.run_async, future)
+        self.assertRaises(imaplib.IMAP4.abort, server.connection.command, 'NOOP')
+
+    def test_bye(self):
+        server = self.server(b'* BYE Autologout\r\n')
+        self.assertRaises(imaplib.IMAP4.abort, self.run_async, server.connection.command('NOOP'))
+
+    def test_close(self):
+        server = self.server()
+        self.run_async(server.connection.close())
+        self.assertEqual(server.writer.close.call_count, 1)
+
+    def test_idle(self):
+        server = self.server(b'+ idling\r\n* 4 EXISTS\r\n', b'$TAG OK IDLE terminated\r\n')
+        self.assertEqual(self.run_async(server.connection.idle(timeout=5)), ('OK', ['4']))
+        self.assertEqual(server.commands, ['IDLE', 'DONE'])
+
+    def test_idle_timeout(self):
+        server = self.server(b'+ idling\r\n', b'$TAG OK IDLE terminated\r\n')
+        self.assertEqual(self.run_async(server.connection.idle(timeout=0.01)), ('OK', [None]))
+        self.assertEqual(server.commands, ['IDLE', 'DONE'])
+
+    def test_idle_rejected(self):
+        server = self.server(b'$TAG NO IDLE not allowed\r\n')
+        self.assertEqual(self.run_async(server.connection.idle(timeout=5)), ('NO', ['IDLE not allowed']))
+        self.assertEqual(server.commands, ['IDLE'])
+
+
+class AsyncEmailConnectorTest(AsyncTestCase):
+    def connector(self, *responses, **kwargs):
+        self.fake = self.server(*responses)
+        conn = AsyncEmailConnector('imap.host.test', 993, True, 'user', 'pass"word', **kwargs)
+        conn.connection = self.fake.connection
+        return conn
+
+    @patch('email_backup.core.aioconnector.AsyncIMAP4.connect')
+    def test_open(self, connect_mock):
+        server = self.server()
+        connect_mock.side_effect = asyncio.coroutine(lambda *args, **kwargs: server.connection)
+        conn = AsyncEmailConnector('imap.host.test', 993, True, 'user', 'pass"word')
+        self.run_async(conn.open())
+        self.assertEqual(connect_mock.call_args[0], ('imap.host.test', 993))
+        self.assertTrue(connect_mock.call_args[1]['ssl'])
+        self.assertEqual(server.commands, ['LOGIN "user" "pass\\"word"'])
+
+    @patch('email_backup.core.aioconnector.AsyncIMAP4.connect')
+    def test_open_wrong_login(self, connect_mock):
+        server = self.server(b'$TAG NO [AUTHENTICATIONFAILED] Invalid credentials\r\n')
+        connect_mock.side_effect = asyncio.coroutine(lambda *args, **kwargs: server.connection)
+        conn = AsyncEmailConnector('imap.host.test', 993, True, 'user', 'password')
+        self.assertRaises(imaplib.IMAP4.error, self.run_async, conn.open())
+
+    @patch('email_backup.core.aioconnector.AsyncIMAP4.connect')
+    def test_open_qresync(self, connect_mock):
+        server = self.server(b'$TAG OK\r\n', b'* CAPABILITY IMAP4rev1 QRESYNC\r\n$TAG OK\r\n')
+        connect_mock.side_effect = asyncio.coroutine(lambda *args, **kwargs: server.connection)
+        conn = AsyncEmailConnector('imap.host.test', 993, True, 'user', 'password', use_uid=True)
+        self.run_async(conn.open())
+        self.assertEqual(server.commands[1:], ['CAPABILITY', 'ENABLE QRESYNC'])
+        self.assertTrue(conn._qresync)
+
+    def test_close(self):
+        conn = self.connector()
+        self.run_async(conn.close())
+        self.assertEqual(self.fake.commands, ['CLOSE', 'LOGOUT'])
+        self.assertIsNone(conn.connection)
+        self.assertEqual(self.fake.writer.close.call_count, 1)
+
+    def test_close_selected(self):
+        conn = self.connector()
+        conn._selected = ('INBOX', False)
+        self.run_async(conn.close())
+        self.assertEqual(self.fake.commands, ['LOGOUT'])
+
+    def test_not_open(self):
+        conn = AsyncEmailConnector('imap.host.test', 993, True, 'user', 'password')
+        self.assertEqual(self.run_async(conn.directories()), [])
+        self.assertEqual(self.run_async(conn.search('INBOX')), [])
+        self.assertEqual(self.collect(conn.fetch('INBOX', [1])), [])
+        self.assertEqual(self.run_async(conn.message_ids('INBOX', [1])), [])
+        self.assertFalse(self.run_async(conn.delete('INBOX', [1])))
+        self.assertIsNone(self.run_async(conn.read(1)))
+        self.assertEqual(self.run_async(conn.chdir('INBOX')), 0)
+        self.assertFalse(self.run_async(conn.has_capability('IDLE')))
+        self.assertEqual(self.run_async(conn.idle('INBOX')), [])
+        self.assertIsNone(self.run_async(conn.trash()))
+        self.assertEqual(self.run_async(conn.vanished('INBOX', 10, 20)), [])
+        self.assertFalse(self.run_async(conn.noop()))
+
+    def test_directories(self):
+        conn = self.connector(
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n'
+            b'* LIST (\\HasNoChildren) "/" "[Gmail]/All Mail"\r\n'
+            b'$TAG OK LIST completed\r\n'
+        )
+        self.assertEqual(self.run_async(conn.directories()), ['INBOX', '[Gmail]/All Mail'])
+        self.assertEqual(self.fake.commands, ['LIST "" *'])
+
+    def test_trash(self):
+        conn = self.connector(
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n'
+            b'* LIST (\\HasNoChildren \\Trash) "/" "[Gmail]/Trash"\r\n'
+            b'$TAG OK LIST completed\r\n'
+        )
+        self.assertEqual(self.run_async(conn.trash()), '[Gmail]/Trash')
+        self.assertEqual(self.run_async(conn.trash()), '[Gmail]/Trash')
+        self.assertEqual(self.fake.commands, ['LIST "" *'])
+
+    def test_trash_missing(self):
+        conn = self.connector(b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n$TAG OK\r\n')
+        self.assertIsNone(self.run_async(conn.trash()))
+
+    def test_vanished(self):
+        conn = self.connector(
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            b'* VANISHED (EARLIER) 3:5,9\r\n* 1 FETCH (UID 2 MODSEQ (951))\r\n$TAG OK\r\n',
+            use_uid=True
+        )
+        conn._qresync = True
+        self.assertEqual(self.run_async(conn.vanished('INBOX', 900, 20)), [3, 4, 5, 9])
+        self.assertEqual(self.fake.commands[1], 'UID FETCH 1:20 (UID) (CHANGEDSINCE 900 VANISHED)')
+
+    def test_vanished_without_qresync(self):
+        conn = self.connector(use_uid=True)
+        self.assertEqual(self.run_async(conn.vanished('INBOX', 900, 20)), [])
+        self.assertEqual(self.fake.commands, [])
+
+    def test_vanished_error(self):
+        conn = self.connector(b'* 3 EXISTS\r\n$TAG OK\r\n', b'$TAG NO Not allowed\r\n', use_uid=True)
+        conn._qresync = True
+        self.assertEqual(self.run_async(conn.vanished('INBOX', 900, 20)), [])
+
+    def test_noop(self):
+        conn = self.connector(b'$TAG OK\r\n', b'$TAG NO\r\n')
+        self.assertTrue(self.run_async(conn.noop()))
+        self.assertFalse(self.run_async(conn.noop()))
+        self.assertEqual(self.fake.commands, ['NOOP', 'NOOP'])
+
+    def test_noop_dropped(self):
+        conn = self.connector(b'* BYE Autologout\r\n')
+        self.assertFalse(self.run_async(conn.noop()))
+
+    def test_status(self):
+        conn = self.connector(
+            b'* CAPABILITY IMAP4rev1\r\n$TAG OK\r\n',
+            b'* STATUS "INBOX" (UIDVALIDITY 3857529045 UIDNEXT 4392)\r\n$TAG OK\r\n'
+        )
+        self.assertEqual(self.run_async(conn.status('INBOX')), {'UIDVALIDITY': 3857529045, 'UIDNEXT': 4392})
+        self.assertEqual(self.fake.commands, ['CAPABILITY', 'STATUS "INBOX" (UIDVALIDITY UIDNEXT)'])
+
+    def test_status_modseq(self):
+        conn = self.connector(
+            b'* CAPABILITY IMAP4rev1 CONDSTORE\r\n$TAG OK\r\n',
+            b'* STATUS "INBOX" (UIDVALIDITY 3 UIDNEXT 43 HIGHESTMODSEQ 951)\r\n$TAG OK\r\n'
+        )
+        self.assertEqual(self.run_async(conn.status('INBOX')),
+                         {'UIDVALIDITY': 3, 'UIDNEXT': 43, 'HIGHESTMODSEQ': 951})
+        self.assertEqual(self.fake.commands[-1], 'STATUS "INBOX" (UIDVALIDITY UIDNEXT HIGHESTMODSEQ)')
+
+    def test_chdir(self):
+        conn = self.connector(b'* 172 EXISTS\r\n* 1 RECENT\r\n$TAG OK [READ-WRITE] SELECT completed\r\n')
+        self.assertEqual(self.run_async(conn.chdir('[Gmail]/All Mail')), 172)
+        self.assertEqual(self.fake.commands, ['SELECT "[Gmail]/All Mail"'])
+
+    def test_chdir_selected(self):
+        conn = self.connector(b'* 2 EXISTS\r\n$TAG OK\r\n', b'* 3 EXISTS\r\n$TAG OK\r\n', readonly=True)
+        self.assertEqual(self.run_async(conn.chdir('INBOX')), 2)
+        self.assertEqual(self.run_async(conn.chdir('INBOX')), 2)
+        self.assertEqual(self.run_async(conn.chdir('INBOX', readonly=False)), 3)
+        self.assertEqual(self.fake.commands, ['EXAMINE "INBOX"', 'SELECT "INBOX"'])
+
+    def test_chdir_wrong(self):
+        conn = self.connector(b'$TAG NO Mailbox does not exist\r\n')
+        self.assertEqual(self.run_async(conn.chdir('Unknown')), 0)
+
+    def test_search(self):
+        conn = self.connector(
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            b'* SEARCH 1 3\r\n$TAG OK\r\n',
+        )
+        self.assertEqual(self.run_async(conn.search('INBOX', just_read=True)), ['1', '3'])
+        self.assertEqual(self.fake.commands, ['SELECT "INBOX"', 'SEARCH (SEEN)'])
+
+    def test_search_all(self):
+        conn = self.connector(b'* 3 EXISTS\r\n$TAG OK\r\n')
+        self.assertEqual(self.run_async(conn.search('INBOX')), [1, 2, 3])
+
+    def test_search_uid(self):
+        conn = self.connector(
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            b'* SEARCH 10 12\r\n$TAG OK\r\n',
+            use_uid=True
+        )
+        self.assertEqual(self.run_async(conn.search('INBOX', since_uid=11)), ['12'])
+        self.assertEqual(self.fake.commands, ['SELECT "INBOX"', 'UID SEARCH (UID 12:*)'])
+
+    @patch('email_backup.core.aioconnector.get_fetch_window', Mock(return_value=2))
+    def test_fetch_pipelined(self):
+        with open(os.path.join(BASE_DIR, 'files', 'plain_email.eml'), 'rb') as eml:
+            plain = eml.read()
+        literal = '{{{}}}'.format(len(plain)).encode('ascii')
+        conn = self.connector(
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            b'* 1 FETCH (UID 11 RFC822 ' + literal + b'\r\n' + plain + b')\r\n$TAG OK\r\n',
+            b'* 2 FETCH (UID 12 RFC822 ' + literal + b'\r\n' + plain + b')\r\n$TAG OK\r\n',
+            b'* 3 FETCH (UID 13 RFC822 ' + literal + b'\r\n' + plain + b')\r\n$TAG OK\r\n',
+            use_uid=True
+        )
+        emails = self.collect(conn.fetch('INBOX', [11, 12, 13], chunk_size=1))
+        self.assertEqual(self.fake.commands, [
+            'SELECT "INBOX"', 'UID FETCH 11 (UID RFC822)', 'UID FETCH 12 (UID RFC822)', 'UID FETCH 13 (UID RFC822)'
+        ])
+        # The third chunk waits for the first one
+        self.assertEqual(self.fake.pipelined, 2)
+        self.assertEqual([email.id for email in emails], [11, 12, 13])
+        self.assertEqual(emails[0].raw, plain)
+        self.assertEqual(emails[0].headers.size, len(plain))
+        self.assertEqual(emails[0].get('Message-Id'), '<plain_id@email.test>')
+
+    def test_fetch_error(self):
+        conn = self.connector(b'* 3 EXISTS\r\n$TAG OK\r\n', b'$TAG NO Invalid messageset\r\n')
+        self.assertEqual(self.collect(conn.fetch('INBOX', [1])), [])
+
+    def test_get_emails(self):
+        conn = self.connector(
+            b'* 1 EXISTS\r\n$TAG OK\r\n',
+            b'* 1 FETCH (UID 11 RFC822 {19}\r\nSubject: Test\r\n\r\nBody)\r\n$TAG OK\r\n',
+        )
+        emails = self.collect(self.run_async(conn.get_emails('INBOX')))
+        self.assertEqual(self.fake.commands, ['SELECT "INBOX"', 'FETCH 1 (UID RFC822)'])
+        self.assertEqual([email.get('subject') for email in emails], ['Test'])
+
+    def test_message_ids(self):
+        conn = self.connector(
+            b'* 2 EXISTS\r\n$TAG OK\r\n',
+            b'* 1 FETCH (UID 11 BODY[HEADER.FIELDS (MESSAGE-ID)] {29}\r\nMessage-ID: <a@email.test>\r\n\r\n)\r\n'
+            b'* 2 FETCH (UID 12 BODY[HEADER.FIELDS (MESSAGE-ID)] {2}\r\n\r\n)\r\n$TAG OK\r\n',
+            b'* 2 FETCH (UID 12 BODY[HEADER] {17}\r\nSubject: Test\r\n\r\n)\r\n$TAG OK\r\n',
+        )
+        self.assertEqual(self.run_async(conn.message_ids('INBOX', [1, 2])), [
+            (1, '<a@email.test>'), (2, EmailHeader.parse('Subject: Test\r\n\r\n').message_id)
+        ])
+        self.assertEqual(self.fake.commands[-2:], ['FETCH 1:2 (UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])',
+                                                   'FETCH 2 (UID BODY.PEEK[HEADER])'])
+
+    def test_read(self):
+        conn = self.connector(b'* 1 FETCH (RFC822 {7}\r\nMessage)\r\n$TAG OK\r\n')
+        self.assertEqual(self.run_async(conn.read(1)), b'Message')
+        self.assertEqual(self.fake.commands, ['FETCH 1 (RFC822)'])
+
+    def test_header(self):
+        conn = self.connector(b'* 1 FETCH (UID 5 BODY[HEADER] {6}\r\nHeader)\r\n$TAG OK\r\n', use_uid=True)
+        self.assertEqual(self.run_async(conn.header(5)), b'Header')
+        self.assertEqual(self.fake.commands, ['UID FETCH 5 (BODY.PEEK[HEADER])'])
+
+    def test_get_uid(self):
+        conn = self.connector(b'* 1 FETCH (UID 33)\r\n$TAG OK\r\n')
+        self.assertEqual(self.run_async(conn.get_uid(1)), 33)
+        conn.use_uid = True
+        self.assertEqual(self.run_async(conn.get_uid(33)), 33)
+        self.assertEqual(self.fake.commands, ['FETCH 1 (UID)'])
+
+    def test_has_capability(self):
+        conn = self.connector(b'* CAPABILITY IMAP4rev1 IDLE\r\n$TAG OK\r\n')
+        self.assertTrue(self.run_async(conn.has_capability('idle')))
+        self.assertFalse(self.run_async(conn.has_capability('QRESYNC')))
+        self.assertEqual(self.fake.commands, ['CAPABILITY'])
+
+    def test_idle(self):
+        conn = self.connector(
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            b'+ idling\r\n* 4 EXISTS\r\n',
+            b'$TAG OK\r\n',
+            readonly=True
+        )
+        self.assertEqual(self.run_async(conn.idle('INBOX', timeout=5)), [4])
+        self.assertEqual(self.fake.commands, ['EXAMINE "INBOX"', 'IDLE', 'DONE'])
+
+    def test_idle_wrong(self):
+        conn = self.connector(b'* 3 EXISTS\r\n$TAG OK\r\n', b'$TAG NO IDLE not allowed\r\n')
+        self.assertRaises(imaplib.IMAP4.error, self.run_async, conn.idle('INBOX'))
+
+    def test_delete(self):
+        conn = self.connector(use_uid=True)
+        self.run_async(asyncio.gather(conn.mark_delete(11), conn.mark_delete(12)))
+        self.run_async(conn.mark_delete(0))
+        self.run_async(conn.do_delete())
+        self.assertEqual(sorted(self.fake.commands[:2]),
+                         ['UID STORE 11 +FLAGS \\Deleted', 'UID STORE 12 +FLAGS \\Deleted'])
+        self.assertEqual(self.fake.commands[2:], ['EXPUNGE'])
+        self.assertEqual(self.fake.pipelined, 2)
+
+    def test_delete_chunks(self):
+        conn = self.connector(b'$TAG OK\r\n', b'* 3 EXISTS\r\n$TAG OK\r\n', use_uid=True)
+        self.assertTrue(self.run_async(conn.delete('INBOX', [11, 12, 13], chunk_size=2)))
+        self.assertFalse(self.run_async(conn.delete('INBOX', [])))
+        self.assertEqual(self.fake.commands, [
+            'CAPABILITY', 'SELECT "INBOX"',
+            'UID STORE 11:12 +FLAGS.SILENT (\\Deleted)', 'UID STORE 13 +FLAGS.SILENT (\\Deleted)'
+        ])
+        self.assertEqual(self.fake.pipelined, 2)
+
+    def test_delete_move(self):
+        conn = self.connector(
+            b'* CAPABILITY IMAP4rev1 MOVE UIDPLUS\r\n$TAG OK\r\n',
+            b'* LIST (\\HasNoChildren \\Trash) "/" "Trash"\r\n$TAG OK\r\n',
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            use_uid=True
+        )
+        self.assertFalse(self.run_async(conn.delete('INBOX', [11, 12, 13], chunk_size=2)))
+        self.assertEqual(self.fake.commands[2:], [
+            'SELECT "INBOX"', 'UID MOVE 11:12 "Trash"', 'UID MOVE 13 "Trash"'
+        ])
+
+    def test_delete_uidplus(self):
+        conn = self.connector(
+            b'* CAPABILITY IMAP4rev1 UIDPLUS\r\n$TAG OK\r\n',
+            b'* 3 EXISTS\r\n$TAG OK\r\n',
+            use_uid=True
+        )
+        self.assertFalse(self.run_async(conn.delete('INBOX', [11, 12])))
+        self.assertEqual(self.fake.commands[1:], [
+            'SELECT "INBOX"', 'UID STORE 11:12 +FLAGS.SILENT (\\Deleted)', 'UID EXPUNGE 11:12'
+        ])
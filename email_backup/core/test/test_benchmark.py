@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+from unittest import TestCase
+from django.db import connection
+from django.test import TestCase as DBTestCase
+from django.test.utils import override_settings
+from mock import patch
+from email_backup.core.benchmark import *
+from email_backup.core.fakeimap import generate_mailboxes
+from email_backup.core.models import Email, EmailAccount
+
+
+class QueryCounterTest(DBTestCase):
+    def test_count(self):
+        with QueryCounter() as queries:
+            EmailAccount.objects.count()
+            list(EmailAccount.objects.all())
+        EmailAccount.objects.count()
+        self.assertEqual(queries.count, 2)
+        self.assertNotIsInstance(connection.queries_log, type(queries._logs[0]))
+
+
+class PeakMemoryTest(TestCase):
+    @patch('email_backup.core.benchmark._max_rss', return_value=1024)
+    def test_rss(self, max_rss_mock):
+        with PeakMemory() as memory:
+            pass
+        self.assertEqual(memory.peak, 1024)
+
+    @patch('email_backup.core.benchmark.tracemalloc')
+    def test_trace(self, tracemalloc_mock):
+        tracemalloc_mock.get_traced_memory.return_value = (10, 2048)
+        with PeakMemory(trace=True) as memory:
+            self.assertEqual(tracemalloc_mock.start.call_count, 1)
+        self.assertEqual(memory.peak, 2048)
+        self.assertEqual(tracemalloc_mock.stop.call_count, 1)
+
+
+class BenchmarkResultTest(TestCase):
+    def test_rates(self):
+        result = BenchmarkResult(messages=10, emails=8, seconds=2.0, queries=0, peak_memory=0, commands={})
+        self.assertEqual(result.throughput, 4)
+        self.assertEqual(result.latency, 0.25)
+
+    def test_empty(self):
+        result = BenchmarkResult(messages=0, emails=0, seconds=0, queries=0, peak_memory=0, commands={})
+        self.assertEqual(result.throughput, 0)
+        self.assertEqual(result.latency, 0)
+
+
+class RunBenchmarkTest(DBTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_run(self):
+        mailboxes = generate_mailboxes(emails=30, folders=2, attachments=0.2, attachment_size=1024)
+        with override_settings(MEDIA_ROOT=self.media_root, EMAIL_BACKUP_SYNC_TIME_LIMIT=0):
+            result = run_benchmark(mailboxes)
+        self.assertEqual(result.messages, 30)
+        self.assertEqual(result.emails, 30)
+        self.assertEqual(Email.objects.count(), 30)
+        self.assertGreater(result.seconds, 0)
+        self.assertGreater(result.queries, 0)
+        self.assertGreater(result.peak_memory, 0)
+        self.assertEqual(result.commands['FETCH messages'], 60)
+        self.assertEqual(result.commands['LOGIN'], 1)
@@ -5,16 +5,44 @@ from unittest import TestCase
 from mock import Mock, patch, call
 from email_backup.core.connector import (
     get_email_content,
+    get_content_max_length,
+    html_to_text,
+    HTMLText,
+    CONTENT_MAX_LENGTH,
+    chunks,
+    message_set,
+    parse_fetch,
+    quote,
+    parse_text_parts,
+    is_attachment,
+    iter_attachments,
+    EmailHeader,
+    synthetic_message_id,
+    parse_message_id,
+    _native,
+    spool_literal,
+    RawMessage,
     Email,
-    EmailConnectorInterface
+    EmailConnectorInterface,
+    ConnectionPool,
+    SessionCache,
+    get_connection_pool,
+    get_session_cache_size,
+    get_session_keepalive,
+    get_session_max_idle,
+    SESSION_CACHE_SIZE,
+    SESSION_KEEPALIVE,
+    SESSION_MAX_IDLE
 )
-from email.parser import Parser
+from email.parser import HeaderParser, Parser
 from datetime import date, datetime
 import binascii
+import hashlib
 import imaplib
 import locale
 import six
 import os
+import time
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -45,6 +73,402 @@ class GetEmailContentTest(TestCase):
         self.assertEqual(email_content, read_content)
 
 
+    def _parse(self, content):
+        return Parser().parsestr(content if six.PY2 else content.decode('latin-1'))
+
+    def test_none(self):
+        self.assertEqual(get_email_content(None), '')
+
+    def test_prefer_plain(self):
+        email = self._parse(
+            b'Content-Type: multipart/alternative; boundary="b"\r\n\r\n'
+            b'--b\r\nContent-Type: text/html; charset="UTF-8"\r\n\r\n<p>HTML body</p>\r\n'
+            b'--b\r\nContent-Type: text/plain; charset="UTF-8"\r\n\r\nPlain body\r\n'
+            b'--b--\r\n'
+        )
+        self.assertEqual(get_email_content(email), 'Plain body')
+
+    def test_html(self):
+        email = self._parse(
+            b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+            b'--b\r\nContent-Type: text/plain\r\nContent-Disposition: attachment; filename="a.txt"\r\n\r\n'
+            b'Attached text\r\n'
+            b'--b\r\nContent-Type: text/plain\r\n\r\n \r\n'
+            b'--b\r\nContent-Type: text/html; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+            b'<p>Caf=C3=A9 &amp; <b>t=\r\nea</b></p>\r\n'
+            b'--b--\r\n'
+        )
+        self.assertEqual(get_email_content(email), u'Caf\xe9 & tea')
+
+    def test_quoted_printable(self):
+        email = self._parse(
+            b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+            b'Caf=C3=A9 long =\r\nline'
+        )
+        self.assertEqual(get_email_content(email), u'Caf\xe9 long line')
+
+    def test_charset(self):
+        email = self._parse(
+            b'Content-Type: text/plain; charset=ISO-8859-1\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+            b'Q2Fm6Q==\r\n'
+        )
+        self.assertEqual(get_email_content(email), u'Caf\xe9')
+
+    def test_without_charset(self):
+        self.assertEqual(get_email_content(self._parse(b'Subject: Test\r\n\r\nCaf\xc3\xa9')), u'Caf\xe9')
+        self.assertEqual(get_email_content(self._parse(b'Subject: Test\r\n\r\nCaf\xe9')), u'Caf\xe9')
+
+    def test_unknown_charset(self):
+        email = self._parse(b'Content-Type: text/plain; charset="x-unknown"\r\n\r\nCaf\xc3\xa9')
+        self.assertEqual(get_email_content(email), u'Caf\xe9')
+
+    def test_other_text(self):
+        email = self._parse(b'Content-Type: text/calendar\r\n\r\nBEGIN:VCALENDAR')
+        self.assertEqual(get_email_content(email), 'BEGIN:VCALENDAR')
+
+    def test_without_text(self):
+        email = self._parse(b'Content-Type: image/png\r\nContent-Transfer-Encoding: base64\r\n\r\niVBORw0KGgo=')
+        self.assertEqual(get_email_content(email), '')
+
+    def test_max_length(self):
+        email = self._parse(b'Subject: Test\r\n\r\n' + b'a' * 100)
+        self.assertEqual(get_email_content(email, max_length=10), 'a' * 10)
+        self.assertEqual(get_email_content(email, max_length=0), 'a' * 100)
+
+    @patch('email_backup.core.connector.get_content_max_length', Mock(return_value=5))
+    def test_max_length_settings(self):
+        email = self._parse(b'Content-Type: text/html\r\n\r\n<p>' + b'word ' * 10 + b'</p>')
+        self.assertEqual(get_email_content(email), 'word ')
+
+
+class HtmlToTextTest(TestCase):
+    def test_html_to_text(self):
+        html = (
+            '<html><head><title>Title</title><style>p {color: red}</style></head><body>'
+            '<p>First  \n paragraph</p><p>Second<br>line&amp;more &#233;&#x41;</p><script>var a = 1;</script>'
+            '<ul><li>one</li><li>two</li></ul></body></html>'
+        )
+        self.assertEqual(html_to_text(html), u'First paragraph\n\nSecond\nline&more \xe9A\n\none\n\ntwo')
+
+    def test_self_closing(self):
+        self.assertEqual(html_to_text('one<br/>two<script/>three'), 'one\ntwothree')
+
+    def test_empty(self):
+        self.assertEqual(html_to_text(''), '')
+
+    @patch('email_backup.core.connector.HTML_CHUNK_SIZE', 16)
+    @patch('email_backup.core.connector.HTMLText.feed', autospec=True, side_effect=HTMLText.feed)
+    def test_max_length(self, feed_mock):
+        html = '<p>word</p>' * 100
+        self.assertEqual(html_to_text(html, max_length=10), 'word\n\nword')
+        self.assertLess(feed_mock.call_count, 10)
+
+
+class ContentMaxLengthTest(TestCase):
+    @patch('email_backup.core.connector.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_CONTENT_MAX_LENGTH
+        self.assertEqual(get_content_max_length(), CONTENT_MAX_LENGTH)
+
+    @patch('email_backup.core.connector.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_CONTENT_MAX_LENGTH = 100
+        self.assertEqual(get_content_max_length(), 100)
+
+
+class SessionSettingsTest(TestCase):
+    @patch('email_backup.core.connector.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_SESSION_CACHE_SIZE
+        del settings_mock.EMAIL_BACKUP_SESSION_KEEPALIVE
+        del settings_mock.EMAIL_BACKUP_SESSION_MAX_IDLE
+        self.assertEqual(get_session_cache_size(), SESSION_CACHE_SIZE)
+        self.assertEqual(get_session_keepalive(), SESSION_KEEPALIVE)
+        self.assertEqual(get_session_max_idle(), SESSION_MAX_IDLE)
+
+    @patch('email_backup.core.connector.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_SESSION_CACHE_SIZE = 2
+        settings_mock.EMAIL_BACKUP_SESSION_KEEPALIVE = 60
+        settings_mock.EMAIL_BACKUP_SESSION_MAX_IDLE = 600
+        self.assertEqual(get_session_cache_size(), 2)
+        self.assertEqual(get_session_keepalive(), 60)
+        self.assertEqual(get_session_max_idle(), 600)
+
+
+class ChunksTest(TestCase):
+    def test_empty(self):
+        self.assertEqual(list(chunks([], 2)), [])
+
+    def test_exact(self):
+        self.assertEqual(list(chunks(range(4), 2)), [[0, 1], [2, 3]])
+
+    def test_remainder(self):
+        self.assertEqual(list(chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+
+class MessageSetTest(TestCase):
+    def test_single(self):
+        self.assertEqual(message_set([5]), '5')
+
+    def test_range(self):
+        self.assertEqual(message_set(range(1, 501)), '1:500')
+
+    def test_mixed(self):
+        self.assertEqual(message_set(['10', '1', '2', '3', '7', '11']), '1:3,7,10:11')
+
+
+class QuoteTest(TestCase):
+    def test_quote(self):
+        self.assertEqual(quote('INBOX'), '"INBOX"')
+        self.assertEqual(quote('pa"ss\\word'), '"pa\\"ss\\\\word"')
+
+
+class ParseFetchTest(TestCase):
+    def test_parse(self):
+        data = [
+            ('1 (RFC822 {9}', 'Message 1'),
+            ')',
+            ('12 (RFC822 {10}', 'Message 12'),
+            ')',
+        ]
+        self.assertEqual(list(parse_fetch(data)), [(1, None, None, 'Message 1'), (12, None, None, 'Message 12')])
+
+    def test_parse_uid(self):
+        data = [
+            ('1 (UID 101 RFC822 {9}', 'Message 1'),
+            ')',
+            ('2 (RFC822 {9}', 'Message 2'),
+            ' UID 102)',
+            ('3 (UID 103 RFC822 {9}', 'Message 3'),
+        ]
+        self.assertEqual(list(parse_fetch(data)),
+                         [(1, 101, None, 'Message 1'), (2, 102, None, 'Message 2'), (3, 103, None, 'Message 3')])
+
+    def test_parse_size(self):
+        data = [
+            ('1 (UID 101 RFC822.SIZE 9 BODY[HEADER] {9}', 'Message 1'),
+            ')',
+            ('2 (UID 102 BODY[HEADER] {9}', 'Message 2'),
+            ' RFC822.SIZE 10)',
+        ]
+        self.assertEqual(list(parse_fetch(data)), [(1, 101, 9, 'Message 1'), (2, 102, 10, 'Message 2')])
+
+    def test_parse_empty(self):
+        self.assertEqual(list(parse_fetch(None)), [])
+        self.assertEqual(list(parse_fetch([None])), [])
+
+    def test_parse_unknown(self):
+        data = [('* FLAGS (\\Seen)', 'Message'), ')']
+        self.assertEqual(list(parse_fetch(data)), [])
+
+
+class RawMessageTest(TestCase):
+    def test_write(self):
+        message = RawMessage(max_size=4)
+        message.write(b'Subject: Test\r\n')
+        message.write(b'\r\nBody\r\n')
+        self.assertEqual(len(message), 23)
+        self.assertEqual(message.digest, hashlib.sha512(b'Subject: Test\r\n\r\nBody\r\n').hexdigest())
+        self.assertEqual(list(message), [b'Subject: Test\r\n', b'\r\n', b'Body\r\n'])
+        message.seek(0)
+        self.assertEqual(message.read(), b'Subject: Test\r\n\r\nBody\r\n')
+        message.close()
+
+    def test_empty(self):
+        message = RawMessage()
+        self.assertFalse(message)
+        self.assertEqual(message.digest, hashlib.sha512(b'').hexdigest())
+
+
+@patch('email_backup.core.connector.READ_CHUNK_SIZE', 4)
+@patch('email_backup.core.connector.LITERAL_SPOOL_SIZE', 8)
+class SpoolLiteralTest(TestCase):
+    def setUp(self):
+        self.connection = Mock()
+        self.data = six.BytesIO(b'Subject: Test\r\n')
+        self.read = Mock(side_effect=lambda connection, size: self.data.read(size))
+
+    def test_small(self):
+        self.assertEqual(spool_literal(self.read, self.connection, 7), b'Subject')
+        self.assertEqual(self.read.call_args, call(self.connection, 7))
+
+    def test_large(self):
+        message = spool_literal(self.read, self.connection, 15)
+        self.assertIsInstance(message, RawMessage)
+        self.assertEqual(len(message), 15)
+        self.assertEqual(message.read(), b'Subject: Test\r\n')
+        self.assertEqual(self.read.call_count, 4)
+        self.assertEqual(self.read.call_args, call(self.connection, 3))
+
+    def test_short_read(self):
+        message = spool_literal(self.read, self.connection, 20)
+        self.assertEqual(len(message), 15)
+
+
+class ParseTextPartsTest(TestCase):
+    def _raw(self, content):
+        message = RawMessage()
+        message.write(content)
+        return message
+
+    def test_multipart(self):
+        with open(os.path.join(BASE_DIR, 'files', 'multi_email.eml'), 'rb') as eml:
+            content = eml.read()
+        expected = Parser().parsestr(content.decode('latin-1'))
+        email = parse_text_parts(self._raw(content))
+        self.assertEqual(email['Message-ID'], expected['Message-ID'])
+        self.assertEqual(len(email.get_payload()), len(expected.get_payload()))
+        self.assertEqual(get_email_content(email), get_email_content(expected))
+        attach = email.get_payload()[1]
+        self.assertEqual(attach.get_filename(), 'pdf.pdf')
+        self.assertEqual(attach.get_payload(), '')
+
+    def test_plain(self):
+        with open(os.path.join(BASE_DIR, 'files', 'plain_email.eml'), 'rb') as eml:
+            content = eml.read()
+        email = parse_text_parts(self._raw(content))
+        expected = Parser().parsestr(content.decode('latin-1'))
+        self.assertEqual(email.get_payload(), expected.get_payload())
+
+    def test_nested_message(self):
+        content = (
+            b'Content-Type: multipart/mixed; boundary="outer"\r\n\r\n'
+            b'--outer\r\nContent-Type: message/rfc822\r\n\r\n'
+            b'Subject: Inner\r\nContent-Type: image/png\r\n\r\nPNGDATA\r\n'
+            b'--outer--\r\n'
+        )
+        email = parse_text_parts(self._raw(content))
+        inner = email.get_payload()[0].get_payload()[0]
+        self.assertEqual(inner['Subject'], 'Inner')
+        self.assertEqual(inner.get_payload(), '')
+
+    def test_headers_only(self):
+        email = parse_text_parts(self._raw(b'Subject: Test\r\n'))
+        self.assertEqual(email['Subject'], 'Test')
+
+
+class IterAttachmentsTest(TestCase):
+    def _attachments(self, content):
+        return [(filename, content_type, data.read())
+                for filename, content_type, data in iter_attachments(six.BytesIO(content))]
+
+    def test_multipart(self):
+        with open(os.path.join(BASE_DIR, 'files', 'multi_email.eml'), 'rb') as eml:
+            content = eml.read()
+        pdf = Parser().parsestr(content.decode('latin-1')).get_payload()[1].get_payload(decode=True)
+        self.assertEqual(self._attachments(content), [('pdf.pdf', 'application/pdf', pdf)])
+
+    def test_spooled(self):
+        message = RawMessage()
+        message.write(b'Content-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+                      b'AAEC\r\nAw==\r\n')
+        (filename, content_type, data), = iter_attachments(message)
+        self.assertEqual((filename, content_type, data.read()), ('', 'application/octet-stream', b'\x00\x01\x02\x03'))
+        self.assertEqual(data.digest, hashlib.sha512(b'\x00\x01\x02\x03').hexdigest())
+
+    def test_encodings(self):
+        content = (
+            b'Content-Type: multipart/mixed; boundary="b"\r\n\r\npreamble\r\n'
+            b'--b\r\nContent-Type: text/plain\r\n\r\nBody\r\n'
+            b'--b\r\nContent-Type: text/csv\r\nContent-Disposition: attachment; filename="a.csv"\r\n'
+            b'Content-Transfer-Encoding: quoted-printable\r\n\r\na=3D1,b=\r\n2\r\n'
+            b'--b\r\nContent-Type: application/x-raw; name="raw.bin"\r\n\r\nline 1\r\nline 2\r\n\r\n'
+            b'--b\r\nContent-Type: image/png\r\nContent-Transfer-Encoding: base64\r\n\r\nUE5\r\nH\r\n'
+            b'--b--\r\nepilogue\r\n'
+        )
+        self.assertEqual(self._attachments(content), [
+            ('a.csv', 'text/csv', b'a=1,b2'),
+            ('raw.bin', 'application/x-raw', b'line 1\r\nline 2\r\n'),
+            ('', 'image/png', b'PNG'),
+        ])
+
+    def test_nested_message(self):
+        content = (
+            b'Content-Type: multipart/mixed; boundary="outer"\r\n\r\n'
+            b'--outer\r\nContent-Type: message/rfc822\r\n\r\n'
+            b'Subject: Inner\r\nContent-Type: multipart/mixed; boundary="inner"\r\n\r\n'
+            b'--inner\r\nContent-Type: image/png\r\nContent-Disposition: attachment;\r\n filename="in.png"\r\n\r\n'
+            b'PNG\r\n--inner--\r\n'
+            b'--outer\r\nContent-Type: application/pdf; name="=?utf-8?q?caf=C3=A9.pdf?="\r\n\r\nPDF\r\n'
+            b'--outer--\r\n'
+        )
+        self.assertEqual(self._attachments(content), [
+            ('in.png', 'image/png', b'PNG'),
+            ('caf\xe9.pdf', 'application/pdf', b'PDF'),
+        ])
+        email = Parser().parsestr(content.decode('latin-1'))
+        self.assertEqual(sum(1 for part in email.walk() if is_attachment(part)), 2)
+
+    def test_plain(self):
+        self.assertEqual(self._attachments(b'Subject: Test\r\n\r\nBody\r\n'), [])
+
+    def test_is_attachment(self):
+        self.assertFalse(is_attachment(Parser().parsestr('Content-Type: text/html\r\n\r\n')))
+        self.assertFalse(is_attachment(Parser().parsestr('Content-Type: multipart/mixed\r\n\r\n')))
+        self.assertFalse(is_attachment(Parser().parsestr('Content-Type: message/rfc822\r\n\r\n')))
+        self.assertTrue(is_attachment(Parser().parsestr('Content-Type: image/gif\r\n\r\n')))
+        self.assertTrue(is_attachment(Parser().parsestr(
+            'Content-Type: text/plain\r\nContent-Disposition: Attachment; filename="a.txt"\r\n\r\n')))
+
+
+class SyntheticMessageIdTest(TestCase):
+    def test_stable(self):
+        first = Parser().parsestr('Subject: Test\r\nTo: a@email.test,\r\n b@email.test\r\n\r\nBody')
+        second = HeaderParser().parsestr('Subject: Test\r\nTo: a@email.test,\r\n\tb@email.test\r\n\r\n')
+        self.assertEqual(synthetic_message_id(first), synthetic_message_id(second))
+
+    def test_different(self):
+        self.assertNotEqual(synthetic_message_id(HeaderParser().parsestr('Subject: A\r\n\r\n')),
+                            synthetic_message_id(HeaderParser().parsestr('Subject: B\r\n\r\n')))
+
+    def test_non_ascii(self):
+        message = HeaderParser().parsestr(_native('Subject: Ca\xf1a\r\n\r\n'.encode('latin-1')))
+        self.assertRegexpMatches(synthetic_message_id(message), r'^<[0-9a-f]{128}@email_backup>$')
+
+    def test_empty(self):
+        self.assertIsNone(synthetic_message_id(HeaderParser().parsestr('\r\n')))
+
+    def test_parse_message_id(self):
+        self.assertEqual(parse_message_id('Message-ID: <a@email.test>\r\n\r\n'), '<a@email.test>')
+        for msg in (None, '\r\n', 'Message-ID: \r\n\r\n'):
+            self.assertIsNone(parse_message_id(msg))
+
+
+class EmailHeaderTest(TestCase):
+    def test_parse(self):
+        with open(os.path.join(BASE_DIR, 'files', 'japan_email.eml')) as eml:
+            header = EmailHeader.parse(eml.read(), size=100)
+        self.assertEqual(header.message_id, '<ID_japan@email.test>')
+        self.assertEqual(header.subject, u'テスト')
+        self.assertEqual(header.send_by, 'from@email.test')
+        self.assertEqual(header.date, datetime(2017, 7, 31, 11, 30, 37))
+        self.assertEqual(header.size, 100)
+        self.assertFalse(hasattr(header, '__dict__'))
+
+    def test_parse_message(self):
+        message = Parser().parsestr('Message-ID: <a@email.test>\r\nSubject: Test\r\n\r\nBody')
+        header = EmailHeader.parse(message)
+        self.assertEqual(header.message_id, '<a@email.test>')
+        self.assertEqual(header.subject, 'Test')
+
+    def test_parse_without_message_id(self):
+        header = EmailHeader.parse('Subject: Test\r\nDate: Mon, 31 Jul 2017 11:30:37 +0200\r\n\r\n')
+        self.assertEqual(header.message_id, synthetic_message_id(
+            Parser().parsestr('Subject: Test\r\nDate: Mon, 31 Jul 2017 11:30:37 +0200\r\n\r\nBody')
+        ))
+        self.assertRegexpMatches(header.message_id, r'^<[0-9a-f]{128}@email_backup>$')
+
+    def test_parse_empty(self):
+        for msg in (None, '', '\r\n'):
+            header = EmailHeader.parse(msg)
+            self.assertIsNone(header.message_id)
+            self.assertIsNone(header.subject)
+            self.assertIsNone(header.send_by)
+            self.assertIsNone(header.date)
+            self.assertIsNone(header.size)
+
+
 class EmailTest(TestCase):
     def setUp(self):
         self.multi_email_file = os.path.join(BASE_DIR, 'files', 'multi_email.eml')
@@ -87,6 +511,16 @@ class EmailTest(TestCase):
         self.connector.read.return_value = open(self.japan_email_file).read()
         self._test_load()
 
+    def test_load_spooled(self):
+        message = RawMessage()
+        with open(self.multi_email_file, 'rb') as eml:
+            message.write(eml.read())
+        self.connector.read.return_value = message
+        self._test_load()
+        self.assertIs(self.email.raw, message)
+        self.assertEqual(self.email.attaches(), 1)
+        self.assertEqual(self.email.get('Message-Id'), '<ID_multi@email.test>')
+
     def _test_load_headers(self):
         self.assertFalse(self.email._header)
         self.assertFalse(self.email._full)
@@ -113,8 +547,53 @@ class EmailTest(TestCase):
     def test_load_no_msg(self):
         self._test_load()
 
+    def test_feed(self):
+        msg = open(self.plain_email_file).read()
+        self.email.feed(msg)
+        self.assertTrue(self.email._header)
+        self.assertTrue(self.email._full)
+        self.assertEqual(self.email.raw, msg)
+        self.assertEqual(self.email.get('Message-ID'), '<plain_id@email.test>')
+        self.email.load()
+        self.assertEqual(self.connector.header.call_count, 0)
+        self.assertEqual(self.connector.read.call_count, 0)
+        self.assertEqual(self.connector.chdir.call_count, 0)
+
+    @patch('email_backup.core.connector.Parser')
+    def test_feed_lazy(self, parser_mock):
+        self.email.feed(open(self.plain_email_file).read())
+        self.assertEqual(parser_mock.call_count, 0)
+        self.assertEqual(self.email.email, parser_mock.return_value.parsestr.return_value)
+        self.assertEqual(self.email.email, parser_mock.return_value.parsestr.return_value)
+        self.assertEqual(parser_mock.return_value.parsestr.call_count, 1)
+
+    def test_feed_without_connector(self):
+        email = Email(None, 1, 'test', uid=11)
+        email.feed(open(self.plain_email_file).read())
+        self.assertEqual(email.get('Message-ID'), '<plain_id@email.test>')
+        self.assertEqual(email.fields()['subject'], 'Test plain')
+
+    def test_fields(self):
+        self.connector.read.return_value = open(self.multi_email_file).read()
+        fields = self.email.fields()
+        self.assertEqual(fields['message_id'], '<ID_multi@email.test>')
+        self.assertEqual(fields['send_by'], 'from@email.test')
+        self.assertEqual(fields['subject'], 'Test subject')
+        self.assertEqual(fields['attaches'], 1)
+        self.assertEqual(self.connector.read.call_count, 1)
+        self.assertEqual(self.connector.header.call_count, 0)
+
+    def test_feed_header(self):
+        msg = open(self.plain_email_file).read()
+        self.email.feed(msg, only_header=True)
+        self.assertTrue(self.email._header)
+        self.assertFalse(self.email._full)
+        self.assertIsNone(self.email.raw)
+        self.assertEqual(self.email.get('Message-ID'), '<plain_id@email.test>')
+        self.assertEqual(self.connector.header.call_count, 0)
+
     def _test_get_common(self):
-        self.assertEqual(self.connector.chdir.call_count, 2)
+        self.assertEqual(self.connector.chdir.call_count, 1)
         self.assertEqual(self.connector.chdir.call_args, call(self.email.directory))
         self.assertEqual(self.connector.header.call_count, 1)
         self.assertEqual(self.connector.header.call_args, call(self.email.id))
@@ -178,6 +657,21 @@ class EmailTest(TestCase):
         self._test_get_common()
         self.assertEqual(value, u'テスト')
 
+    def test_headers_cached(self):
+        self.connector.header.return_value = open(self.multi_email_file).read()
+        headers = self.email.headers
+        self.assertIs(self.email.headers, headers)
+        self.assertEqual(self.email.get('subject'), 'Test subject')
+        self.assertEqual(self.email.get('from'), 'from@email.test')
+        self.assertEqual(self.email.get('Message-Id'), '<ID_multi@email.test>')
+        self._test_get_common()
+        self.assertIsNone(headers.size)
+
+        self.email.feed(open(self.multi_email_file).read())
+        self.assertIsNot(self.email.headers, headers)
+        self.assertEqual(self.email.headers.size, len(self.email.raw))
+        self.assertEqual(self.email.headers.message_id, headers.message_id)
+
     def test_subject_encode_error(self):
         self.email.email = Mock()
         self.email.email.get.return_value = '=?UTF-8?B?test?='
@@ -256,7 +750,24 @@ class EmailTest(TestCase):
     def test_attaches_multi(self):
         self.connector.read.return_value = open(self.multi_email_file).read()
         value = self.email.attaches()
-        self.assertEqual(value, 2)
+        self.assertEqual(value, 1)
+
+    def test_attachments(self):
+        self.connector.read.return_value = open(self.multi_email_file, 'rb').read()
+        (filename, content_type, content), = self.email.attachments()
+        self.assertEqual((filename, content_type, len(content)), ('pdf.pdf', 'application/pdf', 1114))
+
+    def test_attachments_spooled(self):
+        message = RawMessage()
+        with open(self.multi_email_file, 'rb') as eml:
+            message.write(eml.read())
+        self.connector.read.return_value = message
+        self.assertEqual([filename for filename, _, _ in self.email.attachments()], ['pdf.pdf'])
+        self.assertEqual(message.read(7), b'MIME-Ve')
+
+    def test_attachments_plain(self):
+        self.connector.read.return_value = open(self.plain_email_file).read()
+        self.assertEqual(list(self.email.attachments()), [])
 
     def test_attaches_japan(self):
         self.connector.read.return_value = open(self.japan_email_file).read()
@@ -265,35 +776,56 @@ class EmailTest(TestCase):
 
 
 class OpenTest(TestCase):
-    @patch('email_backup.core.connector.imaplib')
+    @patch('email_backup.core.connector.SpooledIMAP4')
     def test_open(self, imap4_mock):
         host, port = 'imap.host.test', 143
         user, password = 'user', 'password'
         login_mock = Mock()
         login_mock.login = Mock()
-        imap4_mock.IMAP4.return_value = login_mock
+        imap4_mock.return_value = login_mock
 
         conn = EmailConnectorInterface(host, port, False, user, password)
         conn.open()
 
-        self.assertEqual(imap4_mock.IMAP4.call_count, 1)
-        self.assertEqual(imap4_mock.IMAP4.call_args, call(host, port))
+        self.assertEqual(imap4_mock.call_count, 1)
+        self.assertEqual(imap4_mock.call_args, call(host, port))
         self.assertEqual(login_mock.login.call_count, 1)
         self.assertEqual(login_mock.login.call_args, call(user, password))
 
-    @patch('email_backup.core.connector.imaplib')
+    @patch('email_backup.core.connector.SpooledIMAP4')
+    def test_open_qresync(self, imap4_mock):
+        imap4_mock.return_value.capability.return_value = ('OK', [b'IMAP4rev1 CONDSTORE QRESYNC'])
+        imap4_mock.return_value._simple_command.return_value = ('OK', [None])
+        conn = EmailConnectorInterface('imap.host.test', 143, False, 'user', 'password', use_uid=True)
+        conn.open()
+
+        self.assertEqual(imap4_mock.return_value._simple_command.call_args, call('ENABLE', 'QRESYNC'))
+        self.assertTrue(conn._qresync)
+        conn.close()
+        self.assertFalse(conn._qresync)
+
+    @patch('email_backup.core.connector.SpooledIMAP4')
+    def test_open_without_qresync(self, imap4_mock):
+        imap4_mock.return_value.capability.return_value = ('OK', [b'IMAP4rev1 CONDSTORE'])
+        conn = EmailConnectorInterface('imap.host.test', 143, False, 'user', 'password', use_uid=True)
+        conn.open()
+
+        self.assertEqual(imap4_mock.return_value._simple_command.call_count, 0)
+        self.assertFalse(conn._qresync)
+
+    @patch('email_backup.core.connector.SpooledIMAP4_SSL')
     def test_open_ssl(self, imap4_mock):
         host, port = 'imap.host.test', 993
         user, password = 'user', 'password'
         login_mock = Mock()
         login_mock.login = Mock()
-        imap4_mock.IMAP4_SSL.return_value = login_mock
+        imap4_mock.return_value = login_mock
 
         conn = EmailConnectorInterface(host, port, True, user, password)
         conn.open()
 
-        self.assertEqual(imap4_mock.IMAP4_SSL.call_count, 1)
-        self.assertEqual(imap4_mock.IMAP4_SSL.call_args, call(host, port))
+        self.assertEqual(imap4_mock.call_count, 1)
+        self.assertEqual(imap4_mock.call_args, call(host, port))
         self.assertEqual(login_mock.login.call_count, 1)
         self.assertEqual(login_mock.login.call_args, call(user, password))
 
@@ -320,6 +852,16 @@ class CloseTest(TestCase):
         self.assertEqual(sock_mock.close.call_args, call())
         self.assertIsNone(self.conn.connection)
 
+    def test_close_selected(self):
+        connection = Mock()
+        self.conn.connection = connection
+        self.conn._selected = ('INBOX', False)
+        self.conn.close()
+
+        self.assertEqual(connection.close.call_count, 0)
+        self.assertEqual(connection.logout.call_count, 1)
+        self.assertIsNone(self.conn._selected)
+
     def test_close_not_open(self):
         self.conn.close()
 
@@ -425,6 +967,178 @@ class FetchTest(TestCase):
         self.assertIn(call(email_id, '(RFC822)'), self.conn.connection.fetch.call_args_list)
 
 
+class FetchBatchTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password)
+        self.conn.connection = Mock()
+        self.conn.chdir = Mock()
+        self.plain_email = open(os.path.join(BASE_DIR, 'files', 'plain_email.eml')).read()
+        self.multi_email = open(os.path.join(BASE_DIR, 'files', 'multi_email.eml')).read()
+
+    def test_fetch_not_open(self):
+        self.conn.connection = None
+        self.assertEqual(list(self.conn.fetch('dir', [1, 2])), [])
+
+    def test_fetch_empty(self):
+        self.assertEqual(list(self.conn.fetch('dir', [])), [])
+        self.assertEqual(self.conn.connection.fetch.call_count, 0)
+
+    def test_fetch(self):
+        directory = 'dir'
+        self.conn.connection.fetch.side_effect = [
+            ('OK', [('1 (UID 11 RFC822 {1})', self.plain_email), ')', ('2 (UID 12 RFC822 {1})', self.multi_email), ')']),
+            ('OK', [('5 (UID 15 RFC822 {1})', self.plain_email), ')']),
+        ]
+        emails = list(self.conn.fetch(directory, [1, 2, 5], chunk_size=2))
+
+        self.assertEqual(self.conn.chdir.call_count, 1)
+        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.connection.fetch.call_args_list,
+                         [call('1:2', '(UID RFC822)'), call('5', '(UID RFC822)')])
+        self.assertEqual([email.id for email in emails], [1, 2, 5])
+        self.assertEqual([email.uid for email in emails], [11, 12, 15])
+        for email in emails:
+            self.assertEqual(email.directory, directory)
+            self.assertTrue(email._full)
+        self.assertEqual(emails[1].raw, self.multi_email)
+        self.assertEqual(emails[1].get('Message-ID'), '<ID_multi@email.test>')
+
+    def test_fetch_header(self):
+        self.conn.connection.fetch.return_value = ('OK', [
+            ('3 (UID 13 RFC822.SIZE 1024 BODY[HEADER] {1})', self.plain_email), ')'
+        ])
+        emails = list(self.conn.fetch('dir', [3], only_header=True))
+
+        self.assertEqual(self.conn.connection.fetch.call_args, call('3', '(UID RFC822.SIZE BODY.PEEK[HEADER])'))
+        self.assertEqual(len(emails), 1)
+        self.assertTrue(emails[0]._header)
+        self.assertFalse(emails[0]._full)
+        self.assertEqual(emails[0].get('Message-ID'), '<plain_id@email.test>')
+        self.assertEqual(emails[0].headers.size, 1024)
+
+    def test_message_ids(self):
+        header = 'Subject: Without id\r\nDate: Mon, 31 Jul 2017 11:30:37 +0200\r\n\r\n'
+        self.conn.connection.fetch.side_effect = [('OK', [
+            ('3 (UID 13 BODY[HEADER.FIELDS (MESSAGE-ID)] {1})', 'Message-ID: <a@email.test>\r\n\r\n'), ')',
+            ('4 (UID 14 BODY[HEADER.FIELDS (MESSAGE-ID)] {1})', '\r\n'), ')',
+            ('5 (UID 15 BODY[HEADER.FIELDS (MESSAGE-ID)] {1})', 'Message-ID: \r\n\r\n'), ')',
+        ]), ('OK', [
+            ('4 (UID 14 BODY[HEADER] {1})', header), ')',
+            ('5 (UID 15 BODY[HEADER] {1})', 'Message-ID: \r\n' + header), ')',
+        ])]
+        result = list(self.conn.message_ids('dir', [3, 4, 5]))
+
+        self.assertEqual(self.conn.connection.fetch.call_args_list, [
+            call('3:5', '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'),
+            call('4:5', '(UID BODY.PEEK[HEADER])'),
+        ])
+        self.assertEqual(result, [
+            (3, '<a@email.test>'),
+            (4, synthetic_message_id(HeaderParser().parsestr(header))),
+            (5, synthetic_message_id(HeaderParser().parsestr('Message-ID: \r\n' + header))),
+        ])
+        self.assertNotEqual(result[1][1], result[2][1])
+
+    def test_fetch_wrong(self):
+        self.conn.connection.fetch.return_value = ('NO', ['Error'])
+        self.assertEqual(list(self.conn.fetch('dir', [1])), [])
+        self.assertEqual(self.conn.connection.fetch.call_count, 1)
+
+
+class StatusTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password)
+        self.conn.connection = Mock()
+        self.conn.connection.capability.return_value = ('OK', [b'IMAP4rev1'])
+
+    def test_status_not_open(self):
+        self.conn.connection = None
+        self.assertEqual(self.conn.status('dir'), {})
+
+    def test_status(self):
+        directory = 'dir'
+        self.conn.connection.status.return_value = ('OK', ['"dir" (UIDVALIDITY 1500 UIDNEXT 33)'])
+        result = self.conn.status(directory)
+        self.assertEqual(result, {'UIDVALIDITY': 1500, 'UIDNEXT': 33})
+        self.assertEqual(self.conn.connection.status.call_count, 1)
+        self.assertEqual(self.conn.connection.status.call_args, call('"dir"', '(UIDVALIDITY UIDNEXT)'))
+
+    def test_status_modseq(self):
+        self.conn.connection.capability.return_value = ('OK', [b'IMAP4rev1 CONDSTORE'])
+        self.conn.connection.status.return_value = ('OK', [b'"dir" (UIDVALIDITY 1500 UIDNEXT 33 HIGHESTMODSEQ 9000)'])
+        result = self.conn.status('dir')
+        self.assertEqual(result, {'UIDVALIDITY': 1500, 'UIDNEXT': 33, 'HIGHESTMODSEQ': 9000})
+        self.assertEqual(self.conn.connection.status.call_args, call('"dir"', '(UIDVALIDITY UIDNEXT HIGHESTMODSEQ)'))
+
+    def test_wrong_status(self):
+        self.conn.connection.status.return_value = ('NO', ['Unknown Mailbox'])
+        self.assertEqual(self.conn.status('not exist'), {})
+
+
+class VanishedTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password, use_uid=True)
+        self.conn.connection = Mock()
+        self.conn.connection.select.return_value = ('OK', [b'10'])
+        self.conn._qresync = True
+
+    def test_vanished_not_enabled(self):
+        self.conn._qresync = False
+        self.assertEqual(self.conn.vanished('dir', 900, 20), [])
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+
+    def test_vanished_first_sync(self):
+        self.assertEqual(self.conn.vanished('dir', None, 20), [])
+        self.assertEqual(self.conn.vanished('dir', 900, 0), [])
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+
+    def test_vanished(self):
+        self.conn.connection.uid.return_value = ('OK', [b'3 (UID 12 FLAGS (\\Seen) MODSEQ (950))'])
+        self.conn.connection.response.side_effect = [
+            ('VANISHED', [b'7']),
+            ('VANISHED', [b'(EARLIER) 3:5,9', b'(EARLIER) 15:14']),
+        ]
+        self.assertEqual(self.conn.vanished('dir', 900, 20), [3, 4, 5, 9, 14, 15])
+        self.assertEqual(self.conn.connection.select.call_args, call('"dir"', False))
+        self.assertEqual(self.conn.connection.uid.call_args,
+                         call('FETCH', '1:20', '(UID)', '(CHANGEDSINCE 900 VANISHED)'))
+
+    def test_vanished_none(self):
+        self.conn.connection.uid.return_value = ('OK', [None])
+        self.conn.connection.response.return_value = ('VANISHED', [None])
+        self.assertEqual(self.conn.vanished('dir', 900, 20), [])
+
+    def test_vanished_error(self):
+        self.conn.connection.uid.return_value = ('BAD', [b'Unknown modifier'])
+        self.conn.connection.response.return_value = ('VANISHED', [b'(EARLIER) 3'])
+        self.assertEqual(self.conn.vanished('dir', 900, 20), [])
+
+
+class GetUidTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password)
+        self.conn.connection = Mock()
+
+    def test_get_uid_not_open(self):
+        self.conn.connection = None
+        self.assertIsNone(self.conn.get_uid(1))
+
+    def test_get_uid(self):
+        self.conn.connection.fetch.return_value = ('OK', ['5 (UID 123)'])
+        self.assertEqual(self.conn.get_uid(5), 123)
+        self.assertEqual(self.conn.connection.fetch.call_args, call(5, '(UID)'))
+
+    def test_wrong_get_uid(self):
+        self.conn.connection.fetch.return_value = ('OK', [None])
+        self.assertIsNone(self.conn.get_uid(5))
+        self.assertIsNone(self.conn.get_uid(0))
+        self.assertEqual(self.conn.connection.fetch.call_count, 1)
+
+
 class ChDirTest(TestCase):
     def setUp(self):
         host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
@@ -444,7 +1158,7 @@ class ChDirTest(TestCase):
         result = self.conn.chdir(directory)
         self.assertEqual(result, 5)
         self.assertEqual(self.conn.connection.select.call_count, 1)
-        self.assertEqual(self.conn.connection.select.call_args, call(directory))
+        self.assertEqual(self.conn.connection.select.call_args, call('"dir"', False))
 
     def test_wrong_chdir(self):
         directory = 'not exist'
@@ -453,6 +1167,38 @@ class ChDirTest(TestCase):
         result = self.conn.chdir(directory)
         self.assertEqual(result, 0)
         self.assertEqual(self.conn.connection.select.call_count, 1)
+        self.conn.chdir(directory)
+        self.assertEqual(self.conn.connection.select.call_count, 2)
+
+    def test_chdir_selected(self):
+        self.conn.connection.select.return_value = ('OK', ['5'])
+        self.assertEqual(self.conn.chdir('dir'), 5)
+        self.assertEqual(self.conn.chdir('dir'), 5)
+        self.assertEqual(self.conn.connection.select.call_count, 1)
+        self.conn.connection.select.return_value = ('OK', ['6'])
+        self.assertEqual(self.conn.chdir('dir', refresh=True), 6)
+        self.assertEqual(self.conn.connection.select.call_count, 2)
+        self.conn.chdir('other')
+        self.conn.chdir('dir')
+        self.assertEqual(self.conn.connection.select.call_count, 4)
+
+    def test_chdir_readonly(self):
+        self.conn.readonly = True
+        self.conn.connection.select.return_value = ('OK', ['5'])
+        self.conn.chdir('Sent Items')
+        self.assertEqual(self.conn.connection.select.call_args, call('"Sent Items"', True))
+        self.conn.chdir('Sent Items', readonly=False)
+        self.assertEqual(self.conn.connection.select.call_args, call('"Sent Items"', False))
+        self.assertEqual(self.conn.connection.select.call_count, 2)
+
+    def test_chdir_closed(self):
+        self.conn.connection.select.return_value = ('OK', ['5'])
+        self.conn.chdir('dir')
+        self.conn.close()
+        self.conn.connection = Mock()
+        self.conn.connection.select.return_value = ('OK', ['5'])
+        self.conn.chdir('dir')
+        self.assertEqual(self.conn.connection.select.call_count, 1)
 
 
 class DeleteTest(TestCase):
@@ -487,6 +1233,133 @@ class DeleteTest(TestCase):
         self.assertEqual(self.conn.connection.store.call_count, 0)
 
 
+class CapabilityTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password)
+        self.conn.connection = Mock()
+
+    def test_has_capability_not_open(self):
+        self.conn.connection = None
+        self.assertFalse(self.conn.has_capability('MOVE'))
+
+    def test_has_capability(self):
+        self.conn.connection.capability.return_value = ('OK', [b'IMAP4rev1 UIDPLUS move'])
+        self.assertTrue(self.conn.has_capability('uidplus'))
+        self.assertTrue(self.conn.has_capability('MOVE'))
+        self.assertFalse(self.conn.has_capability('CONDSTORE'))
+        self.assertEqual(self.conn.connection.capability.call_count, 1)
+
+    def test_has_capability_wrong(self):
+        self.conn.connection.capability.return_value = ('BAD', [None])
+        self.assertFalse(self.conn.has_capability('MOVE'))
+
+    def test_trash(self):
+        self.conn.connection.list.return_value = ('OK', [
+            b'(\\HasNoChildren) "/" "INBOX"',
+            b'(\\HasNoChildren \\Trash) "/" "[Gmail]/Trash"',
+        ])
+        self.assertEqual(self.conn.trash(), '[Gmail]/Trash')
+        self.assertEqual(self.conn.trash(), '[Gmail]/Trash')
+        self.assertEqual(self.conn.connection.list.call_count, 1)
+
+    def test_without_trash(self):
+        self.conn.connection.list.return_value = ('OK', [b'(\\HasNoChildren) "/" "INBOX"'])
+        self.assertIsNone(self.conn.trash())
+        self.assertIsNone(self.conn.trash())
+        self.assertEqual(self.conn.connection.list.call_count, 1)
+
+    def test_trash_target(self):
+        self.conn.use_uid = True
+        self.conn.connection.capability.return_value = ('OK', [b'IMAP4rev1 MOVE'])
+        self.conn.connection.list.return_value = ('OK', [b'(\\Trash) "/" "Trash"'])
+        self.assertEqual(self.conn.trash_target(), 'Trash')
+        self.conn.use_uid = False
+        self.assertIsNone(self.conn.trash_target())
+
+    def test_trash_target_without_move(self):
+        self.conn.use_uid = True
+        self.conn.connection.capability.return_value = ('OK', [b'IMAP4rev1 UIDPLUS'])
+        self.assertIsNone(self.conn.trash_target())
+        self.assertEqual(self.conn.connection.list.call_count, 0)
+
+    def test_noop(self):
+        self.conn.connection.noop.return_value = ('OK', [b'2 EXISTS'])
+        self.assertTrue(self.conn.noop())
+        self.conn.connection.noop.side_effect = imaplib.IMAP4.abort('socket error')
+        self.assertFalse(self.conn.noop())
+        self.conn.connection = None
+        self.assertFalse(self.conn.noop())
+
+    def test_close(self):
+        self.conn.connection.capability.return_value = ('OK', [b'MOVE'])
+        self.conn.has_capability('MOVE')
+        self.conn.close()
+        self.assertIsNone(self.conn._capabilities)
+
+
+class BatchDeleteTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password, use_uid=True)
+        self.conn.connection = Mock()
+        self.conn.connection.list.return_value = ('OK', [b'(\\Trash) "/" "Deleted Items"'])
+        self.conn.chdir = Mock()
+
+    def _capabilities(self, capabilities):
+        self.conn.connection.capability.return_value = ('OK', [capabilities])
+
+    def test_delete_not_open(self):
+        self.conn.connection = None
+        self.assertFalse(self.conn.delete('INBOX', [1]))
+
+    def test_delete_empty(self):
+        self.conn.delete('INBOX', [])
+        self.assertEqual(self.conn.chdir.call_count, 0)
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+
+    def test_delete_move(self):
+        self._capabilities(b'IMAP4rev1 MOVE UIDPLUS')
+        self.assertFalse(self.conn.delete('INBOX', [3, 1, 2, 7], chunk_size=3))
+        self.assertEqual(self.conn.chdir.call_args, call('INBOX', readonly=False))
+        self.assertEqual(self.conn.connection.uid.call_args_list, [
+            call('MOVE', '1:3', '"Deleted Items"'),
+            call('MOVE', '7', '"Deleted Items"'),
+        ])
+
+    def test_delete_trash(self):
+        self._capabilities(b'IMAP4rev1 MOVE UIDPLUS')
+        self.assertFalse(self.conn.delete('Deleted Items', [1, 2]))
+        self.assertEqual(self.conn.connection.uid.call_args_list, [
+            call('STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+            call('EXPUNGE', '1:2'),
+        ])
+
+    def test_delete_uidplus(self):
+        self._capabilities(b'IMAP4rev1 UIDPLUS')
+        self.assertFalse(self.conn.delete('INBOX', [1, 2]))
+        self.assertEqual(self.conn.connection.uid.call_args_list, [
+            call('STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+            call('EXPUNGE', '1:2'),
+        ])
+        self.assertEqual(self.conn.connection.list.call_count, 0)
+
+    def test_delete_store(self):
+        self._capabilities(b'IMAP4rev1')
+        self.assertTrue(self.conn.delete('INBOX', [1, 2]))
+        self.assertEqual(self.conn.connection.uid.call_args_list, [
+            call('STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+        ])
+        self.assertEqual(self.conn.connection.expunge.call_count, 0)
+
+    def test_delete_without_uid(self):
+        self.conn.use_uid = False
+        self.assertTrue(self.conn.delete('INBOX', [1, 2]))
+        self.assertEqual(self.conn.connection.store.call_args, call('1:2', '+FLAGS.SILENT', '(\\Deleted)'))
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+        self.assertEqual(self.conn.connection.capability.call_count, 0)
+
+
 class GetEmailsTest(TestCase):  # pragma: no cover
     def setUp(self):
         host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
@@ -513,7 +1386,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
 
     def test_get_emails_with_just_read(self):
         directory = 'directory'
@@ -530,7 +1403,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args, call(None, '(SEEN)'))
 
@@ -551,7 +1424,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args, call(None, '(before "{}")'.format(before_str)))
 
@@ -573,7 +1446,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args, call(None, '(before "{}")'.format(before_str)))
 
@@ -593,7 +1466,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args, call(None, '(before "{}")'.format(before_str)))
 
@@ -639,7 +1512,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 0)
 
     def test_get_emails_with_before_and_just_read(self):
@@ -658,7 +1531,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args,
                          call(None, '(before "{}")'.format(before_str), '(SEEN)'))
@@ -708,7 +1581,7 @@ class GetEmailsTest(TestCase):  # pragma: no cover
         self.assertEqual(email.directory, directory)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
         self.assertEqual(self.conn.connection.search.call_count, 1)
         self.assertEqual(self.conn.connection.search.call_args, call(None, '(SEEN)'))
 
@@ -729,4 +1602,313 @@ class GetEmailsTest(TestCase):  # pragma: no cover
             self.assertRaises(StopIteration, generator.next)
 
         self.assertEqual(self.conn.chdir.call_count, 1)
-        self.assertEqual(self.conn.chdir.call_args, call(directory))
+        self.assertEqual(self.conn.chdir.call_args, call(directory, refresh=True))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password)
+        self.conn.connection = Mock()
+        self.conn.chdir = Mock()
+        self.conn.chdir.return_value = 3
+        self.conn.connection.search.return_value = ('OK', ('4 5', ))
+
+    def test_search_since_uid(self):
+        result = self.conn.search('directory', since_uid=10)
+        self.assertEqual(result, ['4', '5'])
+        self.assertEqual(self.conn.connection.search.call_args, call(None, '(UID 11:*)'))
+
+    def test_search_since_uid_zero(self):
+        result = self.conn.search('directory', since_uid=0)
+        self.assertEqual(list(result), [1, 2, 3])
+        self.assertEqual(self.conn.connection.search.call_count, 0)
+
+    def test_search_invert(self):
+        result = self.conn.search('directory', just_read=True, since_uid=10, invert=True)
+        self.assertEqual(result, ['4', '5'])
+        self.assertEqual(self.conn.connection.search.call_args, call(None, '(UID 11:*)', 'NOT ((SEEN))'))
+
+    def test_search_invert_without_filters(self):
+        result = self.conn.search('directory', since_uid=10, invert=True)
+        self.assertEqual(result, [])
+        self.assertEqual(self.conn.connection.search.call_count, 0)
+
+
+class UidModeTest(TestCase):
+    def setUp(self):
+        host, port, ssl, user, password = 'imap.host.test', 143, False, 'user', 'password'
+        self.conn = EmailConnectorInterface(host, port, ssl, user, password, use_uid=True)
+        self.conn.connection = Mock()
+        self.conn.chdir = Mock()
+        self.conn.chdir.return_value = 2
+        self.plain_email = open(os.path.join(BASE_DIR, 'files', 'plain_email.eml')).read()
+
+    def test_search_all(self):
+        self.conn.connection.uid.return_value = ('OK', ('101 102', ))
+        result = self.conn.search('directory')
+        self.assertEqual(result, ['101', '102'])
+        self.assertEqual(self.conn.connection.uid.call_args, call('SEARCH', None, 'ALL'))
+        self.assertEqual(self.conn.connection.search.call_count, 0)
+
+    def test_search_empty_directory(self):
+        self.conn.chdir.return_value = 0
+        result = self.conn.search('directory')
+        self.assertEqual(result, [])
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+
+    def test_search_since_uid(self):
+        self.conn.connection.uid.return_value = ('OK', ('90 ', ))
+        result = self.conn.search('directory', just_read=True, since_uid=100)
+        self.assertEqual(result, [])
+        self.assertEqual(self.conn.connection.uid.call_args, call('SEARCH', None, '(UID 101:*)', '(SEEN)'))
+
+    def test_get_emails(self):
+        self.conn.connection.uid.return_value = ('OK', ('101', ))
+        emails = list(self.conn.get_emails('directory'))
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(emails[0].id, '101')
+        self.assertEqual(emails[0].uid, '101')
+
+    def test_fetch(self):
+        self.conn.connection.uid.return_value = ('OK', [('1 (UID 101 RFC822 {1})', self.plain_email), ')'])
+        emails = list(self.conn.fetch('directory', ['101']))
+        self.assertEqual(self.conn.connection.uid.call_args, call('FETCH', '101', '(UID RFC822)'))
+        self.assertEqual(self.conn.connection.fetch.call_count, 0)
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(emails[0].id, 101)
+        self.assertEqual(emails[0].uid, 101)
+
+    def test_read(self):
+        self.conn.connection.uid.return_value = ('OK', (('', 'Message'), ''))
+        self.assertEqual(self.conn.read(101), 'Message')
+        self.assertEqual(self.conn.connection.uid.call_args, call('FETCH', 101, '(RFC822)'))
+
+    def test_header(self):
+        self.conn.connection.uid.return_value = ('OK', (('', 'Message'), ''))
+        self.assertEqual(self.conn.header(101), 'Message')
+        self.assertEqual(self.conn.connection.uid.call_args, call('FETCH', 101, '(BODY.PEEK[HEADER])'))
+
+    def test_mark_delete(self):
+        self.conn.mark_delete(101)
+        self.assertEqual(self.conn.connection.uid.call_args, call('STORE', 101, '+FLAGS', '\\Deleted'))
+        self.assertEqual(self.conn.connection.store.call_count, 0)
+
+    def test_get_uid(self):
+        self.assertEqual(self.conn.get_uid('101'), 101)
+        self.assertEqual(self.conn.connection.uid.call_count, 0)
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.factory = Mock()
+        self.factory.side_effect = lambda: Mock(spec=EmailConnectorInterface)
+
+    def test_connection(self):
+        pool = ConnectionPool(self.factory)
+        with pool.connection() as first:
+            self.assertEqual(first.open.call_count, 1)
+        with pool.connection() as second:
+            self.assertEqual(second, first)
+        self.assertEqual(self.factory.call_count, 1)
+        self.assertEqual(first.open.call_count, 1)
+        self.assertEqual(first.close.call_count, 0)
+
+        pool.close()
+        self.assertEqual(first.close.call_count, 1)
+        with pool.connection() as third:
+            self.assertNotEqual(third, first)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_concurrent_connections(self):
+        pool = ConnectionPool(self.factory, max_connections=2)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertNotEqual(first, second)
+                self.assertFalse(pool._semaphore.acquire(False))
+        self.assertEqual(self.factory.call_count, 2)
+        self.assertEqual(len(pool._idle), 2)
+
+    def test_connection_imap_error(self):
+        pool = ConnectionPool(self.factory)
+        try:
+            with pool.connection() as connector:
+                raise imaplib.IMAP4.abort('socket error')
+        except imaplib.IMAP4.abort:
+            pass
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertEqual(pool._idle, [])
+        self.assertTrue(pool._semaphore.acquire(False))
+
+    def test_connection_other_error(self):
+        pool = ConnectionPool(self.factory)
+        try:
+            with pool.connection() as connector:
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(connector.close.call_count, 0)
+        self.assertEqual(pool._idle, [connector])
+
+    def test_connection_other_error_dropped(self):
+        pool = ConnectionPool(self.factory)
+        try:
+            with pool.connection() as connector:
+                connector.noop.return_value = False
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertEqual(pool._idle, [])
+
+    def test_open_error(self):
+        pool = ConnectionPool(self.factory)
+        connector = Mock(spec=EmailConnectorInterface)
+        connector.open.side_effect = imaplib.IMAP4.error('LOGIN failed')
+        self.factory.side_effect = [connector]
+        with self.assertRaises(imaplib.IMAP4.error):
+            with pool.connection():
+                pass
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertTrue(pool._semaphore.acquire(False))
+
+    def _idle(self, pool, age, alive=None):
+        with pool.connection() as connector:
+            pass
+        pool._seen[id(connector)] = (self._time(age), self._time(age if alive is None else alive))
+        return connector
+
+    def _time(self, age):
+        return time.time() - age
+
+    @patch('email_backup.core.connector.get_session_max_idle', Mock(return_value=600))
+    @patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=60))
+    def test_connection_reused(self):
+        pool = ConnectionPool(self.factory)
+        connector = self._idle(pool, 10)
+        with pool.connection() as second:
+            self.assertEqual(second, connector)
+        self.assertEqual(connector.noop.call_count, 0)
+
+    @patch('email_backup.core.connector.get_session_max_idle', Mock(return_value=600))
+    @patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=60))
+    def test_connection_checked(self):
+        pool = ConnectionPool(self.factory)
+        connector = self._idle(pool, 120)
+        connector.noop.return_value = False
+        with pool.connection() as second:
+            self.assertNotEqual(second, connector)
+        self.assertEqual(connector.noop.call_count, 1)
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertEqual(pool._idle, [second])
+
+    @patch('email_backup.core.connector.get_session_max_idle', Mock(return_value=600))
+    @patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=60))
+    def test_connection_expired(self):
+        pool = ConnectionPool(self.factory)
+        connector = self._idle(pool, 900, alive=0)
+        with pool.connection() as second:
+            self.assertNotEqual(second, connector)
+        self.assertEqual(connector.noop.call_count, 0)
+        self.assertEqual(connector.close.call_count, 1)
+
+    def test_keepalive(self):
+        pool = ConnectionPool(self.factory, max_connections=3)
+        with pool.connection() as expired, pool.connection() as dropped, pool.connection() as alive:
+            pass
+        pool._seen[id(expired)] = (self._time(900), self._time(0))
+        pool._seen[id(dropped)] = (self._time(120), self._time(120))
+        pool._seen[id(alive)] = (self._time(120), self._time(120))
+        dropped.noop.return_value = False
+
+        pool.keepalive(60, 600)
+
+        self.assertEqual(pool._idle, [alive])
+        self.assertEqual((expired.close.call_count, dropped.close.call_count, alive.close.call_count), (1, 1, 0))
+        self.assertEqual(expired.noop.call_count, 0)
+        self.assertEqual(alive.noop.call_count, 1)
+        self.assertGreater(pool._seen[id(alive)][1], self._time(10))
+
+        pool.keepalive(60, 600)
+        self.assertEqual(alive.noop.call_count, 1)
+
+    def test_keepalive_trim(self):
+        pool = ConnectionPool(self.factory)
+        connector = self._idle(pool, 0)
+        pool._release([(Mock(spec=EmailConnectorInterface), 0, 0)])
+        self.assertEqual(pool._idle, [connector])
+        self.assertEqual(len(pool._seen), 1)
+
+    def test_get_connection_pool(self):
+        pool = get_connection_pool('test_key', self.factory, 2)
+        self.assertEqual(pool.max_connections, 2)
+        self.assertEqual(get_connection_pool('test_key', self.factory, 2), pool)
+        self.assertNotEqual(get_connection_pool('test_key', self.factory, 3), pool)
+
+
+@patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=0))
+class SessionCacheTest(TestCase):
+    def setUp(self):
+        self.sessions = SessionCache()
+        self.factory = Mock()
+        self.factory.side_effect = lambda: Mock(spec=EmailConnectorInterface)
+
+    def _use(self, key, max_connections=1):
+        pool = self.sessions.pool(key, self.factory, max_connections)
+        with pool.connection() as connector:
+            pass
+        return pool, connector
+
+    def test_pool(self):
+        pool, connector = self._use('a')
+        factory = Mock()
+        self.assertEqual(self.sessions.pool('a', factory), pool)
+        self.assertEqual(pool.factory, factory)
+        self.assertIsNone(self.sessions._thread)
+
+        other = self.sessions.pool('a', factory, 2)
+        self.assertNotEqual(other, pool)
+        self.assertEqual(connector.close.call_count, 1)
+
+    @patch('email_backup.core.connector.get_session_cache_size', Mock(return_value=2))
+    def test_evict(self):
+        first, first_connector = self._use('a')
+        second, second_connector = self._use('b')
+        self._use('a')
+        third, third_connector = self._use('c')
+        self.assertEqual(second_connector.close.call_count, 1)
+        self.assertEqual(first_connector.close.call_count, 0)
+        self.assertEqual((first.idle, second.idle, third.idle), (1, 0, 1))
+
+    @patch('email_backup.core.connector.os.getpid')
+    def test_forked(self, getpid_mock):
+        getpid_mock.return_value = self.sessions._pid
+        pool, connector = self._use('a')
+        getpid_mock.return_value = self.sessions._pid + 1
+        self.assertNotEqual(self.sessions.pool('a', self.factory), pool)
+        self.assertEqual(connector.close.call_count, 0)
+
+    def test_keepalive(self):
+        pool, connector = self._use('a')
+        pool._seen[id(connector)] = (pool._seen[id(connector)][0], 0)
+        with patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=60)):
+            self.sessions.keepalive()
+        self.assertEqual(connector.noop.call_count, 1)
+
+    @patch('email_backup.core.connector.threading.Thread')
+    def test_keepalive_thread(self, thread_mock):
+        with patch('email_backup.core.connector.get_session_keepalive', Mock(return_value=60)):
+            self.sessions.pool('a', self.factory)
+            self.sessions.pool('b', self.factory)
+        self.assertEqual(thread_mock.call_count, 1)
+        self.assertEqual(thread_mock.return_value.start.call_count, 1)
+        stop = thread_mock.call_args[1]['args'][0]
+        self.sessions.close()
+        self.assertTrue(stop.is_set())
+        self.assertIsNone(self.sessions._thread)
+
+    def test_close(self):
+        pool, connector = self._use('a')
+        self.sessions.close()
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertNotEqual(self.sessions.pool('a', self.factory), pool)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import random
+from unittest import TestCase
+from email_backup.core.connector import EmailConnectorInterface
+from email_backup.core.fakeimap import *
+
+
+class TokensTest(TestCase):
+    def test_tokens(self):
+        self.assertEqual(tokens('1:* (UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'),
+                         ['1:*', ['UID', 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]']])
+
+    def test_quoted(self):
+        self.assertEqual(tokens('"INBOX" "a \\"b\\"" ""'), ['INBOX', 'a "b"', ''])
+
+    def test_parse_date(self):
+        self.assertEqual(parse_date('31-jul-2017'), datetime.date(2017, 7, 31))
+
+
+class SelectMessagesTest(TestCase):
+    def setUp(self):
+        mailbox = FakeMailbox('INBOX')
+        for _ in range(5):
+            mailbox.append(b'Subject: test\r\n\r\nBody\r\n', datetime.datetime(2017, 7, 31))
+        del mailbox.messages[1]
+        self.messages = mailbox.messages
+
+    def _uids(self, text, uid=False):
+        return [message.uid for _, message in select_messages(self.messages, text, uid=uid)]
+
+    def test_sequence(self):
+        self.assertEqual(self._uids('1,3:*'), [1, 4, 5])
+
+    def test_uid(self):
+        self.assertEqual(self._uids('2:4', uid=True), [3, 4])
+
+    def test_uid_last(self):
+        self.assertEqual(self._uids('10:*', uid=True), [5])
+
+
+class GenerateMailboxesTest(TestCase):
+    def test_generate(self):
+        mailboxes = generate_mailboxes(emails=50, folders=3, attachments=0.5, seen=0.5, seed=1)
+        self.assertEqual([mailbox.name for mailbox in mailboxes], ['INBOX', 'Folder 1', 'Folder 2', 'Trash'])
+        self.assertEqual(sum(len(mailbox) for mailbox in mailboxes), 50)
+        self.assertGreater(len(mailboxes[0]), len(mailboxes[2]))
+        self.assertEqual(mailboxes[-1].special_use, '\\Trash')
+        self.assertEqual(len(mailboxes[-1]), 0)
+
+    def test_deterministic(self):
+        first = generate_mailboxes(emails=20, seed=3, now=datetime.datetime(2017, 7, 31))
+        second = generate_mailboxes(emails=20, seed=3, now=datetime.datetime(2017, 7, 31))
+        self.assertEqual([[message.raw for message in mailbox.messages] for mailbox in first],
+                         [[message.raw for message in mailbox.messages] for mailbox in second])
+
+    def test_synthetic_email(self):
+        raw = synthetic_email(random.Random(0), 7, datetime.datetime(2017, 7, 31), 1000, 500)
+        self.assertIn(b'Message-ID: <7.benchmark@email.test>\r\n', raw)
+        self.assertIn(b'Content-Disposition: attachment', raw)
+        self.assertGreater(len(raw), 1500)
+
+
+class FakeIMAPServerTest(TestCase):
+    def setUp(self):
+        self.mailboxes = generate_mailboxes(emails=20, folders=2, attachments=0.5, seen=0.5,
+                                            now=datetime.datetime(2017, 7, 31))
+        self.server = FakeIMAPServer(self.mailboxes).start()
+        self.connector = EmailConnectorInterface(self.server.host, self.server.port, False, 'user', 'password',
+                                                 use_uid=True)
+        self.connector.open()
+
+    def tearDown(self):
+        self.connector.close()
+        self.server.stop()
+
+    def test_directories(self):
+        self.assertEqual(self.connector.directories(), ['INBOX', 'Folder 1', 'Trash'])
+        self.assertEqual(self.connector.trash(), 'Trash')
+        self.assertTrue(self.connector.has_capability('MOVE'))
+
+    def test_status(self):
+        self.assertEqual(self.connector.status('INBOX'),
+                         {'UIDVALIDITY': 1, 'UIDNEXT': self.mailboxes[0].uid_next})
+
+    def test_search(self):
+        inbox = self.mailboxes[0]
+        self.assertEqual(self.connector.search('INBOX'), [str(message.uid) for message in inbox.messages])
+        seen = [str(message.uid) for message in inbox.messages if '\\Seen' in message.flags]
+        self.assertEqual(self.connector.search('INBOX', just_read=True), seen)
+        self.assertEqual(self.connector.search('INBOX', since_uid=inbox.uid_next - 2),
+                         [str(inbox.uid_next - 1)])
+
+    def test_fetch(self):
+        inbox = self.mailboxes[0]
+        ids = self.connector.search('INBOX')[:3]
+        emails = list(self.connector.fetch('INBOX', ids))
+        self.assertEqual([email.uid for email in emails], [int(i) for i in ids])
+        self.assertEqual([email.raw for email in emails], [message.raw for message in inbox.messages[:3]])
+        message_ids = list(self.connector.message_ids('INBOX', ids))
+        self.assertEqual(message_ids, [(int(i), email.headers.message_id) for i, email in zip(ids, emails)])
+        self.assertEqual(self.server.commands['FETCH messages'], 6)
+
+    def test_delete(self):
+        ids = self.connector.search('INBOX')[:2]
+        total = len(self.mailboxes[0])
+        self.connector.delete('INBOX', ids)
+        self.assertEqual(len(self.mailboxes[0]), total - 2)
+        self.assertEqual(len(self.mailboxes[-1]), 2)
+        self.assertEqual(self.server.commands['MOVE'], 1)
+
+    def test_noop(self):
+        self.assertTrue(self.connector.noop())
+        self.assertEqual(self.server.commands['NOOP'], 1)
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        start = datetime.datetime.now()
+        self.connector.status('INBOX')
+        self.assertGreaterEqual(datetime.datetime.now() - start, datetime.timedelta(seconds=0.05))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from django.test import TestCase as DBTestCase
+from mock import Mock, call, patch
+import imaplib
+import six
+
+if not six.PY2:  # pragma: no cover
+    import asyncio
+    from email_backup.core.listener import *
+
+
+def returns(*values):
+    # Coroutine function giving the values on each call, the exceptions are raised
+    values = list(values)
+
+    @asyncio.coroutine
+    def side_effect(*args, **kwargs):
+        value = values.pop(0) if len(values) > 1 else values[0]
+        if isinstance(value, Exception):
+            raise value
+        return value
+    return Mock(side_effect=side_effect)
+
+
+@skipIf(six.PY2, 'asyncio requires Python 3')
+class ListenerTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.account = Mock(pk=1, host='imap.host.test', port=993, ssl=True, user='user', password='password')
+        self.enqueue = Mock()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+@patch('email_backup.core.listener.get_idle_debounce', Mock(return_value=0))
+@patch('email_backup.core.listener.AsyncEmailConnector')
+class AccountListenerTest(ListenerTestCase):
+    def connector(self, connector_mock, exists=3, idle=(imaplib.IMAP4.abort('EOF'),), capability=True):
+        connector = connector_mock.return_value
+        connector.connection = Mock()
+        connector.open = returns(None)
+        connector.close = returns(None)
+        connector.has_capability = returns(capability)
+        connector.chdir = returns(exists)
+        connector.idle = returns(*idle)
+        return connector
+
+    def test_listen(self, connector_mock):
+        connector = self.connector(connector_mock, idle=([], [5, 6], imaplib.IMAP4.abort('EOF')))
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        self.assertRaises(imaplib.IMAP4.abort, self.run_async, listener.listen())
+        self.assertEqual(connector_mock.call_args, call('imap.host.test', 993, True, 'user', 'password',
+                                                        use_uid=True, readonly=True, loop=self.loop))
+        self.assertEqual(connector.chdir.call_args, call('INBOX', readonly=True))
+        self.assertEqual(connector.idle.call_count, 3)
+        self.assertEqual(self.enqueue.call_args_list, [call(1, 'INBOX')])
+        self.assertEqual(listener.exists, 6)
+
+    def test_listen_without_idle(self, connector_mock):
+        connector = self.connector(connector_mock, capability=False)
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        self.run_async(listener.listen())
+        self.assertEqual(connector.chdir.call_count, 0)
+        self.assertEqual(connector.idle.call_count, 0)
+
+    def test_listen_reconnected(self, connector_mock):
+        self.connector(connector_mock, exists=4)
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        listener.exists = 3
+        self.assertRaises(imaplib.IMAP4.abort, self.run_async, listener.listen())
+        self.assertEqual(self.enqueue.call_args_list, [call(1, 'INBOX')])
+        self.assertEqual(listener.exists, 4)
+
+    def test_listen_reconnected_unchanged(self, connector_mock):
+        self.connector(connector_mock, exists=3)
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        listener.exists = 3
+        self.assertRaises(imaplib.IMAP4.abort, self.run_async, listener.listen())
+        self.assertEqual(self.enqueue.call_count, 0)
+
+    @patch('email_backup.core.listener.get_idle_retry', Mock(return_value=0))
+    def test_run(self, connector_mock):
+        connector = self.connector(connector_mock)
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        listener.listen = returns(OSError('Connection reset'), ValueError('Unexpected'), None)
+        listener.connector = connector
+        self.run_async(listener.run())
+        self.assertEqual(listener.listen.call_count, 3)
+        self.assertEqual(connector.close.call_count, 1)
+        self.assertIsNone(listener.connector)
+
+    def test_close_error(self, connector_mock):
+        connector = self.connector(connector_mock)
+        connector.close = returns(imaplib.IMAP4.abort('EOF'))
+        listener = AccountListener(self.account, enqueue=self.enqueue, loop=self.loop)
+        listener.connector = connector
+        self.run_async(listener.close())
+        self.assertIsNone(listener.connector)
+
+
+class IdleListenerTest(ListenerTestCase):
+    def setUp(self):
+        super(IdleListenerTest, self).setUp()
+        self.listener = IdleListener(enqueue=self.enqueue, loop=self.loop)
+        self.listener.accounts = Mock(return_value=[self.account])
+        patcher = patch('email_backup.core.listener.AccountListener.run', returns(None))
+        self.run_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refresh(self):
+        self.run_async(self.listener.refresh())
+        task = self.listener.listeners[1][1]
+        self.run_async(self.listener.refresh())
+        self.assertIs(self.listener.listeners[1][1], task)
+        self.assertEqual(self.run_mock.call_count, 1)
+
+    def test_refresh_changed(self):
+        self.run_async(self.listener.refresh())
+        task = self.listener.listeners[1][1]
+        self.account.password = 'changed'
+        self.run_async(self.listener.refresh())
+        self.assertIsNot(self.listener.listeners[1][1], task)
+        self.assertEqual(self.run_mock.call_count, 2)
+
+    def test_refresh_removed(self):
+        self.run_async(self.listener.refresh())
+        self.listener.accounts.return_value = []
+        self.run_async(self.listener.refresh())
+        self.assertEqual(self.listener.listeners, {})
+
+    @patch('email_backup.core.listener.get_idle_refresh', Mock(return_value=3600))
+    def test_run_cancelled(self):
+        task = self.loop.create_task(self.listener.run())
+        self.loop.call_later(0.01, task.cancel)
+        self.assertRaises(asyncio.CancelledError, self.run_async, task)
+        self.assertEqual(self.listener.listeners, {})
+        self.assertEqual(self.run_mock.call_count, 1)
+
+
+@skipIf(six.PY2, 'asyncio requires Python 3')
+class EnqueueSyncTest(DBTestCase):
+    def setUp(self):
+        self.account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test',
+                                                   sync=True)
+
+    @patch('email_backup.core.listener.sync_account.apply_async')
+    def test_enqueue_sync(self, apply_async_mock):
+        enqueue_sync(self.account.pk, 'INBOX')
+        self.assertEqual(apply_async_mock.call_args_list, [call(args=[self.account.pk, 'INBOX'])])
+
+    @patch('email_backup.core.listener.sync_account.apply_async')
+    def test_enqueue_sync_queued(self, apply_async_mock):
+        # The emails arriving before the queued sync starts are stored by it
+        enqueue_sync(self.account.pk, 'INBOX')
+        enqueue_sync(self.account.pk, 'INBOX')
+        self.assertEqual(apply_async_mock.call_count, 1)
+        self.account.dequeue_sync()
+        enqueue_sync(self.account.pk, 'INBOX')
+        self.assertEqual(apply_async_mock.call_count, 2)
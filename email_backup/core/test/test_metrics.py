@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from mock import Mock, patch
+from email_backup.core.metrics import *
+from email_backup.core import metrics
+
+
+class SettingsTest(TestCase):
+    @patch('email_backup.core.metrics.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_METRICS_SINKS
+        del settings_mock.EMAIL_BACKUP_METRICS_PATH
+        self.assertEqual(get_metrics_sinks(), METRICS_SINKS)
+        self.assertEqual(get_metrics_path(), METRICS_PATH)
+
+    @patch('email_backup.core.metrics.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_METRICS_SINKS = ['email_backup.core.metrics.LogSink']
+        settings_mock.EMAIL_BACKUP_METRICS_PATH = '/metrics/email_backup.prom'
+        self.assertEqual(get_metrics_sinks(), ['email_backup.core.metrics.LogSink'])
+        self.assertEqual(get_metrics_path(), '/metrics/email_backup.prom')
+
+
+class HistogramTest(TestCase):
+    def test_observe(self):
+        histogram = Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.sum, 14.5)
+        self.assertEqual(histogram.count, 4)
+
+    def test_merge(self):
+        histogram, other = Histogram(buckets=(1,)), Histogram(buckets=(1,))
+        histogram.observe(0.5)
+        other.observe(2)
+        histogram.merge(other)
+        self.assertEqual(histogram.counts, [1, 1])
+        self.assertEqual(histogram.count, 2)
+
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.labels = (('account', '1'), ('host', 'imap.host.test'))
+
+    def test_snapshot(self):
+        self.registry.inc('messages', 3, self.labels)
+        self.registry.inc('messages', 2, self.labels)
+        self.registry.observe('sync_seconds', 2.5, self.labels)
+        self.assertEqual(self.registry.snapshot(), [{
+            'labels': {'account': '1', 'host': 'imap.host.test'},
+            'counters': {'messages': 5},
+            'timers': {'sync_seconds': {'count': 1, 'sum': 2.5}},
+        }])
+
+    def test_merge(self):
+        other = Registry()
+        other.inc('messages', 2, self.labels)
+        other.observe('sync_seconds', 1, self.labels)
+        self.registry.inc('messages', 1, self.labels)
+        self.registry.merge(other)
+        self.registry.merge(other)
+        self.assertEqual(self.registry.counters[('messages', self.labels)], 5)
+        self.assertEqual(self.registry.histograms[('sync_seconds', self.labels)].count, 2)
+
+    def test_prometheus(self):
+        self.registry.inc('messages', 5, self.labels)
+        self.registry.inc('messages', 1, (('host', 'a"b'),))
+        self.registry.observe('sync_seconds', 0.02, self.labels)
+        lines = self.registry.prometheus().splitlines()
+        self.assertEqual(lines[:3], [
+            '# TYPE email_backup_messages_total counter',
+            'email_backup_messages_total{account="1",host="imap.host.test"} 5',
+            'email_backup_messages_total{host="a\\"b"} 1',
+        ])
+        self.assertEqual(lines[3], '# TYPE email_backup_sync_seconds histogram')
+        self.assertIn('email_backup_sync_seconds_bucket{account="1",host="imap.host.test",le="0.01"} 0', lines)
+        self.assertIn('email_backup_sync_seconds_bucket{account="1",host="imap.host.test",le="0.05"} 1', lines)
+        self.assertIn('email_backup_sync_seconds_bucket{account="1",host="imap.host.test",le="+Inf"} 1', lines)
+        self.assertEqual(lines[-1], 'email_backup_sync_seconds_count{account="1",host="imap.host.test"} 1')
+
+    def test_prometheus_empty(self):
+        self.assertEqual(self.registry.prometheus(), '')
+
+
+class CollectTest(TestCase):
+    def test_inactive(self):
+        inc('messages')
+        observe('sync_seconds', 1)
+        with timer('sync'):
+            pass
+
+    def test_collect(self):
+        with collect(account=1, host='imap.host.test') as registry:
+            inc('messages', 2)
+            with timer('sync'):
+                pass
+        inc('messages')
+        labels = (('account', '1'), ('host', 'imap.host.test'))
+        self.assertEqual(registry.counters, {('messages', labels): 2})
+        self.assertEqual(registry.histograms[('sync_seconds', labels)].count, 1)
+
+    def test_timer_error(self):
+        with collect() as registry:
+            with self.assertRaises(ValueError):
+                with timer('sync'):
+                    raise ValueError()
+        self.assertEqual(registry.histograms[('sync_seconds', ())].count, 1)
+
+    def test_bind(self):
+        with collect(account=1) as registry:
+            func = bind(lambda value: inc('messages', value))
+        thread = threading.Thread(target=func, args=(3,))
+        thread.start()
+        thread.join()
+        self.assertEqual(registry.counters, {('messages', (('account', '1'),)): 3})
+
+
+class LogSinkTest(TestCase):
+    @patch('email_backup.core.metrics.logger')
+    def test_write(self, logger_mock):
+        registry = Registry()
+        registry.inc('messages', 10, (('account', '1'),))
+        registry.observe('sync_seconds', 2, (('account', '1'),))
+        LogSink().write(registry)
+        line = json.loads(logger_mock.info.call_args[0][0])
+        self.assertEqual(line['labels'], {'account': '1'})
+        self.assertEqual(line['messages_per_second'], 5)
+
+
+class PrometheusSinkTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        sink = PrometheusSink(os.path.join(self.directory, 'email_backup.{pid}.prom'))
+        registry = Registry()
+        registry.inc('messages', 2)
+        sink.write(registry)
+        sink.write(registry)
+        self.assertEqual(os.listdir(self.directory), ['email_backup.{}.prom'.format(os.getpid())])
+        with open(sink.path) as metrics_file:
+            self.assertIn('email_backup_messages_total 4\n', metrics_file.read())
+
+
+class PublishTest(TestCase):
+    def setUp(self):
+        metrics._sinks.clear()
+
+    def tearDown(self):
+        metrics._sinks.clear()
+
+    @patch('email_backup.core.metrics.get_metrics_sinks', Mock(return_value=['email_backup.core.metrics.LogSink']))
+    def test_sinks(self):
+        sinks = get_sinks()
+        self.assertEqual([sink.__class__ for sink in sinks], [LogSink])
+        self.assertIs(get_sinks()[0], sinks[0])
+
+    @patch('email_backup.core.metrics.get_sinks')
+    @patch('email_backup.core.metrics.logger')
+    def test_publish(self, logger_mock, get_sinks_mock):
+        broken, sink = Mock(), Mock()
+        broken.write.side_effect = IOError()
+        get_sinks_mock.return_value = [broken, sink]
+        registry = Registry()
+        publish(registry)
+        self.assertEqual(sink.write.call_args[0][0], registry)
+        self.assertEqual(logger_mock.exception.call_count, 1)
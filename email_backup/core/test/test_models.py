@@ -2,10 +2,14 @@
 from __future__ import unicode_literals
 
 from unittest import TestCase
+from django.test import TestCase as DBTestCase
+from django.utils.timezone import utc
 from mock import Mock, patch, call
 from email_backup.core.models import *
-from datetime import datetime
+from email_backup.core.storage import blob_name, blob_reused
+from datetime import datetime, timedelta
 import six
+import os
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -21,13 +25,143 @@ class EmailAccountTest(TestCase):
     def test_connector(self, interface_mock):
         self.model.connector()
         self.assertEqual(interface_mock.call_count, 1)
-        self.assertEqual(interface_mock.call_args, call('host', 993, True, 'user', 'password'))
+        self.assertEqual(interface_mock.call_args, call('host', 993, True, 'user', 'password',
+                                                        use_uid=True, readonly=True))
+        self.model.remove = True
+        self.model.connector()
+        self.assertEqual(interface_mock.call_args[1]['readonly'], False)
+
+    @patch('email_backup.core.models.get_connection_pool')
+    def test_connection_pool(self, get_connection_pool_mock):
+        self.model.connections = 2
+        pool = self.model.connection_pool()
+        self.assertEqual(pool, get_connection_pool_mock.return_value)
+        self.assertEqual(get_connection_pool_mock.call_args,
+                         call(('host', 993, 'user', False), self.model.connector, 2))
 
     def test_string(self):
         self.assertEqual(str(self.model), "user at [host]")
         self.assertEqual(unicode(self.model), u"user at [host]")
 
 
+@patch('email_backup.core.models.get_host_sessions', Mock(return_value=3))
+class EmailAccountSyncTest(DBTestCase):
+    def setUp(self):
+        self.now = datetime(2017, 7, 31, tzinfo=utc)
+        self.account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test',
+                                                   sync=True, connections=2)
+        self.other = EmailAccount.objects.create(user='other', password='password', host='IMAP.host.test',
+                                                 sync=True, connections=2)
+
+    def test_due(self):
+        self.account.next_sync = self.now + timedelta(hours=2)
+        self.account.save()
+        late = EmailAccount.objects.create(user='late', password='password', host='imap.host.test',
+                                           sync=True, backlog=10, next_sync=self.now)
+        EmailAccount.objects.create(user='off', password='password', host='imap.host.test')
+        self.assertEqual(list(EmailAccount.objects.due(self.now + timedelta(hours=1))), [late, self.other])
+
+    def test_acquire_sync(self):
+        self.assertTrue(self.account.acquire_sync())
+        self.assertIsNotNone(EmailAccount.objects.get(pk=self.account.pk).sync_started)
+        self.assertFalse(self.other.acquire_sync())
+        self.account.release_sync(5)
+        self.assertTrue(self.other.acquire_sync())
+
+    def test_acquire_sync_running(self):
+        self.assertTrue(self.account.acquire_sync())
+        self.assertFalse(EmailAccount.objects.get(pk=self.account.pk).acquire_sync())
+        self.account.release_sync()
+        self.assertTrue(self.account.acquire_sync())
+
+    def test_acquire_sync_alone(self):
+        self.account.connections = 5
+        self.assertTrue(self.account.acquire_sync())
+
+    @patch('email_backup.core.models.get_sync_timeout', Mock(return_value=timedelta(0)))
+    def test_acquire_sync_expired(self):
+        self.assertTrue(self.account.acquire_sync())
+        self.assertTrue(self.other.acquire_sync())
+        self.assertTrue(self.account.acquire_sync())
+
+    def test_queue_sync(self):
+        accounts = EmailAccount.objects.filter(pk=self.account.pk)
+        self.assertTrue(accounts.queue_sync())
+        self.assertFalse(accounts.queue_sync())
+        self.assertTrue(EmailAccount.objects.filter(pk=self.other.pk).queue_sync())
+        EmailAccount.objects.get(pk=self.account.pk).dequeue_sync()
+        self.assertIsNone(EmailAccount.objects.get(pk=self.account.pk).sync_queued)
+        self.assertTrue(accounts.queue_sync())
+
+    @patch('email_backup.core.models.get_sync_timeout', Mock(return_value=timedelta(0)))
+    def test_queue_sync_expired(self):
+        # The queued task was lost
+        accounts = EmailAccount.objects.filter(pk=self.account.pk)
+        self.assertTrue(accounts.queue_sync())
+        self.assertTrue(accounts.queue_sync())
+
+    def test_release_sync(self):
+        self.account.acquire_sync()
+        self.account.release_sync()
+        account = EmailAccount.objects.get(pk=self.account.pk)
+        self.assertIsNone(account.sync_started)
+        self.assertEqual(account.backlog, 0)
+        self.account.release_sync(7)
+        self.assertEqual(EmailAccount.objects.get(pk=self.account.pk).backlog, 7)
+
+
+class SyncRunTest(DBTestCase):
+    def setUp(self):
+        self.account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test')
+        self.path = EmailPath.objects.create(account=self.account, path='INBOX', uid_validity=100, last_uid=20)
+
+    def test_string(self):
+        run = SyncRun(path=self.path)
+        self.assertEqual(str(run), "INBOX [running]")
+        self.assertEqual(unicode(run), u"INBOX [running]")
+
+    def test_resume_new(self):
+        run = SyncRun.objects.resume(self.account, self.path, 100)
+        self.assertEqual((run.state, run.uid_validity, run.since_uid, run.checkpoint),
+                         (SyncRun.RUNNING, 100, 20, 20))
+
+    def test_resume(self):
+        paused = SyncRun.objects.create(account=self.account, path=self.path, uid_validity=100,
+                                        checkpoint=50, state=SyncRun.PAUSED)
+        SyncRun.objects.create(account=self.account, path=self.path, uid_validity=99, checkpoint=70)
+        SyncRun.objects.create(account=self.account, path=self.path, uid_validity=100, state=SyncRun.DONE)
+        run = SyncRun.objects.resume(self.account, self.path, 100)
+        self.assertEqual(run, paused)
+        self.assertEqual(run.checkpoint, 50)
+        self.assertEqual(SyncRun.objects.get(pk=paused.pk).state, SyncRun.RUNNING)
+
+    def test_cancel(self):
+        run = SyncRun.objects.create(account=self.account, path=self.path, state=SyncRun.FAILED)
+        done = SyncRun.objects.create(account=self.account, path=self.path, state=SyncRun.DONE)
+        self.assertEqual(SyncRun.objects.cancel(), 1)
+        self.assertEqual(SyncRun.objects.get(pk=run.pk).state, SyncRun.CANCELED)
+        self.assertEqual(SyncRun.objects.get(pk=done.pk).state, SyncRun.DONE)
+
+    def test_progress(self):
+        run = SyncRun.objects.resume(self.account, self.path, 100)
+        run.found(5)
+        run.progress(['21', '23'], fetched=1, linked=1)
+        run.progress([], fetched=0, linked=0)
+        run = SyncRun.objects.get(pk=run.pk)
+        self.assertEqual((run.emails, run.checkpoint, run.fetched, run.linked), (5, 23, 1, 1))
+        run.found(1)
+        self.assertEqual(run.emails, 3)
+
+    def test_finish(self):
+        run = SyncRun.objects.resume(self.account, self.path, 100)
+        run.finish(SyncRun.PAUSED)
+        self.assertIsNone(SyncRun.objects.get(pk=run.pk).finished)
+        run.finish(SyncRun.FAILED, error='ValueError()')
+        run = SyncRun.objects.get(pk=run.pk)
+        self.assertEqual((run.state, run.error), (SyncRun.FAILED, 'ValueError()'))
+        self.assertIsNotNone(run.finished)
+
+
 class EmailPathTest(TestCase):
     def setUp(self):
         self.model = EmailPath(path='path')
@@ -52,15 +186,14 @@ class EmailManagerTest(TestCase):
     def test_create_from_without_account(self):
         self.assertRaises(AssertionError, Email.objects.create_from, self.email)
 
-    @patch('email_backup.core.models.StringIO')
-    @patch('email_backup.core.models.File')
-    @patch('email_backup.core.models.default_storage')
+    @patch('email_backup.core.models.Attachment.objects.bulk_create')
+    @patch('email_backup.core.models.AttachmentStore')
+    @patch('email_backup.core.models.BlobStore')
     @patch('email_backup.core.models.EmailManager.create')
-    def test_create_from(self, create_mock, default_storage_mock, file_mock, stringIO_mock):
+    def test_create_from(self, create_mock, blob_store_mock, attachment_store_mock, bulk_create_mock):
         email_file = os.path.join(BASE_DIR, 'files', 'multi_email.eml')
         connector = Mock(spec=EmailConnectorInterface)
         connector.read.return_value = open(email_file).read()
-        default_storage_mock.path.return_value = '/'
         self.email = TmpEmail(connector, 1, 'test')
         account = Mock(spec=EmailAccount)
         account.path = '.'
@@ -71,64 +204,78 @@ class EmailManagerTest(TestCase):
         kwargs['date'] = datetime(2017, 7, 31, 14, 18, 46)
         kwargs['subject'] = 'Test subject'
         kwargs['content'] = '*Test Body*\r\n\r\n-- \r\nSignature with link <http://domain.test>\r\n'
-        kwargs['attaches'] = 2
-        kwargs['raw'] = file_mock.return_value
+        kwargs['attaches'] = 1
+        kwargs['raw'] = blob_store_mock.return_value.save.return_value
+        attachment_store_mock.return_value.save.return_value = 'attachments/pdf.bin'
+        create_mock.return_value = Email(pk=3)
 
         Email.objects.create_from(self.email, account=account)
 
-        sha = '74967d805810b1a6eddf4b7cc23d0ebe0a755ab20471fc4d4578d94eda5d612e83d3b45765a76643d86121fbba6d71fdde1d' \
-              '90e8c3a83cae1aac2645e5a9a677'
-        base_path = default_storage_mock.path.return_value
-        filename = '{}/{}/{}.eml'.format(base_path, account.path, sha)
-        filename = os.path.abspath(filename)
-
-        self.assertEqual(default_storage_mock.path.call_count, 1)
-        self.assertEqual(default_storage_mock.path.call_args, call('.'))
-        self.assertEqual(stringIO_mock.call_count, 1)
-        self.assertEqual(stringIO_mock.call_args, call(unicode(self.email)))
-        self.assertEqual(file_mock.call_count, 1)
-        self.assertEqual(file_mock.call_args, call(stringIO_mock.return_value, name=filename))
+        self.assertEqual(blob_store_mock.call_args, call(compression=account.compression))
+        self.assertEqual(blob_store_mock.return_value.save.call_count, 1)
+        self.assertEqual(blob_store_mock.return_value.save.call_args, call(self.email.raw))
         self.assertEqual(create_mock.call_count, 1)
         self.assertEqual(create_mock.call_args, call(account=account, **kwargs))
+        self.assertEqual(attachment_store_mock.call_args, call(compression=account.compression))
+        (attachment,), = bulk_create_mock.call_args[0]
+        self.assertEqual(attachment.email_id, 3)
+        self.assertEqual(attachment.blob, 'attachments/pdf.bin')
+        self.assertEqual(attachment.filename, 'pdf.pdf')
+        self.assertEqual(attachment.content_type, 'application/pdf')
+        self.assertEqual(attachment.size, 1114)
+        self.assertEqual(len(attachment.digest), 128)
 
-    @patch('email_backup.core.models.StringIO')
-    @patch('email_backup.core.models.File')
-    @patch('email_backup.core.models.default_storage')
-    @patch('email_backup.core.models.EmailManager.create')
-    def test_create_from_no_storage(self, create_mock, default_storage_mock, file_mock, stringIO_mock):
-        email_file = os.path.join(BASE_DIR, 'files', 'multi_email.eml')
-        connector = Mock(spec=EmailConnectorInterface)
-        connector.read.return_value = open(email_file).read()
-        default_storage_mock.path.side_effect = NotImplementedError
-        self.email = TmpEmail(connector, 1, 'test')
-        account = Mock(spec=EmailAccount)
-        account.path = '.'
+    @patch('email_backup.core.models.EmailManager.fields_from')
+    def test_build_from(self, fields_from_mock):
+        account = EmailAccount()
+        fields_from_mock.return_value = {'message_id': '<a@test>', 'subject': 'subject'}
+        email = Email.objects.build_from(self.email, account=account)
 
-        kwargs = {}
-        kwargs['message_id'] = '<ID_multi@email.test>'
-        kwargs['send_by'] = 'from@email.test'
-        kwargs['date'] = datetime(2017, 7, 31, 14, 18, 46)
-        kwargs['subject'] = 'Test subject'
-        kwargs['content'] = '*Test Body*\r\n\r\n-- \r\nSignature with link <http://domain.test>\r\n'
-        kwargs['attaches'] = 2
-        kwargs['raw'] = file_mock.return_value
+        self.assertIsNone(email.pk)
+        self.assertEqual(email.message_id, '<a@test>')
+        self.assertEqual(email.subject, 'subject')
+        self.assertEqual(fields_from_mock.call_args, call(self.email, account=account))
 
-        Email.objects.create_from(self.email, account=account)
+    @patch('email_backup.core.models.AttachmentStore')
+    @patch('email_backup.core.models.BlobStore')
+    def test_build_parsed(self, blob_store_mock, attachment_store_mock):
+        account = EmailAccount(compression='gzip')
+        blob_store_mock.return_value.save_encoded.return_value = 'messages/ab.eml.gz'
+        attachment_store_mock.return_value.save_encoded.return_value = 'attachments/cd.bin.gz'
+        parsed = Mock(
+            fields={'message_id': '<a@test>', 'subject': 'subject'},
+            raw=('ab', b'raw'),
+            attachments=[('a.pdf', 'application/pdf', 4, 'cd', b'pdf')]
+        )
+        email, (attachment,) = Email.objects.build_parsed(parsed, account=account)
 
-        sha = '74967d805810b1a6eddf4b7cc23d0ebe0a755ab20471fc4d4578d94eda5d612e83d3b45765a76643d86121fbba6d71fdde1d' \
-              '90e8c3a83cae1aac2645e5a9a677'
-        base_path = '.'
-        filename = '{}/{}/{}.eml'.format(base_path, account.path, sha)
-        filename = os.path.abspath(filename)
-
-        self.assertEqual(default_storage_mock.path.call_count, 1)
-        self.assertEqual(default_storage_mock.path.call_args, call('.'))
-        self.assertEqual(stringIO_mock.call_count, 1)
-        self.assertEqual(stringIO_mock.call_args, call(unicode(self.email)))
-        self.assertEqual(file_mock.call_count, 1)
-        self.assertEqual(file_mock.call_args, call(stringIO_mock.return_value, name=filename))
-        self.assertEqual(create_mock.call_count, 1)
-        self.assertEqual(create_mock.call_args, call(account=account, **kwargs))
+        self.assertIsNone(email.pk)
+        self.assertEqual(email.message_id, '<a@test>')
+        self.assertEqual(email.raw, 'messages/ab.eml.gz')
+        self.assertEqual(blob_store_mock.call_args, call(compression='gzip'))
+        self.assertEqual(blob_store_mock.return_value.save_encoded.call_args, call('ab', b'raw'))
+        self.assertEqual(attachment_store_mock.return_value.save_encoded.call_args, call('cd', b'pdf'))
+        self.assertEqual(attachment.blob, 'attachments/cd.bin.gz')
+        self.assertEqual((attachment.filename, attachment.content_type, attachment.size, attachment.digest),
+                         ('a.pdf', 'application/pdf', 4, 'cd'))
+
+    def test_build_parsed_without_account(self):
+        self.assertRaises(AssertionError, Email.objects.build_parsed, Mock())
+
+    @patch('email_backup.core.models.Attachment.objects.bulk_create')
+    @patch('email_backup.core.models.Email.save')
+    @patch('email_backup.core.models.EmailManager.build_parsed')
+    def test_create_parsed(self, build_parsed_mock, save_mock, bulk_create_mock):
+        email, attachment = Email(pk=3), Attachment()
+        build_parsed_mock.return_value = email, [attachment]
+        account = EmailAccount()
+        parsed = Mock()
+
+        self.assertEqual(Email.objects.create_parsed(parsed, account=account), email)
+        self.assertEqual(build_parsed_mock.call_args, call(parsed, account=account))
+        self.assertEqual(save_mock.call_count, 1)
+        self.assertEqual(bulk_create_mock.call_args, call([attachment]))
+        self.assertEqual(attachment.email_id, 3)
 
     @patch('email_backup.core.models.EmailManager.create_from')
     def test_get_or_create_from_new(self, create_from_mock):
@@ -161,3 +308,192 @@ class EmailManagerTest(TestCase):
         self.assertEqual(exists_mock.exists.call_args, call())
         self.assertEqual(exists_mock.get.call_count, 1)
         self.assertEqual(exists_mock.get.call_args, call())
+
+    def test_stored_message_ids_empty(self):
+        self.assertEqual(Email.objects.stored_message_ids(EmailAccount(), [None, '']), {})
+
+    @patch('email_backup.core.models.EmailManager.get_queryset')
+    def test_stored_message_ids(self, get_queryset_mock):
+        account = EmailAccount()
+        filter_mock = get_queryset_mock.return_value.filter
+        filter_mock.return_value.values_list.return_value = [('<a@test>', 1)]
+
+        ret = Email.objects.stored_message_ids(account, ['<a@test>', '<b@test>', None])
+
+        self.assertEqual(ret, {'<a@test>': 1})
+        self.assertEqual(filter_mock.call_count, 1)
+        self.assertEqual(filter_mock.call_args, call(account=account, message_id__in={'<a@test>', '<b@test>'}))
+        self.assertEqual(filter_mock.return_value.values_list.call_args, call('message_id', 'pk'))
+
+
+    @patch('email_backup.core.models.search')
+    def test_search(self, search_mock):
+        queryset = Email.objects.filter(account_id=1)
+        self.assertEqual(queryset.search('hola'), search_mock.return_value)
+        self.assertEqual(search_mock.call_args, call(queryset, 'hola'))
+        self.assertEqual(Email.objects.search('hola'), search_mock.return_value)
+
+class EmailTest(TestCase):
+    @patch('email_backup.core.models.BlobStore')
+    def test_open_raw(self, blob_store_mock):
+        email = Email(raw='messages/aa/bb/aabb.eml.gz')
+        self.assertEqual(email.open_raw(), blob_store_mock.return_value.open.return_value)
+        self.assertEqual(blob_store_mock.return_value.open.call_args, call('messages/aa/bb/aabb.eml.gz'))
+
+    def test_raw_max_length(self):
+        name = blob_name('a' * 128, '.eml.zst')
+        self.assertLessEqual(len(name), Email._meta.get_field('raw').max_length)
+
+
+class EmailLinkTest(DBTestCase):
+    def setUp(self):
+        account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test')
+        self.path = EmailPath.objects.create(account=account, path='INBOX')
+        self.other_path = EmailPath.objects.create(account=account, path='Archive')
+        date = datetime(2017, 7, 31, tzinfo=utc)
+        self.emails = [Email.objects.create(account=account, raw='messages/{}.eml'.format(i), date=date,
+                                            message_id='<{}@email.test>'.format(i), send_by='a@email.test')
+                       for i in range(3)]
+        EmailLink.objects.bulk_create([EmailLink(email=email, emailpath=self.path, uid=i + 10)
+                                       for i, email in enumerate(self.emails)])
+        EmailLink.objects.create(email=self.emails[0], emailpath=self.other_path, uid=10)
+
+    def test_vanish(self):
+        self.assertEqual(EmailLink.objects.vanish(self.path, [10, 12, 13], chunk_size=2), 2)
+        self.assertEqual(list(self.path.emails.all()), [self.emails[1]])
+        self.assertEqual(list(self.other_path.emails.all()), [self.emails[0]])
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_reset_uids(self):
+        self.assertEqual(EmailLink.objects.reset_uids(self.path), 3)
+        self.assertEqual(set(EmailLink.objects.filter(emailpath=self.path).values_list('uid', flat=True)), {None})
+        self.assertEqual(EmailLink.objects.get(emailpath=self.other_path).uid, 10)
+
+
+class ReleaseRawTest(DBTestCase):
+    def setUp(self):
+        account = EmailAccount.objects.create(host='host', user='user', password='password')
+        self.email = Email.objects.create(account=account, raw='messages/aa/bb/aabb.eml', message_id='<id>',
+                                          send_by='from@email.test', date=datetime(2017, 1, 1, tzinfo=utc))
+
+    @patch('email_backup.core.models.BlobStore')
+    def test_release_raw(self, blob_store_mock):
+        self.email.delete()
+        blob = ReleasedBlob.objects.get()
+        self.assertEqual(blob.name, 'messages/aa/bb/aabb.eml')
+        self.assertFalse(blob.attachment)
+        # The blob is deleted by the collection, an ingest could be reusing it
+        self.assertEqual(blob_store_mock.return_value.delete.call_count, 0)
+
+    def test_release_raw_twice(self):
+        ReleasedBlob.objects.create(name='messages/aa/bb/aabb.eml')
+        self.email.delete()
+        self.assertEqual(ReleasedBlob.objects.count(), 1)
+
+    def test_release_raw_empty(self):
+        release_raw(Email, Email())
+        self.assertFalse(ReleasedBlob.objects.exists())
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                self.email.delete()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(ReleasedBlob.objects.exists())
+
+
+class AttachmentTest(TestCase):
+    def test_string(self):
+        self.assertEqual(str(Attachment(filename='pdf.pdf', digest='aabb')), 'pdf.pdf')
+        self.assertEqual(unicode(Attachment(digest='aabb')), u'aabb')
+
+    @patch('email_backup.core.models.AttachmentStore')
+    def test_open(self, attachment_store_mock):
+        attachment = Attachment(blob='attachments/aa/bb/aabb.bin')
+        self.assertEqual(attachment.open(), attachment_store_mock.return_value.open.return_value)
+        self.assertEqual(attachment_store_mock.return_value.open.call_args, call('attachments/aa/bb/aabb.bin'))
+
+    def test_blob_max_length(self):
+        name = blob_name('a' * 128, '.bin.zst', 'attachments')
+        self.assertLessEqual(len(name), Attachment._meta.get_field('blob').max_length)
+
+    @patch('email_backup.core.models.AttachmentStore')
+    def test_attachments_from(self, attachment_store_mock):
+        content = Mock(digest='aabb')
+        content.__len__ = Mock(return_value=10)
+        email = Mock(spec=TmpEmail)
+        email.attachments.return_value = [('a' * 300, 'application/pdf', content)]
+        account = EmailAccount(compression='gzip')
+
+        attachment, = Email.objects.attachments_from(email, account=account)
+
+        self.assertEqual(attachment_store_mock.call_args, call(compression='gzip'))
+        self.assertEqual(attachment_store_mock.return_value.save.call_args, call(content))
+        self.assertEqual(attachment.blob, attachment_store_mock.return_value.save.return_value)
+        self.assertEqual(attachment.filename, 'a' * 255)
+        self.assertEqual(attachment.size, 10)
+        self.assertEqual(attachment.digest, 'aabb')
+        self.assertEqual(content.close.call_count, 1)
+
+    def test_attachments_from_without_account(self):
+        self.assertRaises(AssertionError, Email.objects.attachments_from, Mock(spec=TmpEmail))
+
+
+class ReleaseBlobTest(DBTestCase):
+    def test_release_blob(self):
+        release_blob(Attachment, Attachment(blob='attachments/aa/bb/aabb.bin'))
+        blob = ReleasedBlob.objects.get()
+        self.assertEqual(blob.name, 'attachments/aa/bb/aabb.bin')
+        self.assertTrue(blob.attachment)
+
+    def test_release_blob_empty(self):
+        release_blob(Attachment, Attachment())
+        self.assertFalse(ReleasedBlob.objects.exists())
+
+
+@patch('email_backup.core.models.AttachmentStore')
+@patch('email_backup.core.models.BlobStore')
+class CollectTest(DBTestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        account = EmailAccount.objects.create(host='host', user='user', password='password')
+        self.email = Email.objects.create(account=account, raw='messages/aa/bb/aabb.eml', message_id='<id>',
+                                          send_by='from@email.test', date=datetime(2017, 1, 1, tzinfo=utc))
+
+    def test_collect(self, blob_store_mock, attachment_store_mock):
+        ReleasedBlob.objects.create(name='messages/cc/dd/ccdd.eml', released=self.now - timedelta(hours=1))
+        ReleasedBlob.objects.create(name='attachments/cc/dd/ccdd.bin', attachment=True,
+                                    released=self.now - timedelta(hours=1))
+        self.assertEqual(ReleasedBlob.objects.collect(self.now), 2)
+        self.assertEqual(blob_store_mock.return_value.delete.call_args_list, [call('messages/cc/dd/ccdd.eml')])
+        self.assertEqual(attachment_store_mock.return_value.delete.call_args_list,
+                         [call('attachments/cc/dd/ccdd.bin')])
+        self.assertFalse(ReleasedBlob.objects.exists())
+
+    def test_collect_referenced(self, blob_store_mock, attachment_store_mock):
+        Attachment.objects.create(email=self.email, blob='attachments/aa/bb/aabb.bin', content_type='text/plain',
+                                  digest='aabb')
+        ReleasedBlob.objects.create(name='messages/aa/bb/aabb.eml', released=self.now - timedelta(hours=1))
+        ReleasedBlob.objects.create(name='attachments/aa/bb/aabb.bin', attachment=True,
+                                    released=self.now - timedelta(hours=1))
+        self.assertEqual(ReleasedBlob.objects.collect(self.now), 0)
+        self.assertEqual(blob_store_mock.return_value.delete.call_count, 0)
+        self.assertEqual(attachment_store_mock.return_value.delete.call_count, 0)
+        self.assertFalse(ReleasedBlob.objects.exists())
+
+    def test_collect_recent(self, blob_store_mock, attachment_store_mock):
+        ReleasedBlob.objects.create(name='messages/cc/dd/ccdd.eml', released=self.now + timedelta(hours=1))
+        self.assertEqual(ReleasedBlob.objects.collect(self.now), 0)
+        self.assertEqual(blob_store_mock.return_value.delete.call_count, 0)
+        self.assertTrue(ReleasedBlob.objects.exists())
+
+    def test_collect_reused(self, blob_store_mock, attachment_store_mock):
+        ReleasedBlob.objects.create(name='messages/cc/dd/ccdd.eml', released=self.now - timedelta(hours=1))
+        blob_reused.send(sender=BlobStore, name='messages/cc/dd/ccdd.eml')
+        self.assertEqual(ReleasedBlob.objects.collect(self.now), 0)
+        self.assertEqual(blob_store_mock.return_value.delete.call_count, 0)
+
+    def test_string(self, blob_store_mock, attachment_store_mock):
+        self.assertEqual(str(ReleasedBlob(name='messages/aa/bb/aabb.eml')), 'messages/aa/bb/aabb.eml')
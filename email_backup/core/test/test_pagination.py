@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from django.test import TestCase as DBTestCase
+from django.utils.timezone import utc
+from mock import MagicMock, Mock, patch, call
+from email_backup.core.models import Email, EmailAccount
+from email_backup.core.pagination import *
+from datetime import datetime, timedelta
+
+
+class GetApproximateCountTest(TestCase):
+    @patch('email_backup.core.pagination.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_APPROXIMATE_COUNT
+        self.assertEqual(get_approximate_count(), APPROXIMATE_COUNT)
+
+    @patch('email_backup.core.pagination.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_APPROXIMATE_COUNT = 10
+        self.assertEqual(get_approximate_count(), 10)
+
+
+@patch('email_backup.core.pagination.connections')
+class EstimateCountTest(TestCase):
+    def setUp(self):
+        self.queryset = Mock()
+        self.queryset.db = 'default'
+        self.queryset.model._meta.db_table = 'core_email'
+
+    def test_postgresql(self, connections_mock):
+        connection = MagicMock()
+        connection.vendor = 'postgresql'
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (1234.0,)
+        connections_mock.__getitem__.return_value = connection
+        self.assertEqual(estimate_count(self.queryset), 1234)
+        self.assertEqual(cursor.execute.call_args,
+                         call('SELECT reltuples FROM pg_class WHERE relname = %s', ['core_email']))
+
+    def test_sqlite(self, connections_mock):
+        connections_mock.__getitem__.return_value.vendor = 'sqlite'
+        manager = self.queryset.model._default_manager.db_manager.return_value
+        manager.aggregate.return_value = {'count': 55}
+        self.assertEqual(estimate_count(self.queryset), 55)
+        self.assertEqual(self.queryset.model._default_manager.db_manager.call_args, call('default'))
+
+    def test_unsupported(self, connections_mock):
+        connections_mock.__getitem__.return_value.vendor = 'mysql'
+        self.assertIsNone(estimate_count(self.queryset))
+
+
+@patch('email_backup.core.pagination.estimate_count')
+class KeysetPaginatorCountTest(TestCase):
+    def setUp(self):
+        self.queryset = Mock()
+        self.queryset.query.where = None
+        self.queryset.count.return_value = 10
+
+    @patch('email_backup.core.pagination.get_approximate_count', Mock(return_value=1000))
+    def test_approximate(self, estimate_count_mock):
+        estimate_count_mock.return_value = 5000
+        self.assertEqual(KeysetPaginator(self.queryset, 10).count, 5000)
+        self.assertEqual(self.queryset.count.call_count, 0)
+
+    @patch('email_backup.core.pagination.get_approximate_count', Mock(return_value=1000))
+    def test_small_table(self, estimate_count_mock):
+        estimate_count_mock.return_value = 500
+        self.assertEqual(KeysetPaginator(self.queryset, 10).count, 10)
+
+    def test_filtered(self, estimate_count_mock):
+        self.queryset.query.where = Mock()
+        self.assertEqual(KeysetPaginator(self.queryset, 10).count, 10)
+        self.assertEqual(estimate_count_mock.call_count, 0)
+
+    def test_list(self, estimate_count_mock):
+        self.assertEqual(KeysetPaginator([1, 2, 3], 2).count, 3)
+        self.assertEqual(list(KeysetPaginator([1, 2, 3], 2).page(2)), [3])
+
+
+class KeysetPaginatorTest(DBTestCase):
+    def setUp(self):
+        account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test')
+        date = datetime(2017, 7, 31, tzinfo=utc)
+        Email.objects.bulk_create([
+            Email(account=account, message_id='<{}@test>'.format(i), send_by='from@email.test',
+                  date=date - timedelta(days=i // 3))
+            for i in range(10)
+        ])
+        self.queryset = Email.objects.order_by(*KEYSET_ORDERING)
+
+    def _pages(self, paginator):
+        return [[email.pk for email in paginator.page(number)] for number in paginator.page_range]
+
+    def test_pages(self):
+        paginator = KeysetPaginator(self.queryset, 4)
+        self.assertTrue(paginator.is_keyset())
+        self.assertEqual(self._pages(paginator), self._pages(Paginator(self.queryset, 4)))
+
+    def test_pages_orphans(self):
+        paginator = KeysetPaginator(self.queryset, 4, orphans=2)
+        self.assertEqual(self._pages(paginator), self._pages(Paginator(self.queryset, 4, orphans=2)))
+
+    def test_repeated_ordering(self):
+        paginator = KeysetPaginator(self.queryset.order_by(*(KEYSET_ORDERING + KEYSET_ORDERING)), 4)
+        self.assertTrue(paginator.is_keyset())
+        self.assertEqual(self._pages(paginator), self._pages(Paginator(self.queryset, 4)))
+
+    def test_other_ordering(self):
+        queryset = Email.objects.order_by('subject', 'id')
+        paginator = KeysetPaginator(queryset, 4)
+        self.assertFalse(paginator.is_keyset())
+        self.assertEqual(self._pages(paginator), self._pages(Paginator(queryset, 4)))
+
+    def test_keyset(self):
+        emails = list(self.queryset)
+        after = emails[4]
+        self.assertEqual(list(Email.objects.keyset(after=(after.date, after.pk))), emails[5:])
+        self.assertEqual(list(Email.objects.keyset()), emails)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from mock import Mock, patch, call
+from email_backup.core.pipeline import *
+from six import BytesIO
+import gzip
+import hashlib
+import imaplib
+import os
+import threading
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_email(name):
+    with open(os.path.join(BASE_DIR, 'files', name), 'rb') as eml:
+        return eml.read()
+
+
+class PipelineSettingsTest(TestCase):
+    @patch('email_backup.core.pipeline.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_PARSE_PROCESSES
+        del settings_mock.EMAIL_BACKUP_PIPELINE_SIZE
+        del settings_mock.EMAIL_BACKUP_PIPELINE_FETCH_SIZE
+        self.assertEqual(get_parse_processes(), PARSE_PROCESSES)
+        self.assertEqual(get_pipeline_size(), PIPELINE_SIZE)
+        self.assertEqual(get_pipeline_fetch_size(), PIPELINE_FETCH_SIZE)
+
+    @patch('email_backup.core.pipeline.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_PARSE_PROCESSES = 4
+        settings_mock.EMAIL_BACKUP_PIPELINE_SIZE = 10
+        settings_mock.EMAIL_BACKUP_PIPELINE_FETCH_SIZE = 5
+        self.assertEqual(get_parse_processes(), 4)
+        self.assertEqual(get_pipeline_size(), 10)
+        self.assertEqual(get_pipeline_fetch_size(), 5)
+
+
+class ParseTest(TestCase):
+    def test_parse(self):
+        raw = read_email('multi_email.eml')
+        parsed = parse(raw, size=len(raw))
+
+        self.assertEqual(parsed.fields['message_id'], '<ID_multi@email.test>')
+        self.assertEqual(parsed.fields['send_by'], 'from@email.test')
+        self.assertEqual(parsed.fields['attaches'], 1)
+        self.assertEqual(parsed.raw, (hashlib.sha512(raw).hexdigest(), raw))
+        (filename, content_type, size, digest, data), = parsed.attachments
+        self.assertEqual((filename, content_type, size), ('pdf.pdf', 'application/pdf', 1114))
+        self.assertEqual(digest, hashlib.sha512(data).hexdigest())
+        self.assertGreaterEqual(parsed.seconds, 0)
+
+    def test_parse_compressed(self):
+        raw = read_email('plain_email.eml')
+        parsed = parse(raw, compression='gzip')
+
+        digest, data = parsed.raw
+        self.assertEqual(digest, hashlib.sha512(raw).hexdigest())
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(data), mode='rb').read(), raw)
+        self.assertEqual(parsed.attachments, [])
+
+
+@patch('email_backup.core.pipeline._pool', None)
+@patch('email_backup.core.pipeline.billiard.Pool')
+class GetParsePoolTest(TestCase):
+    @patch('email_backup.core.pipeline.get_parse_processes', Mock(return_value=0))
+    def test_disabled(self, pool_mock):
+        self.assertIsNone(get_parse_pool())
+        self.assertEqual(pool_mock.call_count, 0)
+
+    @patch('email_backup.core.pipeline.get_parse_processes', Mock(return_value=2))
+    def test_shared(self, pool_mock):
+        self.assertEqual(get_parse_pool(), pool_mock.return_value)
+        self.assertEqual(get_parse_pool(), pool_mock.return_value)
+        self.assertEqual(pool_mock.call_args_list, [call(2)])
+
+    @patch('email_backup.core.pipeline.get_parse_processes')
+    def test_processes_changed(self, processes_mock, pool_mock):
+        old, new = Mock(), Mock()
+        pool_mock.side_effect = [old, new]
+        processes_mock.return_value = 2
+        get_parse_pool()
+        processes_mock.return_value = 3
+        self.assertEqual(get_parse_pool(), new)
+        self.assertEqual(old.terminate.call_count, 1)
+
+    @patch('email_backup.core.pipeline.os.getpid')
+    @patch('email_backup.core.pipeline.get_parse_processes', Mock(return_value=2))
+    def test_forked(self, getpid_mock, pool_mock):
+        old, new = Mock(), Mock()
+        pool_mock.side_effect = [old, new]
+        getpid_mock.return_value = 10
+        get_parse_pool()
+        getpid_mock.return_value = 11
+        self.assertEqual(get_parse_pool(), new)
+        self.assertEqual(old.terminate.call_count, 0)
+
+    @patch('email_backup.core.pipeline.get_parse_processes', Mock(return_value=2))
+    def test_close(self, pool_mock):
+        pool = get_parse_pool()
+        close_parse_pool()
+        close_parse_pool()
+        self.assertEqual(pool.close.call_count, 1)
+        self.assertEqual(pool.join.call_count, 1)
+        get_parse_pool()
+        self.assertEqual(pool_mock.call_count, 2)
+
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        self.writer = Mock()
+        self.email_server = Mock()
+        self.path = Mock()
+        self.threads = threading.active_count()
+
+    def tearDown(self):
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def _message(self, server_id, raw=b'Subject: Test\r\n\r\nBody'):
+        return Mock(server_id=server_id, uid=server_id + 10, raw=raw, size=len(raw))
+
+    def test_store(self):
+        messages = [self._message(1), self._message(2)]
+        self.email_server.fetch.return_value = messages
+        pipeline = Pipeline(self.writer, size=1, fetch_size=5)
+
+        self.assertEqual(list(pipeline.store(self.email_server, 'INBOX', [1, 2], self.path)), [1, 2])
+        self.assertEqual(self.email_server.fetch.call_args, call('INBOX', [1, 2], chunk_size=5))
+        self.assertEqual(self.writer.add.call_args_list, [call(messages[0], self.path), call(messages[1], self.path)])
+
+    def test_store_empty(self):
+        pipeline = Pipeline(self.writer)
+        self.assertEqual(list(pipeline.store(self.email_server, 'INBOX', [], self.path)), [])
+        self.assertEqual(self.email_server.fetch.call_count, 0)
+
+    def test_store_parse_processes(self):
+        spooled = RawMessage()
+        spooled.write(b'Subject: Big\r\n\r\nBody')
+        messages = [self._message(1), self._message(2, raw=spooled), self._message(3)]
+        self.email_server.fetch.return_value = messages
+        parsed = [Mock(seconds=0.1), Mock(seconds=0.2)]
+        pool = Mock()
+        pool.apply_async.side_effect = [Mock(get=Mock(return_value=result)) for result in parsed]
+        pipeline = Pipeline(self.writer, compression='gzip', pool=pool, size=2)
+
+        self.assertEqual(list(pipeline.store(self.email_server, 'INBOX', [1, 2, 3], self.path)), [1, 2, 3])
+        self.assertEqual(pool.apply_async.call_args_list, [
+            call(parse, (messages[0].raw, messages[0].size, 'gzip')),
+            call(parse, (messages[2].raw, messages[2].size, 'gzip')),
+        ])
+        self.assertEqual(self.writer.add_parsed.call_args_list, [
+            call(parsed[0], 11, self.path), call(parsed[1], 13, self.path)
+        ])
+        self.assertEqual(self.writer.add.call_args_list, [call(messages[1], self.path)])
+
+    def test_store_real_processes(self):
+        raw = read_email('plain_email.eml')
+        self.email_server.fetch.return_value = [self._message(1, raw=raw)]
+        pool = billiard.Pool(1)
+        try:
+            pipeline = Pipeline(self.writer, pool=pool)
+            self.assertEqual(list(pipeline.store(self.email_server, 'INBOX', [1], self.path)), [1])
+        finally:
+            pool.close()
+            pool.join()
+        (parsed, uid, path), _ = self.writer.add_parsed.call_args
+        self.assertEqual(parsed.fields['message_id'], '<plain_id@email.test>')
+        self.assertEqual(parsed.raw, (hashlib.sha512(raw).hexdigest(), raw))
+        self.assertEqual(uid, 11)
+
+    def test_store_fetch_error(self):
+        def fetch(*args, **kwargs):
+            yield self._message(1)
+            raise imaplib.IMAP4.abort('socket error')
+        self.email_server.fetch.side_effect = fetch
+        pipeline = Pipeline(self.writer)
+
+        stored = []
+        with self.assertRaises(imaplib.IMAP4.abort):
+            for server_id in pipeline.store(self.email_server, 'INBOX', [1, 2], self.path):
+                stored.append(server_id)
+        self.assertEqual(stored, [1])
+
+    def test_store_writer_error(self):
+        fetched = []
+
+        def fetch(*args, **kwargs):
+            for server_id in range(100):
+                fetched.append(server_id)
+                yield self._message(server_id)
+        self.email_server.fetch.side_effect = fetch
+        self.writer.add.side_effect = ValueError
+        pipeline = Pipeline(self.writer, size=2)
+
+        self.assertRaises(ValueError, list, pipeline.store(self.email_server, 'INBOX', list(range(100)), self.path))
+        self.assertLess(len(fetched), 100)
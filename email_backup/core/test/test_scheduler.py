@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from mock import Mock, patch
+from email_backup.core.scheduler import *
+from datetime import datetime, timedelta
+
+
+class SettingsTest(TestCase):
+    @patch('email_backup.core.scheduler.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_SYNC_INTERVAL
+        del settings_mock.EMAIL_BACKUP_SYNC_RETRY
+        del settings_mock.EMAIL_BACKUP_SYNC_TIMEOUT
+        del settings_mock.EMAIL_BACKUP_HOST_SESSIONS
+        self.assertEqual(get_sync_interval(), timedelta(seconds=SYNC_INTERVAL))
+        self.assertEqual(get_sync_retry(), SYNC_RETRY)
+        self.assertEqual(get_sync_timeout(), timedelta(seconds=SYNC_TIMEOUT))
+        self.assertEqual(get_host_sessions(), HOST_SESSIONS)
+
+    @patch('email_backup.core.scheduler.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_SYNC_INTERVAL = 60
+        settings_mock.EMAIL_BACKUP_SYNC_RETRY = 5
+        settings_mock.EMAIL_BACKUP_SYNC_TIMEOUT = 120
+        settings_mock.EMAIL_BACKUP_HOST_SESSIONS = 2
+        self.assertEqual(get_sync_interval(), timedelta(seconds=60))
+        self.assertEqual(get_sync_retry(), 5)
+        self.assertEqual(get_sync_timeout(), timedelta(seconds=120))
+        self.assertEqual(get_host_sessions(), 2)
+
+
+class ScheduleTest(TestCase):
+    def setUp(self):
+        self.now = datetime(2017, 7, 31)
+        self.interval = timedelta(hours=1)
+
+    def test_schedule_empty(self):
+        self.assertEqual(list(schedule([], self.now, self.interval)), [])
+
+    def test_schedule_spread_per_host(self):
+        accounts = [Mock(host='imap.one.test', next_sync=None) for _ in range(4)]
+        accounts.append(Mock(host='IMAP.ONE.test', next_sync=self.now - timedelta(minutes=5)))
+        accounts.append(Mock(host='imap.two.test', next_sync=None))
+        self.assertEqual(list(schedule(accounts, self.now, self.interval)), [
+            (accounts[0], self.now),
+            (accounts[1], self.now + timedelta(minutes=12)),
+            (accounts[2], self.now + timedelta(minutes=24)),
+            (accounts[3], self.now + timedelta(minutes=36)),
+            (accounts[4], self.now + timedelta(minutes=48)),
+            (accounts[5], self.now),
+        ])
+
+    def test_schedule_keep_due_time(self):
+        due = self.now + timedelta(minutes=30)
+        account = Mock(host='imap.one.test', next_sync=due)
+        self.assertEqual(list(schedule([account], self.now, self.interval)), [(account, due)])
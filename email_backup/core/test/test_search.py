@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipUnless
+from django.db import connection
+from django.test import TestCase as DBTestCase
+from django.utils.timezone import utc
+from mock import Mock, MagicMock, patch, call
+from email_backup.core.models import Email, EmailAccount
+from email_backup.core.search import *
+from email_backup.core.search import _installed
+from datetime import datetime
+
+
+class SearchTermsTest(TestCase):
+    def test_search_terms(self):
+        self.assertEqual(search_terms('from@email.test  Hola, "mundo"'), ['from', 'email', 'test', 'Hola', 'mundo'])
+        self.assertEqual(search_terms("' OR 1=1 --"), ['OR', '1', '1'])
+        self.assertEqual(search_terms(None), [])
+
+
+class InstallTest(TestCase):
+    def setUp(self):
+        self.connection = MagicMock()
+        self.connection.alias = 'default'
+        self.cursor = self.connection.cursor.return_value.__enter__.return_value
+        _installed.clear()
+
+    def test_install_postgresql(self):
+        self.connection.vendor = 'postgresql'
+        _installed[('default', 'core_email')] = False
+        self.assertTrue(install(self.connection, 'core_email'))
+        self.assertEqual(self.cursor.execute.call_count, len(POSTGRESQL_INSTALL))
+        self.assertEqual(self.cursor.execute.call_args_list[0],
+                         call('ALTER TABLE core_email ADD COLUMN search_vector tsvector'))
+        self.assertNotIn(('default', 'core_email'), _installed)
+
+    def test_install_sqlite(self):
+        self.connection.vendor = 'sqlite'
+        self.cursor.fetchone.return_value = (1,)
+        self.assertTrue(install(self.connection, 'core_email'))
+        self.assertEqual(self.cursor.execute.call_count, len(SQLITE_INSTALL) + 1)
+
+    def test_install_sqlite_without_fts5(self):
+        self.connection.vendor = 'sqlite'
+        self.cursor.fetchone.return_value = (0,)
+        self.assertFalse(install(self.connection, 'core_email'))
+        self.assertEqual(self.cursor.execute.call_count, 1)
+
+    def test_install_unsupported(self):
+        self.connection.vendor = 'mysql'
+        self.assertFalse(install(self.connection, 'core_email'))
+        self.assertEqual(self.cursor.execute.call_count, 0)
+
+    def test_uninstall(self):
+        self.connection.vendor = 'postgresql'
+        uninstall(self.connection, 'core_email')
+        self.assertEqual(self.cursor.execute.call_count, len(POSTGRESQL_UNINSTALL))
+        self.connection.vendor = 'mysql'
+        uninstall(self.connection, 'core_email')
+        self.assertEqual(self.cursor.execute.call_count, len(POSTGRESQL_UNINSTALL))
+
+    def test_is_installed_cached(self):
+        self.connection.vendor = 'sqlite'
+        self.connection.introspection.table_names.return_value = ['core_email', 'core_email_fts']
+        self.assertTrue(is_installed(self.connection, 'core_email'))
+        self.assertTrue(is_installed(self.connection, 'core_email'))
+        self.assertEqual(self.connection.introspection.table_names.call_count, 1)
+
+    def test_is_installed_postgresql(self):
+        self.connection.vendor = 'postgresql'
+        column = Mock()
+        column.name = 'subject'
+        self.connection.introspection.get_table_description.return_value = [column]
+        self.assertFalse(is_installed(self.connection, 'core_email'))
+
+
+@patch('email_backup.core.search.is_installed')
+@patch('email_backup.core.search.connections')
+class SearchTest(TestCase):
+    def setUp(self):
+        self.queryset = Mock()
+        self.queryset.db = 'default'
+        self.queryset.model._meta.db_table = 'core_email'
+
+    def test_empty(self, connections_mock, is_installed_mock):
+        self.assertEqual(search(self.queryset, ' ,; '), self.queryset)
+        self.assertEqual(self.queryset.extra.call_count, 0)
+        self.assertEqual(self.queryset.filter.call_count, 0)
+
+    def test_postgresql(self, connections_mock, is_installed_mock):
+        connections_mock.__getitem__.return_value.vendor = 'postgresql'
+        is_installed_mock.return_value = True
+        ret = search(self.queryset, 'hola mundo')
+        self.assertEqual(ret, self.queryset.extra.return_value)
+        self.assertEqual(self.queryset.extra.call_args, call(
+            where=['core_email.search_vector @@ to_tsquery(%s, %s)'],
+            params=[SEARCH_CONFIG, 'hola:* & mundo:*']
+        ))
+
+    def test_sqlite(self, connections_mock, is_installed_mock):
+        connections_mock.__getitem__.return_value.vendor = 'sqlite'
+        is_installed_mock.return_value = True
+        ret = search(self.queryset, 'hola mundo')
+        self.assertEqual(ret, self.queryset.extra.return_value)
+        self.assertEqual(self.queryset.extra.call_args, call(
+            where=['core_email.id IN (SELECT rowid FROM core_email_fts WHERE core_email_fts MATCH %s)'],
+            params=['"hola"* "mundo"*']
+        ))
+
+    def test_not_installed(self, connections_mock, is_installed_mock):
+        is_installed_mock.return_value = False
+        ret = search(self.queryset, 'hola')
+        self.assertEqual(ret, self.queryset.filter.return_value)
+        self.assertEqual(self.queryset.extra.call_count, 0)
+        query = self.queryset.filter.call_args[0][0]
+        self.assertEqual(query.connector, 'OR')
+        self.assertEqual(query.children, [('{}__icontains'.format(f), 'hola') for f in SEARCH_FIELDS])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite full text search')
+class SQLiteSearchTest(DBTestCase):
+    def setUp(self):
+        _installed.clear()
+        if not is_installed(connection, Email._meta.db_table):
+            self.skipTest('SQLite without FTS5')
+        self.account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test')
+        date = datetime(2017, 7, 31, tzinfo=utc)
+        Email.objects.bulk_create([
+            Email(account=self.account, message_id='<1@test>', send_by='from@email.test',
+                  subject='Hola mundo', content='Test body', date=date),
+            Email(account=self.account, message_id='<2@test>', send_by='other@email.test',
+                  subject='Invoice', content='Mundial invoice', date=date),
+        ])
+
+    def _search(self, query):
+        return sorted(Email.objects.search(query).values_list('message_id', flat=True))
+
+    def test_search(self):
+        self.assertEqual(self._search('mund'), ['<1@test>', '<2@test>'])
+        self.assertEqual(self._search('hola body'), ['<1@test>'])
+        self.assertEqual(self._search('other'), ['<2@test>'])
+        self.assertEqual(self._search('missing'), [])
+
+    def test_search_updated(self):
+        Email.objects.filter(message_id='<1@test>').update(subject='Changed')
+        Email.objects.filter(message_id='<2@test>').delete()
+        self.assertEqual(self._search('hola'), [])
+        self.assertEqual(self._search('changed'), ['<1@test>'])
+        self.assertEqual(self._search('invoice'), [])
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from mock import Mock, patch, call
+from email_backup.core.storage import *
+from six import BytesIO
+import hashlib
+
+DIGEST = hashlib.sha512(b'Message').hexdigest()
+
+
+class BlobNameTest(TestCase):
+    @patch('email_backup.core.storage.settings')
+    def test_blob_name(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_BLOB_PATH
+        self.assertEqual(blob_name('abcdef'), 'messages/ab/cd/abcdef.eml')
+
+    @patch('email_backup.core.storage.settings')
+    def test_blob_name_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_BLOB_PATH = 'blobs'
+        self.assertEqual(blob_name('abcdef', '.eml.gz'), 'blobs/ab/cd/abcdef.eml.gz')
+
+
+class BlobStoreTest(TestCase):
+    def setUp(self):
+        self.storage = Mock()
+        self.storage.exists.return_value = False
+        self.storage.save.side_effect = lambda name, content: name
+        self.store = BlobStore(self.storage)
+        self.name = blob_name(DIGEST)
+
+    def test_save(self):
+        name = self.store.save(b'Message')
+        self.assertEqual(name, self.name)
+        self.assertEqual(self.storage.exists.call_args, call(self.name))
+        self.assertEqual(self.storage.save.call_count, 1)
+        self.assertEqual(self.storage.save.call_args[0][0], self.name)
+        self.assertEqual(self.storage.save.call_args[0][1].read(), b'Message')
+
+    def test_save_text(self):
+        self.assertEqual(self.store.save('Message'), self.name)
+
+    def test_save_empty(self):
+        self.assertEqual(self.store.save(None), blob_name(hashlib.sha512(b'').hexdigest()))
+
+    def test_save_exists(self):
+        self.storage.exists.return_value = True
+        name = self.store.save(b'Message')
+        self.assertEqual(name, self.name)
+        self.assertEqual(self.storage.save.call_count, 0)
+
+    def test_save_exists_reused(self):
+        self.storage.exists.return_value = True
+        receiver = Mock()
+        blob_reused.connect(receiver)
+        try:
+            self.store.save(b'Message')
+        finally:
+            blob_reused.disconnect(receiver)
+        self.assertEqual(receiver.call_args, call(signal=blob_reused, sender=BlobStore, name=self.name))
+
+    def test_save_exists_collected(self):
+        # A collection deleted the blob before the release was cancelled
+        self.storage.exists.side_effect = [True, False]
+        self.assertEqual(self.store.save(b'Message'), self.name)
+        self.assertEqual(self.storage.save.call_count, 1)
+
+    @patch('email_backup.core.storage.CHUNK_SIZE', 2)
+    def test_save_stream(self):
+        contents = []
+        self.storage.save.side_effect = lambda name, content: contents.append(content.read()) or name
+        name = self.store.save(BytesIO(b'Message'))
+        self.assertEqual(name, self.name)
+        self.assertEqual(contents, [b'Message'])
+
+    def test_save_hashed(self):
+        content = Mock()
+        content.digest = DIGEST
+        name = self.store.save(content)
+        self.assertEqual(name, self.name)
+        self.assertEqual(content.seek.call_args, call(0))
+        self.assertEqual(self.storage.save.call_args[0][1].file, content)
+        self.assertEqual(content.read.call_count, 0)
+
+    def test_encode(self):
+        self.assertEqual(self.store.encode('Message'), (DIGEST, b'Message'))
+        self.assertEqual(self.store.encode(b'Message', digest='abcdef'), ('abcdef', b'Message'))
+        self.assertEqual(self.storage.save.call_count, 0)
+
+    def test_save_encoded(self):
+        name = self.store.save_encoded(DIGEST, b'Message')
+        self.assertEqual(name, self.name)
+        self.assertEqual(self.storage.save.call_args[0][1].read(), b'Message')
+
+    def test_open(self):
+        self.assertEqual(self.store.open(self.name), self.storage.open.return_value)
+        self.assertEqual(self.storage.open.call_args, call(self.name, 'rb'))
+
+    def test_delete(self):
+        self.storage.exists.return_value = True
+        self.store.delete(self.name)
+        self.assertEqual(self.storage.delete.call_args, call(self.name))
+
+    def test_delete_not_exists(self):
+        self.store.delete(self.name)
+        self.store.delete('')
+        self.assertEqual(self.storage.delete.call_count, 0)
+
+
+class AttachmentStoreTest(TestCase):
+    @patch('email_backup.core.storage.settings')
+    def test_attachment_path(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_ATTACHMENT_PATH
+        self.assertEqual(get_attachment_path(), ATTACHMENT_PATH)
+        settings_mock.EMAIL_BACKUP_ATTACHMENT_PATH = 'files'
+        self.assertEqual(get_attachment_path(), 'files')
+
+    @patch('email_backup.core.storage.get_attachment_path', Mock(return_value='attachments'))
+    def test_save_once(self):
+        storage = MemoryStorage()
+        store = AttachmentStore(storage, compression='gzip')
+        name = store.save(b'%PDF')
+        self.assertEqual(name, blob_name(hashlib.sha512(b'%PDF').hexdigest(), '.bin.gz', 'attachments'))
+        self.assertEqual(store.save(b'%PDF'), name)
+        self.assertEqual(len(storage.files), 1)
+        self.assertEqual(AttachmentStore(storage).open(name).read(), b'%PDF')
+
+
+class MemoryStorage(object):
+    def __init__(self):
+        self.files = {}
+
+    def exists(self, name):
+        return name in self.files
+
+    def save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def open(self, name, mode='rb'):
+        return BytesIO(self.files[name])
+
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.message = b'Subject: Test\r\n\r\n' + b'Compressible body\r\n' * 1000
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, BlobStore, self.storage, 'rar')
+
+    @patch('email_backup.core.storage.zstandard', None)
+    def test_zstd_not_installed(self):
+        self.assertRaises(ValueError, BlobStore, self.storage, 'zstd')
+
+    def test_gzip(self):
+        store = BlobStore(self.storage, compression='gzip')
+        name = store.save(self.message)
+        self.assertEqual(name, blob_name(hashlib.sha512(self.message).hexdigest(), '.eml.gz'))
+        self.assertLess(len(self.storage.files[name]), len(self.message))
+        self.assertEqual(BlobStore(self.storage).open(name).read(), self.message)
+
+    def test_gzip_encoded(self):
+        store = BlobStore(self.storage, compression='gzip')
+        name = store.save_encoded(*store.encode(self.message))
+        self.assertEqual(name, blob_name(hashlib.sha512(self.message).hexdigest(), '.eml.gz'))
+        self.assertLess(len(self.storage.files[name]), len(self.message))
+        self.assertEqual(BlobStore(self.storage).open(name).read(), self.message)
+
+    @patch('email_backup.core.storage.CHUNK_SIZE', 7)
+    def test_gzip_stream(self):
+        store = BlobStore(self.storage, compression='gzip')
+        name = store.save(BytesIO(self.message))
+        self.assertEqual(name, blob_name(hashlib.sha512(self.message).hexdigest(), '.eml.gz'))
+        reader = BlobStore(self.storage).open(name)
+        self.assertEqual(reader.read(5), self.message[:5])
+        self.assertEqual(reader.read(), self.message[5:])
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        store = BlobStore(self.storage, compression='zstd')
+        name = store.save(self.message)
+        self.assertEqual(name, blob_name(hashlib.sha512(self.message).hexdigest(), '.eml.zst'))
+        self.assertLess(len(self.storage.files[name]), len(self.message))
+        self.assertEqual(BlobStore(self.storage).open(name).read(len(self.message) + 1), self.message)
+
+    def test_open_plain(self):
+        name = BlobStore(self.storage).save(self.message)
+        self.assertEqual(BlobStore(self.storage, compression='gzip').open(name).read(), self.message)
@@ -1,36 +1,133 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import random
+import shutil
+import tempfile
 from unittest import TestCase
+from django.test import TestCase as DBTestCase
+from django.test.utils import override_settings
 from mock import Mock, patch, call
 from email_backup.core.tasks import *
+from email_backup.core.tasks import _check_deadline, _last_uid, _sync_emails, _sync_path
+from email_backup.core import metrics
+from email_backup.core.connector import ConnectionPool, EmailHeader
+from email_backup.core.fakeimap import FakeIMAPServer, FakeMailbox, synthetic_email
+import threading
+
+
+def patch_sync_runs(test):
+    patcher = patch('email_backup.core.tasks.SyncRun.objects')
+    sync_runs = patcher.start()
+    test.addCleanup(patcher.stop)
+    sync_runs.resume.side_effect = lambda account, path, uid_validity: Mock(
+        checkpoint=path.last_uid, since_uid=path.last_uid
+    )
+    return sync_runs
 
 
 class SyncAllAccountTest(TestCase):
-    @patch('email_backup.core.tasks.EmailAccount.objects.filter')
-    def test_sync_all_account_empty(self, filter_mock):
-        filter_mock.return_value = []
+    @patch('email_backup.core.tasks.EmailAccount.objects.due')
+    def test_sync_all_account_empty(self, due_mock):
+        due_mock.return_value = []
         sync_all_account()
-        self.assertEqual(filter_mock.call_count, 1)
-        self.assertEqual(filter_mock.call_args, call(sync=True))
+        self.assertEqual(due_mock.call_count, 1)
 
+    @patch('email_backup.core.tasks.get_sync_interval', Mock(return_value=datetime.timedelta(hours=1)))
+    @patch('email_backup.core.tasks.timezone')
     @patch('email_backup.core.tasks.sync_account')
-    @patch('email_backup.core.tasks.EmailAccount.objects.filter')
-    def test_sync_all_account(self, filter_mock, sync_account_mock):
-        account = Mock()
-        account.pk = 1
-        filter_mock.return_value = [account]
+    @patch('email_backup.core.tasks.EmailAccount.objects.due')
+    def test_sync_all_account(self, due_mock, sync_account_mock, timezone_mock):
+        now = datetime.datetime(2017, 7, 31)
+        interval = datetime.timedelta(hours=1)
+        timezone_mock.now.return_value = now
+        accounts = [Mock(pk=1, host='imap.host.test', next_sync=None),
+                    Mock(pk=2, host='imap.host.test', next_sync=None)]
+        due_mock.return_value = accounts
         sync_all_account()
-        self.assertEqual(filter_mock.call_count, 1)
-        self.assertEqual(filter_mock.call_args, call(sync=True))
-        self.assertEqual(sync_account_mock.apply_async.call_count, 1)
-        self.assertEqual(sync_account_mock.apply_async.call_args, call(account.pk))
+        self.assertEqual(due_mock.call_args, call(now + interval))
+        self.assertEqual(sync_account_mock.apply_async.call_args_list, [
+            call(args=[1], eta=now),
+            call(args=[2], eta=now + interval // 2),
+        ])
+        self.assertEqual(accounts[0].next_sync, now + interval)
+        self.assertEqual(accounts[1].next_sync, now + interval + interval // 2)
+        self.assertEqual(accounts[1].save.call_args, call(update_fields=['next_sync']))
+
+
+class CollectBlobsTest(TestCase):
+    @patch('email_backup.core.tasks.get_sync_timeout', Mock(return_value=datetime.timedelta(hours=2)))
+    @patch('email_backup.core.tasks.timezone')
+    @patch('email_backup.core.tasks.ReleasedBlob.objects.collect')
+    def test_collect_blobs(self, collect_mock, timezone_mock):
+        timezone_mock.now.return_value = datetime.datetime(2017, 7, 31, 12)
+        self.assertEqual(collect_blobs(), collect_mock.return_value)
+        self.assertEqual(collect_mock.call_args, call(datetime.datetime(2017, 7, 31, 10)))
 
 
 class SyncAccountTest(TestCase):
+    def setUp(self):
+        self.sync_runs = patch_sync_runs(self)
+
     def test_sync_account_no_account(self):
         self.assertRaises(EmailAccount.DoesNotExist, sync_account, 1)
 
+    @patch('email_backup.core.tasks.get_sync_retry', Mock(return_value=30))
+    @patch('email_backup.core.tasks.sync_account.apply_async')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_host_busy(self, get_account_objects_mock, apply_async_mock):
+        account = Mock(spec=EmailAccount)
+        account.pk = 1
+        account.sync = True
+        account.acquire_sync.return_value = False
+        get_account_objects_mock.return_value = account
+        sync_account(1)
+        self.assertEqual(account.connection_pool.call_count, 0)
+        self.assertEqual(account.release_sync.call_count, 0)
+        self.assertEqual(apply_async_mock.call_args, call(args=[1], countdown=30))
+
+    @patch('email_backup.core.tasks._sync_account')
+    @patch('email_backup.core.tasks.sync_account.apply_async')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_paused(self, get_account_objects_mock, apply_async_mock, sync_account_mock):
+        account = Mock(spec=EmailAccount)
+        account.pk = 1
+        account.sync = True
+        get_account_objects_mock.return_value = account
+        sync_account_mock.side_effect = SyncPaused
+        released = []
+        apply_async_mock.side_effect = lambda **kwargs: released.append(account.release_sync.call_count)
+        sync_account(1)
+        self.assertEqual(apply_async_mock.call_args, call(args=[1]))
+        self.assertEqual(account.release_sync.call_args, call(None))
+        # The new task can take the lease right away
+        self.assertEqual(released, [1])
+
+    @patch('email_backup.core.tasks.metrics.publish')
+    @patch('email_backup.core.tasks._sync_account')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_metrics(self, get_account_objects_mock, sync_account_mock, publish_mock):
+        account = Mock(spec=EmailAccount)
+        account.pk = 1
+        account.host = 'IMAP.host.test'
+        account.sync = True
+        get_account_objects_mock.return_value = account
+        sync_account_mock.side_effect = lambda *args, **kwargs: metrics.inc('messages', 3) or 3
+        sync_account(1)
+        registry = publish_mock.call_args[0][0]
+        labels = (('account', '1'), ('host', 'imap.host.test'))
+        self.assertEqual(registry.counters, {('messages', labels): 3})
+        self.assertEqual(registry.histograms[('sync_seconds', labels)].count, 1)
+
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_error(self, get_account_objects_mock):
+        account = Mock(spec=EmailAccount)
+        account.sync = True
+        account.connection_pool.side_effect = ValueError
+        get_account_objects_mock.return_value = account
+        self.assertRaises(ValueError, sync_account, 1)
+        self.assertEqual(account.release_sync.call_args, call(None))
+
     @patch('email_backup.core.tasks.EmailAccount.objects.get')
     def test_sync_account_no_sync(self, get_account_objects_mock):
         account = Mock(spec=EmailAccount)
@@ -47,6 +144,8 @@ class SyncAccountTest(TestCase):
         email_server_mock = Mock()
         email_server_mock.directories.return_value = []
         account.connector.return_value = email_server_mock
+        account.connections = 1
+        account.connection_pool.return_value = ConnectionPool(account.connector)
 
         get_account_objects_mock.return_value = account
         sync_account(1)
@@ -55,8 +154,11 @@ class SyncAccountTest(TestCase):
         self.assertEqual(account.connector.call_args, call())
         self.assertEqual(email_server_mock.directories.call_count, 1)
         self.assertEqual(email_server_mock.directories.call_args, call())
-        self.assertEqual(email_server_mock.do_delete.call_count, 1)
-        self.assertEqual(email_server_mock.do_delete.call_args, call())
+        self.assertEqual(email_server_mock.open.call_count, 1)
+        self.assertEqual(email_server_mock.open.call_args, call())
+        self.assertEqual(email_server_mock.do_delete.call_count, 0)
+        self.assertEqual(email_server_mock.close.call_count, 0)
+        self.assertEqual(account.connection_pool.return_value._idle, [email_server_mock])
 
     @patch('email_backup.core.tasks.EmailPath.objects')
     @patch('email_backup.core.tasks.EmailAccount.objects.get')
@@ -69,6 +171,8 @@ class SyncAccountTest(TestCase):
         email_server_mock = Mock()
         email_server_mock.directories.return_value = [directory]
         account.connector.return_value = email_server_mock
+        account.connections = 1
+        account.connection_pool.return_value = ConnectionPool(account.connector)
         path_mock = Mock()
         path_mock.ignore = True
         objects_mock.get_or_create.return_value = path_mock, False
@@ -85,7 +189,7 @@ class SyncAccountTest(TestCase):
         self.assertEqual(objects_mock.get_or_create.call_args,
                          call(account=account, path=directory))
         self.assertEqual(email_server_mock.do_delete.call_count, 0)
-        self.assertEqual(email_server_mock.get_emails.call_count, 0)
+        self.assertEqual(email_server_mock.fetch.call_count, 0)
 
     @patch('email_backup.core.tasks.EmailPath.objects')
     @patch('email_backup.core.tasks.EmailAccount.objects.get')
@@ -98,8 +202,11 @@ class SyncAccountTest(TestCase):
         email_server_mock = Mock()
         email_server_mock.directories.return_value = [directory]
         account.connector.return_value = email_server_mock
+        account.connections = 1
+        account.connection_pool.return_value = ConnectionPool(account.connector)
         path_mock = Mock()
         path_mock.ignore = False
+        path_mock.path = directory
         objects_mock.get_or_create.return_value = path_mock, True
 
         get_account_objects_mock.return_value = account
@@ -113,12 +220,13 @@ class SyncAccountTest(TestCase):
         self.assertEqual(objects_mock.get_or_create.call_args,
                          call(account=account, path=directory))
         self.assertEqual(email_server_mock.do_delete.call_count, 0)
-        self.assertEqual(email_server_mock.get_emails.call_count, 0)
+        self.assertEqual(email_server_mock.fetch.call_count, 0)
 
+    @patch('email_backup.core.tasks.EmailWriter')
     @patch('email_backup.core.tasks.Email.objects')
     @patch('email_backup.core.tasks.EmailPath.objects')
     @patch('email_backup.core.tasks.EmailAccount.objects.get')
-    def test_sync_account_remove(self, get_account_objects_mock, objects_mock, email_objects_mock):
+    def test_sync_account_remove(self, get_account_objects_mock, objects_mock, email_objects_mock, writer_mock):
         account = Mock(spec=EmailAccount)
         account.sync = True
         account.remove = True
@@ -129,13 +237,19 @@ class SyncAccountTest(TestCase):
         email_server_mock = Mock()
         email_server_mock.directories.return_value = [directory]
         account.connector.return_value = email_server_mock
-        email_mock = Mock()
-        email_objects_mock.get_or_create_from.return_value = email_mock, True
-        path_mock = Mock()
+        account.connections = 1
+        account.connection_pool.return_value = ConnectionPool(account.connector)
+        email_objects_mock.stored_message_ids.return_value = {}
+        path_mock = Mock(uid_validity=None, highest_modseq=None, last_uid=0)
         path_mock.ignore = False
+        path_mock.path = directory
         objects_mock.get_or_create.return_value = path_mock, False
-        email_raw = Mock()
-        email_server_mock.get_emails.return_value = [email_raw]
+        email_raw = Mock(server_id=1)
+        email_raw.get.return_value = '<id@email.test>'
+        email_server_mock.status.return_value = {}
+        email_server_mock.search.return_value = [1]
+        email_server_mock.message_ids.return_value = [(1, '<id@email.test>')]
+        email_server_mock.fetch.return_value = [email_raw]
 
         get_account_objects_mock.return_value = account
         sync_account(1)
@@ -147,23 +261,31 @@ class SyncAccountTest(TestCase):
         self.assertEqual(objects_mock.get_or_create.call_count, 1)
         self.assertEqual(objects_mock.get_or_create.call_args,
                          call(account=account, path=directory))
-        self.assertEqual(email_server_mock.get_emails.call_count, 1)
-        self.assertEqual(email_server_mock.get_emails.call_args,
-                         call(directory=directory, before=before, just_read=account.just_read))
-        self.assertEqual(email_objects_mock.get_or_create_from.call_count, 1)
-        self.assertEqual(email_objects_mock.get_or_create_from.call_args,
-                         call(email_raw, account=account))
-        self.assertEqual(email_mock.paths.add.call_count, 1)
-        self.assertEqual(email_mock.paths.add.call_args, call(path_mock))
-        self.assertEqual(email_server_mock.mark_delete.call_count, 1)
-        self.assertEqual(email_server_mock.mark_delete.call_args, call(email_mock.server_id))
+        self.assertEqual(email_server_mock.search.call_count, 1)
+        self.assertEqual(email_server_mock.search.call_args,
+                         call(directory=directory, before=before, just_read=account.just_read, since_uid=0))
+        self.assertEqual(email_server_mock.message_ids.call_count, 1)
+        self.assertEqual(email_server_mock.message_ids.call_args, call(directory, [1], chunk_size=500))
+        self.assertEqual(email_objects_mock.stored_message_ids.call_count, 1)
+        self.assertEqual(email_objects_mock.stored_message_ids.call_args,
+                         call(account, ['<id@email.test>']))
+        self.assertEqual(email_server_mock.fetch.call_count, 1)
+        self.assertEqual(email_server_mock.fetch.call_args, call(directory, [1], chunk_size=50))
+        self.assertEqual(writer_mock.call_args, call(account))
+        self.assertEqual(writer_mock.return_value.add.call_count, 1)
+        self.assertEqual(writer_mock.return_value.add.call_args, call(email_raw, path_mock))
+        self.assertEqual(writer_mock.return_value.flush.call_count, 1)
+        self.assertEqual(email_server_mock.delete.call_count, 1)
+        self.assertEqual(email_server_mock.delete.call_args, call(directory, [email_raw.server_id], chunk_size=500))
         self.assertEqual(email_server_mock.do_delete.call_count, 1)
         self.assertEqual(email_server_mock.do_delete.call_args, call())
+        self.assertEqual(account.release_sync.call_args, call(1))
 
+    @patch('email_backup.core.tasks.EmailWriter')
     @patch('email_backup.core.tasks.Email.objects')
     @patch('email_backup.core.tasks.EmailPath.objects')
     @patch('email_backup.core.tasks.EmailAccount.objects.get')
-    def test_sync_account_no_remove(self, get_account_objects_mock, objects_mock, email_objects_mock):
+    def test_sync_account_no_remove(self, get_account_objects_mock, objects_mock, email_objects_mock, writer_mock):
         account = Mock(spec=EmailAccount)
         account.sync = True
         account.remove = False
@@ -174,13 +296,19 @@ class SyncAccountTest(TestCase):
         email_server_mock = Mock()
         email_server_mock.directories.return_value = [directory]
         account.connector.return_value = email_server_mock
-        email_mock = Mock()
-        email_objects_mock.get_or_create_from.return_value = email_mock, True
-        path_mock = Mock()
+        account.connections = 1
+        account.connection_pool.return_value = ConnectionPool(account.connector)
+        email_objects_mock.stored_message_ids.return_value = {}
+        path_mock = Mock(uid_validity=None, highest_modseq=None, last_uid=0)
         path_mock.ignore = False
+        path_mock.path = directory
         objects_mock.get_or_create.return_value = path_mock, False
-        email_raw = Mock()
-        email_server_mock.get_emails.return_value = [email_raw]
+        email_raw = Mock(server_id=1)
+        email_raw.get.return_value = '<id@email.test>'
+        email_server_mock.status.return_value = {}
+        email_server_mock.search.return_value = [1]
+        email_server_mock.message_ids.return_value = [(1, '<id@email.test>')]
+        email_server_mock.fetch.return_value = [email_raw]
 
         get_account_objects_mock.return_value = account
         sync_account(1)
@@ -192,13 +320,643 @@ class SyncAccountTest(TestCase):
         self.assertEqual(objects_mock.get_or_create.call_count, 1)
         self.assertEqual(objects_mock.get_or_create.call_args,
                          call(account=account, path=directory))
-        self.assertEqual(email_server_mock.get_emails.call_count, 1)
-        self.assertEqual(email_server_mock.get_emails.call_args,
-                         call(directory=directory, before=before, just_read=account.just_read))
-        self.assertEqual(email_objects_mock.get_or_create_from.call_count, 1)
-        self.assertEqual(email_objects_mock.get_or_create_from.call_args,
-                         call(email_raw, account=account))
-        self.assertEqual(email_mock.paths.add.call_count, 1)
-        self.assertEqual(email_mock.paths.add.call_args, call(path_mock))
-        self.assertEqual(email_server_mock.mark_delete.call_count, 0)
+        self.assertEqual(email_server_mock.search.call_count, 1)
+        self.assertEqual(email_server_mock.search.call_args,
+                         call(directory=directory, before=before, just_read=account.just_read, since_uid=0))
+        self.assertEqual(email_server_mock.message_ids.call_count, 1)
+        self.assertEqual(email_server_mock.message_ids.call_args, call(directory, [1], chunk_size=500))
+        self.assertEqual(email_objects_mock.stored_message_ids.call_count, 1)
+        self.assertEqual(email_objects_mock.stored_message_ids.call_args,
+                         call(account, ['<id@email.test>']))
+        self.assertEqual(email_server_mock.fetch.call_count, 1)
+        self.assertEqual(email_server_mock.fetch.call_args, call(directory, [1], chunk_size=50))
+        self.assertEqual(writer_mock.call_args, call(account))
+        self.assertEqual(writer_mock.return_value.add.call_count, 1)
+        self.assertEqual(writer_mock.return_value.add.call_args, call(email_raw, path_mock))
+        self.assertEqual(writer_mock.return_value.flush.call_count, 1)
+        self.assertEqual(email_server_mock.delete.call_count, 0)
         self.assertEqual(email_server_mock.do_delete.call_count, 0)
+
+
+@patch('email_backup.core.tasks.get_sync_retry', Mock(return_value=30))
+@patch('email_backup.core.tasks.sync_account.apply_async')
+@patch('email_backup.core.tasks._sync_account')
+class SyncAccountOverlapTest(DBTestCase):
+    def setUp(self):
+        self.account = EmailAccount.objects.create(user='user', password='password', host='imap.host.test',
+                                                   sync=True)
+
+    def test_directory_during_full_sync(self, sync_account_mock, apply_async_mock):
+        # The IDLE listener enqueues the INBOX while the scheduled sync runs
+        self.assertTrue(EmailAccount.objects.get(pk=self.account.pk).acquire_sync())
+        sync_account(self.account.pk, 'INBOX')
+        self.assertEqual(sync_account_mock.call_count, 0)
+        self.assertEqual(apply_async_mock.call_args, call(args=[self.account.pk, 'INBOX'], countdown=30))
+        self.assertIsNotNone(EmailAccount.objects.get(pk=self.account.pk).sync_started)
+
+    def test_directory_dequeued(self, sync_account_mock, apply_async_mock):
+        accounts = EmailAccount.objects.filter(pk=self.account.pk)
+        accounts.queue_sync()
+        self.assertTrue(EmailAccount.objects.get(pk=self.account.pk).acquire_sync())
+        sync_account(self.account.pk, 'INBOX')
+        # Refused by the running sync, the retry keeps the folder queued
+        self.assertIsNotNone(accounts.get().sync_queued)
+        accounts.get().release_sync()
+        sync_account(self.account.pk, 'INBOX')
+        self.assertEqual(sync_account_mock.call_count, 1)
+        self.assertIsNone(accounts.get().sync_queued)
+
+    def test_full_sync_during_directory(self, sync_account_mock, apply_async_mock):
+        def sync_directory(account, deadline=None, directory=None):
+            sync_account(self.account.pk)
+            return 1
+        sync_account_mock.side_effect = sync_directory
+        sync_account(self.account.pk, 'INBOX')
+        self.assertEqual(sync_account_mock.call_count, 1)
+        self.assertEqual(apply_async_mock.call_args, call(args=[self.account.pk], countdown=30))
+        self.assertIsNone(EmailAccount.objects.get(pk=self.account.pk).sync_started)
+
+
+class SyncAccountParallelTest(TestCase):
+    @patch('email_backup.core.tasks.metrics.publish')
+    @patch('email_backup.core.tasks.db_connection')
+    @patch('email_backup.core.tasks._sync_path')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_parallel(self, get_account_objects_mock, objects_mock, sync_path_mock, db_connection_mock,
+                                   publish_mock):
+        account = Mock(spec=EmailAccount)
+        account.sync = True
+        account.connections = 3
+        servers = [Mock(), Mock(), Mock()]
+        servers[0].directories.return_value = ['one', 'two', 'three', 'four']
+        account.connector.side_effect = servers
+        account.connection_pool.return_value = ConnectionPool(account.connector, account.connections)
+        paths = [Mock(ignore=False), Mock(ignore=False), Mock(ignore=False), Mock(ignore=False)]
+        objects_mock.get_or_create.side_effect = [(path, False) for path in paths]
+        get_account_objects_mock.return_value = account
+        # Mock call counters are not thread safe, record the calls from the workers
+        synced, closed = [], []
+        sync_path_mock.side_effect = lambda *args, **kwargs: synced.append(args) or metrics.inc('messages', 2) or 2
+        db_connection_mock.close.side_effect = lambda: closed.append(True)
+
+        sync_account(1)
+
+        self.assertEqual(len(synced), 4)
+        self.assertEqual(sorted([args[2] for args in synced], key=paths.index), paths)
+        for args in synced:
+            self.assertIn(args[0], servers)
+            self.assertEqual(args[1], account)
+        self.assertLessEqual(account.connector.call_count, 3)
+        self.assertEqual(len(closed), 4)
+        self.assertEqual(account.release_sync.call_args, call(8))
+        # The workers record on the registry of the task
+        registry = publish_mock.call_args[0][0]
+        self.assertEqual(sum(registry.counters.values()), 8)
+        for server in servers[:account.connector.call_count]:
+            self.assertEqual(server.open.call_count, 1)
+            self.assertEqual(server.close.call_count, 0)
+        self.assertEqual(account.connection_pool.return_value.idle, account.connector.call_count)
+
+    @patch('email_backup.core.tasks.ThreadPool')
+    @patch('email_backup.core.tasks.db_connection', Mock(vendor='sqlite'))
+    @patch('email_backup.core.tasks._sync_path')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_sqlite(self, get_account_objects_mock, objects_mock, sync_path_mock, thread_pool_mock):
+        account = Mock(spec=EmailAccount)
+        account.sync = True
+        account.remove = False
+        account.connections = 3
+        server = Mock()
+        server.directories.return_value = ['one', 'two']
+        account.connector.return_value = server
+        account.connection_pool.return_value = ConnectionPool(account.connector, account.connections)
+        paths = [Mock(ignore=False), Mock(ignore=False)]
+        objects_mock.get_or_create.side_effect = [(path, False) for path in paths]
+        get_account_objects_mock.return_value = account
+        sync_path_mock.return_value = 2
+
+        sync_account(1)
+
+        self.assertEqual(thread_pool_mock.call_count, 0)
+        self.assertEqual([args for args, _ in sync_path_mock.call_args_list],
+                         [(server, account, path) for path in paths])
+        self.assertEqual(account.connector.call_count, 1)
+        self.assertEqual(account.release_sync.call_args, call(4))
+
+    @patch('email_backup.core.tasks.sync_account.apply_async')
+    @patch('email_backup.core.tasks.db_connection', Mock())
+    @patch('email_backup.core.tasks._sync_path')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_parallel_soft_time_limit(self, get_account_objects_mock, objects_mock, sync_path_mock,
+                                                   apply_async_mock):
+        account = Mock(spec=EmailAccount)
+        account.pk = 1
+        account.sync = True
+        account.connections = 2
+        server = Mock()
+        server.directories.return_value = ['one', 'two']
+        account.connector.return_value = server
+        account.connection_pool.return_value = ConnectionPool(account.connector, account.connections)
+        objects_mock.get_or_create.side_effect = [(Mock(ignore=False), False), (Mock(ignore=False), False)]
+        get_account_objects_mock.return_value = account
+        started, paused = threading.Semaphore(0), []
+
+        def sync_path(*args, **kwargs):
+            started.release()
+            paused.append(kwargs['stop'].wait(5))
+            raise SyncPaused()
+        sync_path_mock.side_effect = sync_path
+
+        class InterruptedPool(ThreadPool):
+            # Celery raises SoftTimeLimitExceeded on the thread of the task
+            def map(self, func, iterable):
+                self.map_async(func, iterable)
+                started.acquire()
+                started.acquire()
+                raise SoftTimeLimitExceeded()
+
+        with patch('email_backup.core.tasks.ThreadPool', InterruptedPool):
+            sync_account(1)
+
+        self.assertEqual(paused, [True, True])
+        self.assertEqual(apply_async_mock.call_args, call(args=[1]))
+        self.assertEqual(account.release_sync.call_args, call(None))
+
+
+@override_settings(EMAIL_BACKUP_SYNC_TIME_LIMIT=0)
+class SyncAccountFakeServerTest(DBTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        now = datetime.datetime.now()
+        self.inbox = FakeMailbox('INBOX')
+        for number in range(3):
+            self.inbox.append(synthetic_email(random.Random(number), number, now, 100), now, ['\\Seen'])
+        # Flagged by another client, the account only syncs the read emails
+        self.unread = self.inbox.append(synthetic_email(random.Random(3), 3, now, 100), now, ['\\Deleted'])
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _sync(self, mailboxes, capabilities, syncs=1, **kwargs):
+        with FakeIMAPServer(mailboxes, capabilities=capabilities) as server:
+            account = EmailAccount.objects.create(user='user', password='password', host=server.host,
+                                                  port=server.port, ssl=False, sync=True, **kwargs)
+            EmailPath.objects.bulk_create([EmailPath(account=account, path=mailbox.name) for mailbox in mailboxes])
+            try:
+                for _ in range(syncs):
+                    sync_account(account.pk)
+            finally:
+                account.connection_pool().close()
+                close_parse_pool()
+        return server, account
+
+    def test_remove_uid_expunge(self):
+        server, account = self._sync([self.inbox], ('IMAP4rev1', 'UIDPLUS'), remove=True, just_read=True)
+        self.assertEqual(Email.objects.filter(account=account).count(), 3)
+        self.assertEqual([message.uid for message in self.inbox.messages], [self.unread.uid])
+
+    def test_remove_expunge(self):
+        server, account = self._sync([self.inbox], ('IMAP4rev1',), remove=True, just_read=True)
+        self.assertEqual(Email.objects.filter(account=account).count(), 3)
+        # Without UIDPLUS the folder can only be expunged as a whole
+        self.assertEqual(self.inbox.messages, [])
+
+    def test_without_message_id(self):
+        now = datetime.datetime.now()
+        raw = (b'From: from@email.test\r\nDate: Mon, 31 Jul 2017 11:30:37 +0200\r\n'
+               b'Subject: Without id\r\n\r\nBody\r\n')
+        inbox, archive = FakeMailbox('INBOX'), FakeMailbox('Archive')
+        inbox.append(raw, now, ['\\Seen'])
+        archive.append(raw, now, ['\\Seen'])
+        server, account = self._sync([inbox, archive], ('IMAP4rev1', 'UIDPLUS'))
+
+        email = Email.objects.get(account=account)
+        self.assertEqual(email.message_id, EmailHeader.parse(raw).message_id)
+        self.assertEqual(sorted(EmailLink.objects.filter(email=email).values_list('emailpath__path', flat=True)),
+                         ['Archive', 'INBOX'])
+        # The message of the second folder is found by its header, only the first one is downloaded
+        self.assertEqual(server.commands['FETCH messages'], 5)
+
+    def test_remove_move(self):
+        trash = FakeMailbox('Trash', special_use='\\Trash')
+        server, account = self._sync([self.inbox, trash], ('IMAP4rev1', 'UIDPLUS', 'MOVE', 'SPECIAL-USE'), syncs=2,
+                                     remove=True, just_read=True)
+        self.assertEqual([message.uid for message in self.inbox.messages], [self.unread.uid])
+        self.assertEqual(len(trash), 3)
+        # The moved emails are not synced again from the trash
+        self.assertEqual(Email.objects.filter(account=account).count(), 3)
+        links = EmailLink.objects.filter(email__account=account)
+        self.assertEqual(set(links.values_list('emailpath__path', flat=True)), {'INBOX'})
+        self.assertEqual(server.commands['EXPUNGE'], 0)
+
+
+class LogoutSessionsTest(TestCase):
+    @patch('email_backup.core.tasks.close_sessions')
+    def test_logout_sessions(self, close_sessions_mock):
+        worker_process_shutdown.send(sender=None, pid=1, exitcode=0)
+        self.assertEqual(close_sessions_mock.call_count, 1)
+
+
+class StopParseProcessesTest(TestCase):
+    @patch('email_backup.core.tasks.close_parse_pool')
+    def test_stop_parse_processes(self, close_parse_pool_mock):
+        worker_process_shutdown.send(sender=None, pid=1, exitcode=0)
+        self.assertEqual(close_parse_pool_mock.call_count, 1)
+
+
+class SyncEmailsTest(TestCase):
+    def setUp(self):
+        self.email_server = Mock()
+        self.account = Mock(spec=EmailAccount)
+        self.account.remove = True
+        self.path = Mock()
+        self.directory = 'directory'
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_stored(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.return_value = [(1, '<a@test>'), (2, '<b@test>')]
+        email_objects_mock.stored_message_ids.return_value = {'<a@test>': 10, '<b@test>': 20}
+        self.email_server.fetch.return_value = []
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1, 2])
+
+        writer = writer_mock.return_value
+        self.assertEqual(writer.link.call_count, 1)
+        self.assertEqual(writer.link.call_args, call([(10, 1), (20, 2)], self.path))
+        self.assertEqual(self.email_server.fetch.call_count, 0)
+        self.assertEqual(writer.add.call_count, 0)
+        self.assertEqual(self.email_server.delete.call_args_list, [call(self.directory, [1, 2], chunk_size=500)])
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_chunks(self, email_objects_mock, writer_mock):
+        self.account.remove = False
+        self.email_server.message_ids.side_effect = [[(1, '<a@test>'), (2, '<b@test>')], [(3, '<c@test>')]]
+        email_objects_mock.stored_message_ids.side_effect = [{'<a@test>': 10}, {}]
+        self.email_server.fetch.return_value = []
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1, 2, 3], chunk_size=2)
+
+        self.assertEqual(self.email_server.message_ids.call_args_list,
+                         [call(self.directory, [1, 2], chunk_size=2), call(self.directory, [3], chunk_size=2)])
+        self.assertEqual(self.email_server.fetch.call_args_list,
+                         [call(self.directory, [2], chunk_size=50), call(self.directory, [3], chunk_size=50)])
+        self.assertEqual(writer_mock.return_value.flush.call_count, 2)
+        self.assertEqual(self.email_server.delete.call_count, 0)
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_duplicated(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.return_value = [(1, '<a@test>'), (2, '<a@test>')]
+        email_objects_mock.stored_message_ids.return_value = {}
+        message = Mock()
+        message.server_id = 1
+        self.email_server.fetch.return_value = [message]
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1, 2])
+
+        self.assertEqual(self.email_server.fetch.call_args, call(self.directory, [1], chunk_size=50))
+        self.assertEqual(writer_mock.return_value.add.call_args_list, [call(message, self.path)])
+        self.assertEqual(self.email_server.delete.call_args, call(self.directory, [2, 1], chunk_size=500))
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_expunged(self, email_objects_mock, writer_mock):
+        # UID EXPUNGE or MOVE already removed them, a plain EXPUNGE would remove the skipped emails too
+        self.email_server.message_ids.return_value = [(1, '<a@test>')]
+        email_objects_mock.stored_message_ids.return_value = {'<a@test>': 10}
+        self.email_server.delete.return_value = False
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1])
+
+        self.assertEqual(self.email_server.delete.call_count, 1)
+        self.assertEqual(self.email_server.do_delete.call_count, 0)
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_expunge(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.side_effect = [[(1, '<a@test>')], [(2, '<b@test>')]]
+        email_objects_mock.stored_message_ids.return_value = {'<a@test>': 10, '<b@test>': 20}
+        self.email_server.delete.return_value = True
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1, 2], chunk_size=1)
+
+        self.assertEqual(self.email_server.delete.call_count, 2)
+        self.assertEqual(self.email_server.do_delete.call_args_list, [call()])
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_flush_error(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.return_value = [(1, '<a@test>')]
+        email_objects_mock.stored_message_ids.return_value = {}
+        self.email_server.fetch.return_value = [Mock()]
+        writer_mock.return_value.flush.side_effect = ValueError
+
+        self.assertRaises(ValueError, _sync_emails, self.email_server, self.account, self.path,
+                          self.directory, [1])
+        self.assertEqual(self.email_server.delete.call_count, 0)
+
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_progress(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.return_value = [(1, '<a@test>'), (2, '<b@test>')]
+        email_objects_mock.stored_message_ids.return_value = {'<a@test>': 10}
+        message = Mock()
+        message.server_id = 2
+        self.email_server.fetch.return_value = [message]
+        run = Mock()
+
+        _sync_emails(self.email_server, self.account, self.path, self.directory, [1, 2], run=run)
+
+        self.assertEqual(run.progress.call_args, call([1, 2], fetched=1, linked=1))
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_missing(self, email_objects_mock, writer_mock):
+        self.account.remove = False
+        self.email_server.message_ids.side_effect = [[('1', '<a@test>'), ('2', '<b@test>')], [('4', '<d@test>')]]
+        email_objects_mock.stored_message_ids.return_value = {}
+        messages = [Mock(server_id='1'), Mock(server_id='4')]
+        self.email_server.fetch.side_effect = [[messages[0]], [messages[1]]]
+        run = Mock()
+
+        failed = _sync_emails(self.email_server, self.account, self.path, self.directory, ['1', '2', '3', '4'],
+                              chunk_size=2, run=run)
+
+        self.assertEqual(failed, 2)
+        self.assertEqual(run.progress.call_args_list, [call(['1'], fetched=1, linked=0),
+                                                       call([], fetched=1, linked=0)])
+
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_all_stored(self, email_objects_mock, writer_mock):
+        self.email_server.message_ids.return_value = [(1, '<a@test>')]
+        email_objects_mock.stored_message_ids.return_value = {'<a@test>': 10}
+        self.assertIsNone(_sync_emails(self.email_server, self.account, self.path, self.directory, ['1']))
+
+    @patch('email_backup.core.tasks.time')
+    @patch('email_backup.core.tasks.EmailWriter')
+    @patch('email_backup.core.tasks.Email.objects')
+    def test_sync_emails_deadline(self, email_objects_mock, writer_mock, time_mock):
+        self.email_server.message_ids.return_value = []
+        email_objects_mock.stored_message_ids.return_value = {}
+        self.email_server.fetch.return_value = []
+        time_mock.time.side_effect = [10, 20]
+
+        self.assertRaises(SyncPaused, _sync_emails, self.email_server, self.account, self.path,
+                          self.directory, [1, 2, 3], chunk_size=2, deadline=15)
+        self.assertEqual(self.email_server.message_ids.call_count, 1)
+
+
+class CheckDeadlineTest(TestCase):
+    @patch('email_backup.core.tasks.time')
+    def test_check_deadline(self, time_mock):
+        time_mock.time.return_value = 10
+        _check_deadline(None)
+        _check_deadline(11)
+        self.assertRaises(SyncPaused, _check_deadline, 9)
+
+    def test_check_deadline_stop(self):
+        stop = threading.Event()
+        _check_deadline(None, stop)
+        stop.set()
+        self.assertRaises(SyncPaused, _check_deadline, None, stop)
+
+
+class LastUidTest(TestCase):
+    def setUp(self):
+        self.email_server = Mock()
+        self.directory = 'directory'
+
+    def test_last_uid_without_pending(self):
+        self.email_server.search.return_value = []
+        last_uid = _last_uid(self.email_server, self.directory, 10, 21, before='before', just_read=True)
+        self.assertEqual(last_uid, 20)
+        self.assertEqual(self.email_server.search.call_args,
+                         call(directory=self.directory, before='before', just_read=True,
+                              since_uid=10, invert=True))
+        self.assertEqual(self.email_server.get_uid.call_count, 0)
+
+    def test_last_uid_with_pending(self):
+        self.email_server.search.return_value = ['7', '5']
+        self.email_server.get_uid.return_value = 15
+        last_uid = _last_uid(self.email_server, self.directory, 10, 21)
+        self.assertEqual(last_uid, 14)
+        self.assertEqual(self.email_server.get_uid.call_count, 1)
+        self.assertEqual(self.email_server.get_uid.call_args, call(5))
+
+    def test_last_uid_with_old_pending(self):
+        # "UID n:*" always matches the last message of the directory
+        self.email_server.search.return_value = ['5']
+        self.email_server.get_uid.return_value = 8
+        last_uid = _last_uid(self.email_server, self.directory, 10, 21)
+        self.assertEqual(last_uid, 20)
+
+
+class SyncAccountCheckpointTest(TestCase):
+    def setUp(self):
+        self.account = Mock(spec=EmailAccount)
+        self.account.sync = True
+        self.account.remove = False
+        self.account.weeks_before = 0
+        self.account.just_read = False
+        self.directory = 'directory'
+
+        self.email_server = Mock()
+        self.email_server.directories.return_value = [self.directory]
+        self.email_server.search.return_value = []
+        self.email_server.fetch.return_value = []
+        self.account.connector.return_value = self.email_server
+        self.account.connections = 1
+        self.account.connection_pool.return_value = ConnectionPool(self.account.connector)
+
+        self.path = Mock()
+        self.path.ignore = False
+        self.path.path = self.directory
+        self.path.uid_validity = 100
+        self.path.last_uid = 20
+        self.path.highest_modseq = None
+        self.sync_runs = patch_sync_runs(self)
+
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_up_to_date(self, get_account_objects_mock, objects_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 21}
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.status.call_count, 1)
+        self.assertEqual(self.email_server.status.call_args, call(self.directory))
+        self.assertEqual(self.email_server.search.call_count, 0)
+        self.assertEqual(self.email_server.fetch.call_count, 0)
+        self.assertEqual(self.path.save.call_count, 0)
+
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_directory(self, get_account_objects_mock, objects_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 31}
+
+        sync_account(1, self.directory)
+
+        self.assertEqual(self.email_server.directories.call_count, 0)
+        self.assertEqual(objects_mock.get_or_create.call_args, call(account=self.account, path=self.directory))
+        self.assertEqual(self.email_server.search.call_args_list[0][1]['since_uid'], 20)
+        self.assertEqual(self.path.last_uid, 30)
+        self.assertEqual(self.account.release_sync.call_args, call(None))
+
+    @patch('email_backup.core.tasks.get_sync_retry', Mock(return_value=30))
+    @patch('email_backup.core.tasks.sync_account.apply_async')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_directory_host_busy(self, get_account_objects_mock, apply_async_mock):
+        self.account.pk = 1
+        self.account.acquire_sync.return_value = False
+        get_account_objects_mock.return_value = self.account
+        sync_account(1, self.directory)
+        self.assertEqual(apply_async_mock.call_args, call(args=[1, self.directory], countdown=30))
+
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_new_emails(self, get_account_objects_mock, objects_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 31}
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.search.call_count, 2)
+        self.assertEqual(self.email_server.search.call_args_list[0][1]['since_uid'], 20)
+        self.assertEqual(self.path.last_uid, 30)
+        self.assertEqual(self.path.uid_validity, 100)
+        self.assertEqual(self.path.save.call_count, 1)
+        self.assertEqual(self.path.save.call_args,
+                         call(update_fields=['uid_validity', 'last_uid', 'highest_modseq']))
+
+    @patch('email_backup.core.tasks.EmailLink.objects')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_uid_validity_changed(self, get_account_objects_mock, objects_mock, links_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.path.highest_modseq = 900
+        self.email_server.status.return_value = {'UIDVALIDITY': 200, 'UIDNEXT': 5, 'HIGHESTMODSEQ': 10}
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.search.call_args_list[0][1]['since_uid'], 0)
+        self.assertEqual(self.path.last_uid, 4)
+        self.assertEqual(self.path.uid_validity, 200)
+        self.assertEqual(self.path.highest_modseq, 10)
+        self.assertEqual(self.path.save.call_count, 1)
+        self.assertEqual(links_mock.reset_uids.call_args, call(self.path))
+        self.assertEqual(self.email_server.vanished.call_count, 0)
+
+    @patch('email_backup.core.tasks.EmailLink.objects')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_modseq_unchanged(self, get_account_objects_mock, objects_mock, links_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.path.highest_modseq = 900
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 21, 'HIGHESTMODSEQ': 900}
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.vanished.call_count, 0)
+        self.assertEqual(self.email_server.search.call_count, 0)
+        self.assertEqual(self.path.save.call_count, 0)
+
+    @patch('email_backup.core.tasks.EmailLink.objects')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_vanished(self, get_account_objects_mock, objects_mock, links_mock):
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.path.highest_modseq = 900
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 21, 'HIGHESTMODSEQ': 950}
+        self.email_server.vanished.return_value = [3, 4]
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.vanished.call_args, call(self.directory, 900, 20))
+        self.assertEqual(links_mock.vanish.call_args, call(self.path, [3, 4]))
+        self.assertEqual(self.email_server.search.call_count, 0)
+        self.assertEqual(self.path.highest_modseq, 950)
+        self.assertEqual(self.path.save.call_args, call(update_fields=['highest_modseq']))
+
+    @patch('email_backup.core.tasks.EmailLink.objects')
+    @patch('email_backup.core.tasks.EmailPath.objects')
+    @patch('email_backup.core.tasks.EmailAccount.objects.get')
+    def test_sync_account_vanished_remove(self, get_account_objects_mock, objects_mock, links_mock):
+        # The UIDs deleted by the previous sync are reported as vanished
+        self.account.remove = True
+        get_account_objects_mock.return_value = self.account
+        objects_mock.get_or_create.return_value = self.path, False
+        self.path.highest_modseq = 900
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 21, 'HIGHESTMODSEQ': 950}
+
+        sync_account(1)
+
+        self.assertEqual(self.email_server.vanished.call_count, 0)
+        self.assertEqual(links_mock.vanish.call_count, 0)
+        self.assertEqual(self.path.highest_modseq, 950)
+
+
+@patch('email_backup.core.tasks._sync_emails')
+class SyncPathRunTest(TestCase):
+    def setUp(self):
+        self.account = Mock(spec=EmailAccount)
+        self.account.remove = False
+        self.account.weeks_before = 0
+        self.account.just_read = False
+        self.email_server = Mock()
+        self.email_server.status.return_value = {'UIDVALIDITY': 100, 'UIDNEXT': 61}
+        self.email_server.search.side_effect = [['51', '52'], []]
+        self.path = Mock(path='directory', uid_validity=100, last_uid=20)
+        patcher = patch('email_backup.core.tasks.SyncRun.objects')
+        self.run = patcher.start().resume.return_value
+        self.addCleanup(patcher.stop)
+        self.run.since_uid = 20
+        self.run.checkpoint = 50
+
+    def test_resume(self, sync_emails_mock):
+        sync_emails_mock.return_value = None
+        self.assertEqual(_sync_path(self.email_server, self.account, self.path, deadline=None), 2)
+        self.assertEqual(self.email_server.search.call_args_list[0][1]['since_uid'], 50)
+        self.assertEqual(self.run.found.call_args, call(2))
+        self.assertEqual(sync_emails_mock.call_args,
+                         call(self.email_server, self.account, self.path, 'directory', ['51', '52'],
+                              run=self.run, deadline=None, stop=None))
+        self.assertEqual(self.email_server.search.call_args_list[1][1]['since_uid'], 20)
+        self.assertEqual(self.path.last_uid, 60)
+        self.assertEqual(self.run.finish.call_args, call())
+
+    def test_missing(self, sync_emails_mock):
+        sync_emails_mock.return_value = 52
+        _sync_path(self.email_server, self.account, self.path)
+        self.assertEqual(self.path.last_uid, 51)
+        self.assertEqual(self.run.finish.call_args, call())
+
+    def test_paused(self, sync_emails_mock):
+        sync_emails_mock.side_effect = SyncPaused
+        self.assertRaises(SyncPaused, _sync_path, self.email_server, self.account, self.path)
+        self.assertEqual(self.run.finish.call_args, call(SyncRun.PAUSED))
+        self.assertEqual(self.path.save.call_count, 0)
+
+    def test_failed(self, sync_emails_mock):
+        sync_emails_mock.side_effect = ValueError('error')
+        self.assertRaises(ValueError, _sync_path, self.email_server, self.account, self.path)
+        self.assertEqual(self.run.finish.call_args[0][0], SyncRun.FAILED)
+        self.assertIn('error', self.run.finish.call_args[1]['error'])
+        self.assertEqual(self.path.save.call_count, 0)
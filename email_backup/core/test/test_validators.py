@@ -9,7 +9,8 @@ from email_backup.core.validators import (
     bind_port_validator,
     port_validator,
     host_validator,
-    path_validator
+    path_validator,
+    compression_validator
 )
 
 
@@ -109,3 +110,20 @@ class PathValidatorTest(TestCase):
         self.assertRaises(ValidationError, path_validator, '+')
         self.assertRaises(ValidationError, path_validator, '"')
         self.assertRaises(ValidationError, path_validator, "'")
+
+
+class CompressionValidatorTest(TestCase):
+    def test_invalid(self):
+        self.assertRaises(ValidationError, compression_validator, 'rar')
+
+    def test_valid(self):
+        self.assertIsNone(compression_validator(''))
+        self.assertIsNone(compression_validator('gzip'))
+
+    @patch('email_backup.core.validators.storage.zstandard', None)
+    def test_zstd_not_installed(self):
+        self.assertRaises(ValidationError, compression_validator, 'zstd')
+
+    @patch('email_backup.core.validators.storage.zstandard', object())
+    def test_zstd(self):
+        self.assertIsNone(compression_validator('zstd'))
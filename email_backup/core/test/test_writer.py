@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from django.db import IntegrityError
+from django.test import TestCase as DBTestCase
+from django.utils.timezone import utc
+from mock import Mock, patch, call
+from email_backup.core.connector import Email as TmpEmail, EmailHeader
+from email_backup.core.models import EmailAccount, EmailLink, EmailPath
+from email_backup.core.writer import *
+from datetime import datetime
+
+
+class GetBatchSizeTest(TestCase):
+    @patch('email_backup.core.writer.settings')
+    def test_default(self, settings_mock):
+        del settings_mock.EMAIL_BACKUP_BATCH_SIZE
+        self.assertEqual(get_batch_size(), BATCH_SIZE)
+
+    @patch('email_backup.core.writer.settings')
+    def test_settings(self, settings_mock):
+        settings_mock.EMAIL_BACKUP_BATCH_SIZE = 10
+        self.assertEqual(get_batch_size(), 10)
+
+
+@patch('email_backup.core.writer.transaction')
+@patch('email_backup.core.writer.Email.paths')
+@patch('email_backup.core.writer.Email.objects')
+class EmailWriterTest(TestCase):
+    def setUp(self):
+        self.account = Mock()
+        self.path = Mock()
+        self.path.pk = 1
+        self.other_path = Mock()
+        self.other_path.pk = 2
+
+    def _message(self, message_id, uid=None):
+        message = Mock(uid=uid)
+        message.get.return_value = message_id
+        return message
+
+    def _email(self, message_id, pk):
+        email = Mock()
+        email.message_id = message_id
+        email.pk = pk
+        return email
+
+    def test_add(self, objects_mock, paths_mock, transaction_mock):
+        email = self._email('<a@test>', 10)
+        objects_mock.build_from.return_value = email
+        message = self._message('<a@test>', uid=7)
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add(message, self.path)
+        writer.add(message, self.other_path)
+
+        self.assertEqual(len(writer), 1)
+        self.assertEqual(objects_mock.build_from.call_count, 1)
+        self.assertEqual(objects_mock.build_from.call_args, call(message, account=self.account))
+        self.assertEqual(objects_mock.bulk_create.call_count, 0)
+
+        writer.flush()
+
+        through = paths_mock.through
+        self.assertEqual(objects_mock.bulk_create.call_count, 1)
+        self.assertEqual(objects_mock.bulk_create.call_args, call([email], batch_size=10))
+        self.assertEqual(through.call_args_list, [call(email_id=10, emailpath_id=1, uid=7),
+                                                  call(email_id=10, emailpath_id=2, uid=7)])
+        self.assertEqual(through.objects.bulk_create.call_count, 1)
+        self.assertEqual(transaction_mock.atomic.call_count, 2)
+        self.assertEqual(len(writer), 0)
+
+    @patch('email_backup.core.writer.Attachment.objects')
+    def test_add_attachments(self, attachment_objects_mock, objects_mock, paths_mock, transaction_mock):
+        objects_mock.build_from.return_value = self._email('<a@test>', 10)
+        attachments = [Attachment(filename='a.pdf'), Attachment(filename='b.pdf')]
+        objects_mock.attachments_from.return_value = attachments
+        message = self._message('<a@test>')
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add(message, self.path)
+        writer.add(message, self.other_path)
+        writer.flush()
+
+        self.assertEqual(objects_mock.attachments_from.call_count, 1)
+        self.assertEqual(objects_mock.attachments_from.call_args, call(message, account=self.account))
+        self.assertEqual(attachment_objects_mock.bulk_create.call_args, call(attachments, batch_size=10))
+        self.assertEqual([attachment.email_id for attachment in attachments], [10, 10])
+
+    @patch('email_backup.core.writer.Attachment.objects')
+    def test_add_parsed(self, attachment_objects_mock, objects_mock, paths_mock, transaction_mock):
+        email = self._email('<a@test>', 10)
+        attachments = [Attachment(filename='a.pdf')]
+        objects_mock.build_parsed.return_value = email, attachments
+        parsed = Mock(fields={'message_id': '<a@test>'})
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add_parsed(parsed, 7, self.path)
+        writer.add_parsed(parsed, 8, self.other_path)
+        writer.flush()
+
+        self.assertEqual(objects_mock.build_parsed.call_count, 1)
+        self.assertEqual(objects_mock.build_parsed.call_args, call(parsed, account=self.account))
+        self.assertEqual(objects_mock.bulk_create.call_args, call([email], batch_size=10))
+        self.assertEqual(attachment_objects_mock.bulk_create.call_args, call(attachments, batch_size=10))
+        self.assertEqual(paths_mock.through.call_args_list, [call(email_id=10, emailpath_id=1, uid=7),
+                                                             call(email_id=10, emailpath_id=2, uid=8)])
+
+    def test_add_flush_batch(self, objects_mock, paths_mock, transaction_mock):
+        objects_mock.build_from.side_effect = [self._email('<a@test>', 1), self._email('<b@test>', 2)]
+        writer = EmailWriter(self.account, batch_size=2)
+        writer.add(self._message('<a@test>'), self.path)
+        self.assertEqual(objects_mock.bulk_create.call_count, 0)
+        writer.add(self._message('<b@test>'), self.path)
+        self.assertEqual(objects_mock.bulk_create.call_count, 1)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_without_ids(self, objects_mock, paths_mock, transaction_mock):
+        email = self._email('<a@test>', None)
+        objects_mock.build_from.return_value = email
+        objects_mock.stored_message_ids.return_value = {'<a@test>': 33}
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add(self._message('<a@test>'), self.path)
+        writer.flush()
+
+        self.assertEqual(objects_mock.stored_message_ids.call_args, call(self.account, ['<a@test>']))
+        self.assertEqual(email.pk, 33)
+        self.assertEqual(paths_mock.through.call_args, call(email_id=33, emailpath_id=1, uid=None))
+
+    @patch('email_backup.core.writer.Attachment.objects')
+    def test_flush_stored_meanwhile(self, attachment_objects_mock, objects_mock, paths_mock, transaction_mock):
+        emails = [self._email('<a@test>', None), self._email('<b@test>', None)]
+        attachments = [[Attachment(filename='a.pdf')], [Attachment(filename='b.pdf')]]
+        objects_mock.build_from.side_effect = emails
+        objects_mock.attachments_from.side_effect = attachments
+
+        def bulk_create(objs, batch_size):
+            if len(objs) > 1:
+                objs[0].pk, objs[1].pk = 1, 2
+                raise IntegrityError('UNIQUE constraint failed')
+            objs[0].pk = 11
+        objects_mock.bulk_create.side_effect = bulk_create
+        objects_mock.stored_message_ids.return_value = {'<a@test>': 33}
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add(self._message('<a@test>', uid=1), self.path)
+        writer.add(self._message('<b@test>', uid=2), self.path)
+        writer.flush()
+
+        self.assertEqual(objects_mock.stored_message_ids.call_args, call(self.account, ['<a@test>', '<b@test>']))
+        self.assertEqual(objects_mock.bulk_create.call_args, call([emails[1]], batch_size=10))
+        self.assertEqual([email.pk for email in emails], [33, 11])
+        self.assertEqual(attachment_objects_mock.bulk_create.call_args, call(attachments[1], batch_size=10))
+        self.assertEqual(paths_mock.through.call_args_list, [call(email_id=11, emailpath_id=1, uid=2),
+                                                             call(email_id=33, emailpath_id=1, uid=1)])
+
+    def test_flush_integrity_error(self, objects_mock, paths_mock, transaction_mock):
+        objects_mock.build_from.return_value = self._email('<a@test>', None)
+        objects_mock.bulk_create.side_effect = IntegrityError('NOT NULL constraint failed')
+        objects_mock.stored_message_ids.return_value = {}
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.add(self._message('<a@test>'), self.path)
+        self.assertRaises(IntegrityError, writer.flush)
+
+    def test_link(self, objects_mock, paths_mock, transaction_mock):
+        through = paths_mock.through
+        through.objects.filter.return_value.values_list.return_value = [(10, 1, 5)]
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.link([(10, 5), (11, 6)], self.path)
+        writer.flush()
+
+        self.assertEqual(objects_mock.bulk_create.call_count, 0)
+        self.assertEqual(through.objects.filter.call_args_list,
+                         [call(email_id__in={10, 11}, emailpath_id__in={1})])
+        self.assertEqual(through.call_args_list, [call(email_id=11, emailpath_id=1, uid=6)])
+
+    def test_link_new_uid(self, objects_mock, paths_mock, transaction_mock):
+        through = paths_mock.through
+        through.objects.filter.return_value.values_list.return_value = [(10, 1, None), (11, 1, 6)]
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.link([(10, 5), (11, None)], self.path)
+        writer.flush()
+
+        self.assertEqual(through.objects.filter.call_args_list[1:], [call(email_id=10, emailpath_id=1)])
+        self.assertEqual(through.objects.filter.return_value.update.call_args, call(uid=5))
+        self.assertEqual(through.call_count, 0)
+
+    def test_flush_empty(self, objects_mock, paths_mock, transaction_mock):
+        writer = EmailWriter(self.account, batch_size=10)
+        writer.flush()
+        self.assertEqual(transaction_mock.atomic.call_count, 0)
+
+    def test_context(self, objects_mock, paths_mock, transaction_mock):
+        objects_mock.build_from.return_value = self._email('<a@test>', 1)
+        with EmailWriter(self.account, batch_size=10) as writer:
+            writer.add(self._message('<a@test>'), self.path)
+        self.assertEqual(objects_mock.bulk_create.call_count, 1)
+
+    def test_context_error(self, objects_mock, paths_mock, transaction_mock):
+        objects_mock.build_from.return_value = self._email('<a@test>', 1)
+        try:
+            with EmailWriter(self.account, batch_size=10) as writer:
+                writer.add(self._message('<a@test>'), self.path)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(objects_mock.bulk_create.call_count, 0)
+
+
+@patch('email_backup.core.models.BlobStore', Mock(return_value=Mock(
+    save_encoded=Mock(return_value='messages/aa/bb/aabb.eml'))))
+class EmailWriterConcurrentTest(DBTestCase):
+    def setUp(self):
+        self.account = EmailAccount.objects.create(host='host', user='user', password='password')
+        self.inbox = EmailPath.objects.create(account=self.account, path='INBOX')
+        self.all_mail = EmailPath.objects.create(account=self.account, path='All Mail')
+        self.parsed = Mock(raw=('aabb', b'raw'), attachments=[], fields={
+            'message_id': '<a@test>', 'send_by': 'from@email.test', 'subject': 'Test', 'content': '',
+            'attaches': 0, 'date': datetime(2017, 1, 1, tzinfo=utc),
+        })
+
+    def test_same_message_in_two_folders(self):
+        # Both folder threads checked the stored Message-Ids before any of them flushed
+        inbox, all_mail = EmailWriter(self.account), EmailWriter(self.account)
+        inbox.add_parsed(self.parsed, 1, self.inbox)
+        all_mail.add_parsed(self.parsed, 2, self.all_mail)
+        inbox.flush()
+        all_mail.flush()
+
+        email = Email.objects.get()
+        self.assertEqual(sorted(EmailLink.objects.filter(email=email).values_list('emailpath__path', 'uid')),
+                         [('All Mail', 2), ('INBOX', 1)])
+
+
+@patch('email_backup.core.models.BlobStore', Mock(return_value=Mock(
+    save=Mock(return_value='messages/aa/bb/aabb.eml'))))
+class EmailWriterWithoutMessageIdTest(DBTestCase):
+    def setUp(self):
+        self.account = EmailAccount.objects.create(host='host', user='user', password='password')
+        self.inbox = EmailPath.objects.create(account=self.account, path='INBOX')
+        self.all_mail = EmailPath.objects.create(account=self.account, path='All Mail')
+        self.raw = (b'From: from@email.test\r\nDate: Mon, 31 Jul 2017 11:30:37 +0200\r\n'
+                    b'Subject: Without id\r\n\r\nBody\r\n')
+
+    def _message(self, uid):
+        message = TmpEmail(None, uid, 'INBOX', uid=uid)
+        message.feed(self.raw)
+        return message
+
+    def test_synced_again(self):
+        for path, uid in ((self.inbox, 1), (self.all_mail, 2), (self.inbox, 1)):
+            with EmailWriter(self.account) as writer:
+                writer.add(self._message(uid), path)
+
+        email = Email.objects.get()
+        self.assertEqual(email.message_id, EmailHeader.parse(self.raw).message_id)
+        self.assertEqual(sorted(EmailLink.objects.filter(email=email).values_list('emailpath__path', 'uid')),
+                         [('All Mail', 2), ('INBOX', 1)])
+        self.assertEqual(Email.objects.stored_message_ids(self.account, [email.message_id]),
+                         {email.message_id: email.pk})
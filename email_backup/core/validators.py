@@ -9,6 +9,8 @@ from django.core.exceptions import ValidationError
 from django.core.validators import validate_ipv46_address
 from django.utils.translation import ugettext_lazy as _
 
+from email_backup.core import storage
+
 RE_PATH = re.compile('([\w/\[\] .-]+)$', re.UNICODE)
 
 
@@ -58,3 +60,12 @@ def host_validator(value):
         except socket.error:
             message = _('%(show_value)s is not valid host name, cannot be resolved')
             raise ValidationError(message, code='invalid_host', params={'show_value': value})
+
+
+def compression_validator(value):
+    if value not in storage.COMPRESSION_EXTENSIONS:
+        message = _('%(show_value)s is not valid compression')
+        raise ValidationError(message, code='invalid_compression', params={'show_value': value})
+    if value == 'zstd' and storage.zstandard is None:
+        message = _('%(show_value)s compression requires the zstandard package')
+        raise ValidationError(message, code='invalid_compression', params={'show_value': value})
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from email_backup.core import metrics
+from email_backup.core.models import Attachment, Email
+
+BATCH_SIZE = 500
+
+
+def get_batch_size():
+    return getattr(settings, 'EMAIL_BACKUP_BATCH_SIZE', BATCH_SIZE)
+
+
+class EmailWriter(object):
+    def __init__(self, account, batch_size=None):
+        self.account = account
+        self.batch_size = batch_size or get_batch_size()
+        self.emails = OrderedDict()
+        self.links = []
+
+    def __len__(self):
+        return len(self.emails) + len(self.links)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, message, path):
+        message_id = message.get('Message-Id')
+        if message_id in self.emails:
+            self.emails[message_id][1][path.pk] = message.uid
+        else:
+            email = Email.objects.build_from(message, account=self.account)
+            attachments = Email.objects.attachments_from(message, account=self.account)
+            self.emails[message_id] = (email, {path.pk: message.uid}, attachments)
+        self._check_size()
+
+    def add_parsed(self, parsed, uid, path):
+        message_id = parsed.fields['message_id']
+        if message_id in self.emails:
+            self.emails[message_id][1][path.pk] = uid
+        else:
+            email, attachments = Email.objects.build_parsed(parsed, account=self.account)
+            self.emails[message_id] = (email, {path.pk: uid}, attachments)
+        self._check_size()
+
+    def link(self, email_uids, path):
+        for email_pk, uid in email_uids:
+            self.links.append((email_pk, path.pk, uid))
+        self._check_size()
+
+    def _check_size(self):
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not len(self):
+            return
+        with metrics.timer('db_write'), transaction.atomic():
+            emails = [email for email, _, _ in self.emails.values()]
+            existing = self._create(emails) if emails else {}
+            missing = [email.message_id for email in emails if email.pk is None]
+            if missing:
+                # Backends without RETURNING on bulk inserts
+                stored = Email.objects.stored_message_ids(self.account, missing)
+                for email in emails:
+                    if email.pk is None:
+                        email.pk = stored[email.message_id]
+
+            through = Email.paths.through
+            links = OrderedDict(((email_pk, path_pk), uid) for email_pk, path_pk, uid in self.links)
+            # The emails stored meanwhile by another sync can be linked to the paths already
+            for email, path_uids, _ in self.emails.values():
+                if email.message_id in existing:
+                    for path_pk, uid in path_uids.items():
+                        links[email.pk, path_pk] = uid
+            if links:
+                exists = through.objects.filter(
+                    email_id__in=set(email_pk for email_pk, _ in links),
+                    emailpath_id__in=set(path_pk for _, path_pk in links),
+                ).values_list('email_id', 'emailpath_id', 'uid')
+                for email_pk, path_pk, uid in exists:
+                    new_uid = links.pop((email_pk, path_pk), None)
+                    if new_uid is not None and new_uid != uid:
+                        # The UIDs of the path changed or the link is older than them
+                        through.objects.filter(email_id=email_pk, emailpath_id=path_pk).update(uid=new_uid)
+            attachments = []
+            for email, path_uids, email_attachments in self.emails.values():
+                if email.message_id in existing:
+                    continue
+                for path_pk, uid in path_uids.items():
+                    links[email.pk, path_pk] = uid
+                for attachment in email_attachments:
+                    attachment.email_id = email.pk
+                    attachments.append(attachment)
+            if attachments:
+                Attachment.objects.bulk_create(attachments, batch_size=self.batch_size)
+            through.objects.bulk_create(
+                [through(email_id=email_pk, emailpath_id=path_pk, uid=uid)
+                 for (email_pk, path_pk), uid in sorted(links.items())],
+                batch_size=self.batch_size
+            )
+        self.emails = OrderedDict()
+        self.links = []
+
+    def _create(self, emails):
+        # The folders synced in parallel can store the same messages, those rows are linked instead
+        existing = {}
+        while True:
+            new = [email for email in emails if email.message_id not in existing]
+            try:
+                with transaction.atomic():
+                    Email.objects.bulk_create(new, batch_size=self.batch_size)
+                return existing
+            except IntegrityError:
+                stored = Email.objects.stored_message_ids(self.account, [email.message_id for email in new])
+                if not stored:
+                    raise
+                existing.update(stored)
+                for email in new:
+                    # The keys returned before the rollback are gone
+                    email.pk = stored.get(email.message_id)
@@ -128,3 +128,52 @@ STATIC_URL = '/static/'
 
 DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'storage')
+
+# Email backup
+
+# Number of emails stored per INSERT and transaction while syncing
+EMAIL_BACKUP_BATCH_SIZE = 500
+# Storage path for the raw emails, shared by all the accounts
+EMAIL_BACKUP_BLOB_PATH = 'messages'
+# Storage path for the attachments, each content is stored once for all the emails
+EMAIL_BACKUP_ATTACHMENT_PATH = 'attachments'
+# Tables with more emails are paginated with an estimated count in the admin
+EMAIL_BACKUP_APPROXIMATE_COUNT = 100000
+# Seconds between the syncs of an account, sync_all_account should run at least this often
+EMAIL_BACKUP_SYNC_INTERVAL = 3600
+# Maximum number of simultaneous IMAP sessions against the same host
+EMAIL_BACKUP_HOST_SESSIONS = 20
+# Seconds to wait before retrying an account when its host is busy
+EMAIL_BACKUP_SYNC_RETRY = 60
+# Seconds after which a running sync is considered dead
+EMAIL_BACKUP_SYNC_TIMEOUT = 14400
+# Seconds a sync task runs before leaving the rest for a new task, 0 disables it
+EMAIL_BACKUP_SYNC_TIME_LIMIT = 600
+# IMAP sessions kept open by each worker process for the next tasks, the least recently used are closed first
+EMAIL_BACKUP_SESSION_CACHE_SIZE = 8
+# Seconds between the NOOP commands keeping the idle sessions alive, 0 disables them
+EMAIL_BACKUP_SESSION_KEEPALIVE = 240
+# Seconds an unused session is kept open
+EMAIL_BACKUP_SESSION_MAX_IDLE = 7200
+# Processes parsing, hashing and compressing the fetched emails of each worker, 0 parses them on the sync thread
+EMAIL_BACKUP_PARSE_PROCESSES = 0
+# Emails waiting between the fetch, parse and write stages of a sync before the fetch waits for the others
+EMAIL_BACKUP_PIPELINE_SIZE = 100
+# Emails requested by each IMAP FETCH of the pipeline
+EMAIL_BACKUP_PIPELINE_FETCH_SIZE = 50
+# Characters of the text stored and indexed for each email, 0 keeps all of them
+EMAIL_BACKUP_CONTENT_MAX_LENGTH = 65536
+# Sinks receiving the timings and counters of each sync, e.g. 'email_backup.core.metrics.LogSink'
+EMAIL_BACKUP_METRICS_SINKS = ()
+# File written by email_backup.core.metrics.PrometheusSink, {pid} is replaced by the worker process id
+EMAIL_BACKUP_METRICS_PATH = '/tmp/email_backup.{pid}.prom'
+# Seconds an IMAP IDLE command of the listen_idle command lasts before being renewed
+EMAIL_BACKUP_IDLE_TIMEOUT = 1500
+# Seconds to wait before reconnecting a failed IDLE session
+EMAIL_BACKUP_IDLE_RETRY = 60
+# Seconds an IDLE session waits after enqueueing a sync, the emails arriving meanwhile are synced together
+EMAIL_BACKUP_IDLE_DEBOUNCE = 10
+# Seconds between the reloads of the accounts listened by listen_idle
+EMAIL_BACKUP_IDLE_REFRESH = 300
+# FETCH commands of the asyncio connector waiting for their answer at once, only their emails are held in memory
+EMAIL_BACKUP_FETCH_WINDOW = 4